@@ -1,12 +1,114 @@
 import json
 import os
+import time
+import uuid
 
-from Shared.msg_enum import msg_type
+import numpy as np
+
+from Shared.confusion import metrics_from_counts
+from Shared.messages import METRIC_NAMES, MetricsSnapshotMsg, ObjectivesMsg, ObjectiveRationale
+from fleet import FleetState
+
+# metrics that degrade when they increase, every other metric degrades when it decreases
+HIGHER_IS_WORSE = ('fpr', 'fnr')
+
+
+class ChangePointDetector:
+    """
+    Streaming change-point detection on the metrics of one layer, with O(1) state per metric.
+
+    Each snapshot updates an EWMA of every metric and of its variance. The distance of a metric from its target,
+    in the direction where it degrades and in units of its EWMA standard deviation, feeds a one-sided CUSUM:
+    small excursions within `slack` deviations are absorbed, a sustained degradation accumulates.
+    A metric raises an alarm once the CUSUM exceeds `alarm_threshold`, after at least `min_samples` snapshots
+    and while its EWMA is on the wrong side of the target. The alarm holds until the CUSUM falls below
+    `release_ratio * alarm_threshold`, so that a metric hovering around its target does not flap.
+    """
+
+    def __init__(self, thresholds: dict, alpha: float = 0.2, slack: float = 0.5, alarm_threshold: float = 5.0,
+                 release_ratio: float = 0.5, min_samples: int = 10, min_sigma: float = 0.01):
+        """
+        :param thresholds: target of each metric of METRIC_NAMES.
+        :param alpha: weight of the last snapshot in the EWMA.
+        :param slack: deviations from the target, in standard deviations, absorbed at each snapshot.
+        :param alarm_threshold: CUSUM value raising an alarm.
+        :param release_ratio: fraction of alarm_threshold below which the CUSUM releases an alarm.
+        :param min_samples: snapshots needed before any alarm.
+        :param min_sigma: lower bound of the standard deviation, for metrics that barely move.
+        """
+        self.thresholds = np.array([thresholds[metric] for metric in METRIC_NAMES], dtype=float)
+        # +1 where a higher value is a degradation, -1 where a lower value is
+        self.direction = np.array([1.0 if metric in HIGHER_IS_WORSE else -1.0 for metric in METRIC_NAMES])
+
+        self.alpha = alpha
+        self.slack = slack
+        self.alarm_threshold = alarm_threshold
+        self.release_ratio = release_ratio
+        self.min_samples = min_samples
+        self.min_sigma = min_sigma
+
+        self.reset()
+
+    def reset(self):
+        self.samples = 0
+        self.values = np.zeros(len(METRIC_NAMES))
+        self.ewma = np.zeros(len(METRIC_NAMES))
+        self.ewm_var = np.zeros(len(METRIC_NAMES))
+        self.cusum = np.zeros(len(METRIC_NAMES))
+        self.alarmed = np.zeros(len(METRIC_NAMES), dtype=bool)
+
+    def update(self, values) -> np.ndarray:
+        """
+        :param values: the metrics of a snapshot, in the order of METRIC_NAMES.
+        :return: whether each metric is in alarm after this snapshot.
+        """
+        self.values = np.asarray(values, dtype=float)
+
+        if self.samples == 0:
+            self.ewma = self.values.copy()
+        else:
+            diff = self.values - self.ewma
+            self.ewma += self.alpha * diff
+            self.ewm_var = (1 - self.alpha) * (self.ewm_var + self.alpha * diff ** 2)
+        self.samples += 1
+
+        sigma = np.maximum(np.sqrt(self.ewm_var), self.min_sigma)
+        deviation = self.direction * (self.values - self.thresholds) / sigma
+        self.cusum = np.maximum(0.0, self.cusum + deviation - self.slack)
+
+        raise_alarm = ((self.samples >= self.min_samples)
+                       & (self.cusum > self.alarm_threshold)
+                       & (self.direction * (self.ewma - self.thresholds) > 0))
+        hold_alarm = self.cusum > self.release_ratio * self.alarm_threshold
+        self.alarmed = np.where(self.alarmed, hold_alarm, raise_alarm)
+
+        return self.alarmed
+
+    def rationale(self, layer: int, mask: np.ndarray = None) -> list[ObjectiveRationale]:
+        """
+        :param mask: the metrics to report, every metric if None.
+        :return: the state of the detector for each metric in alarm.
+        """
+        alarmed = self.alarmed if mask is None else self.alarmed & mask
+        return [
+            ObjectiveRationale(layer, METRIC_NAMES[i], float(self.values[i]), float(self.ewma[i]),
+                               float(self.thresholds[i]), float(self.cusum[i]), self.samples)
+            for i in np.flatnonzero(alarmed)
+        ]
 
 
 class Analyzer:
+    """
+    Turns the metrics snapshots of the detection system instances into objectives for the hypertuner.
 
-    def __init__(self, path: str):
+    Snapshots only update the state of their instance in the FleetState. At each tick, the confusion counts
+    collected across the fleet are pooled into the metrics of each layer, which feed the change-point detector
+    of the layer: an objective is raised only on a sustained degradation of the whole fleet, in a single
+    ObjectivesMsg for both layers, whatever the number of instances. Detectors start over when the fleet moves
+    to new models.
+    """
+
+    def __init__(self, path: str, stale_after: float = 60):
 
         import analyzer_main
         self.LOGGER = analyzer_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
@@ -16,26 +118,125 @@ class Analyzer:
 
         self._metrics_thresholds_1 = _json_file['_metrics_thresh_1']
         self._metrics_thresholds_2 = _json_file['_metrics_thresh_2']
+        self._detector_params = _json_file.get('_change_detection', {})
+
+        self._detectors = (
+            ChangePointDetector(self._metrics_thresholds_1, **self._detector_params),
+            ChangePointDetector(self._metrics_thresholds_2, **self._detector_params)
+        )
+        self._model_version = None
+
+        self.fleet = FleetState(stale_after=stale_after)
+
+    def record_snapshot(self, snapshot: MetricsSnapshotMsg):
+        if not snapshot.has_counts():
+            self.LOGGER.warning(f'Snapshot {snapshot.correlation_id} of instance {snapshot.instance_id} has no '
+                                f'confusion counts, it cannot be pooled.')
+            return
+
+        self.fleet.record(snapshot)
 
-    def analyze_incoming_metrics(self, metrics1: dict, metrics2: dict, classification_metrics: dict):
+    def evaluate_fleet(self) -> ObjectivesMsg:
+        """
+        Pools the counts of the fleet since the previous call and updates the detectors of both layers.
+        :return: the objectives of the fleet, empty if no metric is degraded or no instance has reported.
+        """
+        tick = self.fleet.tick()
+        if tick is None:
+            return ObjectivesMsg(model_version=self._model_version)
 
-        objectives = {
-            "MSG_TYPE": str(msg_type.OBJECTIVES_MSG),
-            "objs_layer1": [],
-            "objs_layer2": []
-        }
+        if tick.model_version != self._model_version:
+            self.LOGGER.debug(f'Fleet moved to models {tick.model_version} from {self._model_version}, '
+                              f'resetting change-point detection.')
+            for detector in self._detectors:
+                detector.reset()
+            self._model_version = tick.model_version
 
-        for metric, value in metrics1.items():
-            if metrics1[metric] < self._metrics_thresholds_1[metric]:
-                objectives['objs_layer1'].append(metric)
+        pooled_metrics = metrics_from_counts(tick.pooled_counts)
+        objectives = ObjectivesMsg(model_version=tick.model_version, correlation_id=uuid.uuid4().hex)
 
-        for metric, value in metrics2.items():
-            if metrics2[metric] < self._metrics_thresholds_2[metric]:
-                objectives['objs_layer2'].append(metric)
+        for layer, (detector, metrics) in enumerate(zip(self._detectors, pooled_metrics)):
+            # not enough traffic since the previous tick to tell anything about this layer
+            fresh = np.isfinite(metrics)
+            if fresh.all():
+                detector.update(metrics)
 
-        self.LOGGER.debug(f'Identified {len(objectives["objs_layer1"])} objective(s) for layer1: '
-                          f'[{objectives["objs_layer1"]}]')
-        self.LOGGER.debug(f'Identified {len(objectives["objs_layer2"])} objective(s) for layer2: '
-                          f'[{objectives["objs_layer2"]}]')
+            # instances past each threshold, only reported in the logs as pooling makes the decision
+            past_threshold = (detector.direction * (tick.instance_metrics[:, layer] - detector.thresholds) > 0)
+            objs = objectives.objs_layer1 if layer == 0 else objectives.objs_layer2
+
+            # the alarm of a metric without fresh samples in the fleet holds, but it is not raised from old data
+            for i in np.flatnonzero(detector.alarmed & fresh):
+                objs.append(METRIC_NAMES[i])
+                self.LOGGER.debug(f'{METRIC_NAMES[i]} of layer{layer + 1} past its threshold on '
+                                  f'{past_threshold[:, i].sum()}/{tick.instances} instance(s).')
+
+            objectives.rationale.extend(detector.rationale(layer + 1, fresh))
+
+        self.LOGGER.debug(f'Pooled {tick.instances} instance(s) on models {tick.model_version}, '
+                          f'{tick.stale} stale.')
+        self.LOGGER.debug(f'Identified {len(objectives.objs_layer1)} objective(s) for layer1: '
+                          f'[{objectives.objs_layer1}]')
+        self.LOGGER.debug(f'Identified {len(objectives.objs_layer2)} objective(s) for layer2: '
+                          f'[{objectives.objs_layer2}]')
+
+        for rationale in objectives.rationale:
+            self.LOGGER.debug(f'Sustained degradation: {rationale}')
 
         return objectives
+
+
+class InFlightTuning:
+    """
+    Objectives forwarded to the hypertuner for each model version, while the tuning they triggered is in flight.
+    Snapshots keep arriving during tuning and describe the same models, so the objectives they produce are
+    suppressed if already requested for that version. An in-flight tuning ends when snapshots of different
+    models arrive, or after the timeout, when objectives are forwarded again as usual.
+    """
+
+    def __init__(self, timeout: float):
+        import analyzer_main
+        self.LOGGER = analyzer_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+
+        self.timeout = timeout
+        # model_version -> (objectives of layer1, objectives of layer2, time they were forwarded)
+        self.__in_flight = {}
+        self.suppressed = 0
+
+    def should_forward(self, objectives: ObjectivesMsg) -> bool:
+        if objectives.is_empty():
+            self.LOGGER.debug('No objectives for the current metrics, nothing to tune.')
+            return False
+
+        self.__expire(objectives.model_version)
+
+        requested = self.__in_flight.get(objectives.model_version)
+        if requested is not None:
+            objs_1, objs_2, forwarded_at = requested
+
+            if set(objectives.objs_layer1) <= objs_1 and set(objectives.objs_layer2) <= objs_2:
+                self.suppressed += 1
+                self.LOGGER.debug(f'Tuning of models {objectives.model_version} already in flight since '
+                                  f'{time.monotonic() - forwarded_at:.1f}s, suppressed duplicate objectives '
+                                  f'of snapshot {objectives.correlation_id}.')
+                return False
+
+            objs_1, objs_2 = objs_1 | set(objectives.objs_layer1), objs_2 | set(objectives.objs_layer2)
+        else:
+            objs_1, objs_2 = set(objectives.objs_layer1), set(objectives.objs_layer2)
+
+        self.__in_flight[objectives.model_version] = (objs_1, objs_2, time.monotonic())
+        return True
+
+    def __expire(self, current_version: str):
+        now = time.monotonic()
+
+        for model_version, (_, _, forwarded_at) in list(self.__in_flight.items()):
+            if model_version != current_version:
+                self.LOGGER.debug(f'Models {model_version} have been replaced, tuning completed.')
+                del self.__in_flight[model_version]
+
+            elif now - forwarded_at > self.timeout:
+                self.LOGGER.warning(f'No new models {self.timeout}s after the objectives for models '
+                                    f'{model_version}, forwarding objectives again.')
+                del self.__in_flight[model_version]
@@ -1,37 +1,39 @@
 import argparse
 import sys
-import json
 import os
 import threading
 import time
 
-import boto3
 import logging
 
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
-from Shared import utils
+from Shared import transports, utils
 from Shared.sqs_wrapper import Connector
-from Shared.msg_enum import msg_type
-from Shared.message_handler import MetricsMsgHandler
-from analyzer import Analyzer
+from Shared.outbox import Outbox, default_journal_path
+from Shared.message_handler import MetricsMsgHandler, MessageDispatcher
+from Shared.messages import MetricsSnapshotMsg
+from analyzer import Analyzer, InFlightTuning
+from tuning_scheduler import TuningCostModel, TuningScheduler
 
 
 LOGGER = utils.get_logger(os.path.splitext(os.path.basename(__file__))[0])
 
 class MsgHandler(MetricsMsgHandler):
 
-    def __init__(self, polling_timer: float, analyzer: Analyzer):
+    def __init__(self, polling_timer: float, analyzer: Analyzer, scheduler: TuningScheduler,
+                 tuning_timeout: float = 3600, tick_interval: float = 5, outbox_journal: str = None):
 
         self._polling_timer = polling_timer
+        self._outbox_journal = outbox_journal or default_journal_path('analyzer')
+        self._tick_interval = tick_interval
         self.analyzer = analyzer
+        self.scheduler = scheduler
+        self.in_flight_tuning = InFlightTuning(timeout=tuning_timeout)
 
         self.__sqs_setup()
 
     def __sqs_setup(self):
-        self.sqs_client = boto3.client('sqs')
-        self.sqs_resource = boto3.resource('sqs')
-
         self.queue_urls = [
             'https://sqs.eu-west-3.amazonaws.com/818750160971/forward-metrics.fifo',
         ]
@@ -40,39 +42,37 @@ class MsgHandler(MetricsMsgHandler):
         ]
 
         self.connector = Connector(
-            sqs_client=self.sqs_client,
-            sqs_resource=self.sqs_resource,
+            transport=transports.create_transport(),
             queue_urls=self.queue_urls,
             queue_names=self.queue_names
         )
+        self.outbox = Outbox(self.connector, journal_path=self._outbox_journal)
+        self.dispatcher = MessageDispatcher.for_handler(self)
 
-    def handle_metrics_msg(self, msg_body: str):
+    def handle_metrics_msg(self, message: MetricsSnapshotMsg):
+        LOGGER.debug(f'Parsed message: {message}')
 
-        if msg_body:
-            LOGGER.debug(f'Parsing message: {msg_body}')
-            json_dict = json.loads(msg_body)
+        # objectives are decided for the whole fleet at each tick, not for each snapshot
+        self.analyzer.record_snapshot(message)
 
-            if json_dict['MSG_TYPE'] == str(msg_type.METRICS_SNAPSHOT_MSG):
-                metrics1, metrics2, classification_metrics = utils.parse_metrics_msg(json_dict)
-                objectives = self.analyzer.analyze_incoming_metrics(metrics1, metrics2, classification_metrics)
+    def evaluate_fleet(self):
+        while True:
+            time.sleep(self._tick_interval)
 
-                self.connector.send_message_to_queues(objectives)
-            else:
-                LOGGER.error(f'Received message of type {json_dict["MSG_TYPE"]}')
+            objectives = self.scheduler.plan(self.analyzer.evaluate_fleet())
 
-    def poll_queues(self):
-        while True:
-            LOGGER.debug('Fetching messages..')
+            if self.in_flight_tuning.should_forward(objectives):
+                self.outbox.send(objectives)
+                self.scheduler.on_requested(objectives)
 
-            try:
-                msg_body = self.connector.receive_messages()
-                if msg_body:
-                    self.handle_metrics_msg(msg_body)
-            except Exception as e:
-                LOGGER.error(f"Error in fetching messages from queue: {e}")
-                raise KeyboardInterrupt
+    def poll_queues(self):
+        LOGGER.debug('Listening for messages..')
 
-            time.sleep(self._polling_timer)
+        try:
+            self.connector.listen(self.dispatcher.dispatch, wait_time=self._polling_timer)
+        except Exception as e:
+            LOGGER.error(f"Error in fetching messages from queue: {e}")
+            raise KeyboardInterrupt
 
 
 class AnalyzerMain:
@@ -85,12 +85,15 @@ class AnalyzerMain:
 
     def terminate_instance(self):
         self.FULL_CLOSE = True
+        self.sqs_manager.outbox.close()
         self.sqs_manager.connector.close()
 
     def run_tasks(self):
         queue_reading_thread = threading.Thread(target=self.sqs_manager.poll_queues, daemon=True)
+        fleet_evaluation_thread = threading.Thread(target=self.sqs_manager.evaluate_fleet, daemon=True)
 
         queue_reading_thread.start()
+        fleet_evaluation_thread.start()
 
         try:
             while True:
@@ -106,13 +109,53 @@ class CommandLineParser:
 
     @staticmethod
     def process_command_line_args():
-        # Args: -polling_timer: time to wait each cycle to read messages, -verbose
+        # Args: -polling_timer: long polling wait time on the queue, -tuning_timeout, -tick_interval,
+        # -stale_after, -tuning_budget, -tuning_cooldown, -tuning_history, -outbox_journal, -verbose
         parser = argparse.ArgumentParser(description='Process command line arguments for a Python script.')
 
         parser.add_argument('-polling_timer',
                             type=float,
                             default=5,
-                            help='Specify the polling timer (float)'
+                            help='Specify the long polling wait time on each queue, at most 20 seconds (float)'
+                            )
+        parser.add_argument('-tuning_timeout',
+                            type=float,
+                            default=3600,
+                            help='Specify the seconds to wait for new models before forwarding the same '
+                                 'objectives again (float)'
+                            )
+        parser.add_argument('-tick_interval',
+                            type=float,
+                            default=5,
+                            help='Specify the seconds between two evaluations of the fleet metrics (float)'
+                            )
+        parser.add_argument('-stale_after',
+                            type=float,
+                            default=60,
+                            help='Specify the seconds without snapshots after which an instance is left out '
+                                 'of the fleet metrics (float)'
+                            )
+        parser.add_argument('-tuning_budget',
+                            type=float,
+                            default=7200,
+                            help='Specify the CPU-seconds of tuning that can be requested within an hour (float)'
+                            )
+        parser.add_argument('-tuning_cooldown',
+                            type=float,
+                            default=1800,
+                            help='Specify the seconds between two tuning requests for the same layer (float)'
+                            )
+        parser.add_argument('-tuning_history',
+                            nargs='+',
+                            default=['../TunerProcess/tuning_history.jsonl', '../TunerProcess/optimal_tuning_hps.txt'],
+                            help='Specify the tuning history files of the hypertuner to learn tuning costs from '
+                                 '(str)'
+                            )
+        parser.add_argument('-outbox_journal',
+                            type=str,
+                            default=None,
+                            help='Specify the journal of the outgoing messages, one for each running analyzer, '
+                                 'outbox_analyzer.jsonl by default (str)'
                             )
         parser.add_argument('-verbose',
                             action='store_true',
@@ -129,14 +172,32 @@ class CommandLineParser:
         if polling_timer is not None:
             LOGGER.debug(f'Polling Timer: {polling_timer}')
 
-        return polling_timer
+        tuning_timeout = args.tuning_timeout
+        LOGGER.debug(f'Tuning Timeout: {tuning_timeout}')
 
+        tick_interval = args.tick_interval
+        LOGGER.debug(f'Tick Interval: {tick_interval}')
 
-def main():
-    timer = CommandLineParser.process_command_line_args()
+        stale_after = args.stale_after
+        LOGGER.debug(f'Stale After: {stale_after}')
+
+        LOGGER.debug(f'Tuning Budget: {args.tuning_budget}, Tuning Cooldown: {args.tuning_cooldown}, '
+                     f'Tuning History: {args.tuning_history}')
 
-    analyzer = Analyzer("thresholds.json")
-    sqs_manager = MsgHandler(polling_timer=timer, analyzer=analyzer)
+        return (polling_timer, tuning_timeout, tick_interval, stale_after, args.tuning_budget, args.tuning_cooldown,
+                args.tuning_history, args.outbox_journal)
+
+
+def main():
+    (timer, tuning_timeout, tick_interval, stale_after, tuning_budget, tuning_cooldown,
+     tuning_history, outbox_journal) = CommandLineParser.process_command_line_args()
+
+    analyzer = Analyzer("thresholds.json", stale_after=stale_after)
+    scheduler = TuningScheduler(TuningCostModel(tuning_history), budget_per_hour=tuning_budget,
+                                cooldown=tuning_cooldown)
+    sqs_manager = MsgHandler(polling_timer=timer, analyzer=analyzer, scheduler=scheduler,
+                             tuning_timeout=tuning_timeout, tick_interval=tick_interval,
+                             outbox_journal=outbox_journal)
 
     analyzer_main = AnalyzerMain(analyzer=analyzer, sqs_manager=sqs_manager)
 
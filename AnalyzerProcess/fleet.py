@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+from typing import NamedTuple
+
+import numpy as np
+
+from Shared.confusion import metrics_from_counts
+from Shared.messages import CONFUSION_NAMES, MetricsSnapshotMsg
+
+LAYERS = 2
+
+
+class FleetTick(NamedTuple):
+    model_version: str
+    # confusion counts of each layer collected by the pooled instances since the previous tick, shape (2, 4)
+    pooled_counts: np.ndarray
+    # cumulative metrics of each pooled instance, shape (instances, 2, 7)
+    instance_metrics: np.ndarray
+    instances: int
+    stale: int
+
+
+class FleetState:
+    """
+    Latest confusion counts reported by every detection system instance, kept in NumPy arrays indexed by
+    instance id, so that the whole fleet is evaluated with a few vectorised operations at each tick.
+
+    Recording a snapshot only overwrites the row of its instance. A tick pools the counts collected since the
+    previous tick by the instances running the most common model version, leaving out the ones that have not
+    reported for stale_after seconds and the ones still running other models.
+    """
+
+    INITIAL_CAPACITY = 64
+
+    def __init__(self, stale_after: float):
+        """
+        :param stale_after: seconds without snapshots after which an instance is left out of the ticks.
+        """
+        import analyzer_main
+        self.LOGGER = analyzer_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+
+        self.stale_after = stale_after
+
+        self.__lock = threading.Lock()
+        # instance_id -> row
+        self.__rows = {}
+        # model version -> code, and back
+        self.__version_codes = {}
+        self.__versions = []
+
+        self.__counts = np.zeros((self.INITIAL_CAPACITY, LAYERS, len(CONFUSION_NAMES)), dtype=np.int64)
+        # counts of each instance already pooled by the previous ticks
+        self.__pooled = np.zeros_like(self.__counts)
+        self.__version = np.full(self.INITIAL_CAPACITY, -1, dtype=np.int32)
+        self.__last_seen = np.full(self.INITIAL_CAPACITY, -np.inf)
+
+    def __len__(self):
+        return len(self.__rows)
+
+    def record(self, snapshot: MetricsSnapshotMsg, now: float = None):
+        now = time.monotonic() if now is None else now
+        instance_id = snapshot.instance_id or 'default'
+
+        with self.__lock:
+            row = self.__rows.get(instance_id)
+            if row is None:
+                row = self.__add_instance(instance_id)
+
+            self.__counts[row, 0] = snapshot.counts_1.as_tuple()
+            self.__counts[row, 1] = snapshot.counts_2.as_tuple()
+            self.__version[row] = self.__version_code(snapshot.model_version)
+            self.__last_seen[row] = now
+
+    def tick(self, now: float = None):
+        """
+        :return: the FleetTick of the current model version, None if no instance has reported recently.
+        """
+        now = time.monotonic() if now is None else now
+
+        with self.__lock:
+            n = len(self.__rows)
+            counts, pooled, version = self.__counts[:n], self.__pooled[:n], self.__version[:n]
+
+            active = self.__last_seen[:n] >= now - self.stale_after
+            if not active.any():
+                return None
+
+            current = np.bincount(version[active]).argmax()
+            pool = active & (version == current)
+
+            delta = counts[pool] - pooled[pool]
+            # an instance whose counts went down has restarted, everything it reported is new
+            restarted = (delta < 0).any(axis=(1, 2))
+            delta[restarted] = counts[pool][restarted]
+            pooled[pool] = counts[pool]
+
+            return FleetTick(
+                model_version=self.__versions[current],
+                pooled_counts=delta.sum(axis=0),
+                instance_metrics=metrics_from_counts(counts[pool]),
+                instances=int(pool.sum()),
+                stale=int(n - active.sum())
+            )
+
+    def __add_instance(self, instance_id: str) -> int:
+        row = len(self.__rows)
+
+        if row == len(self.__last_seen):
+            capacity = 2 * row
+            self.__counts = self.__grow(self.__counts, capacity, 0)
+            self.__pooled = self.__grow(self.__pooled, capacity, 0)
+            self.__version = self.__grow(self.__version, capacity, -1)
+            self.__last_seen = self.__grow(self.__last_seen, capacity, -np.inf)
+
+        self.__rows[instance_id] = row
+        self.LOGGER.debug(f'New detection system instance {instance_id}, {row + 1} in the fleet.')
+        return row
+
+    @staticmethod
+    def __grow(array: np.ndarray, capacity: int, fill) -> np.ndarray:
+        grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+        grown[:len(array)] = array
+        return grown
+
+    def __version_code(self, model_version: str) -> int:
+        code = self.__version_codes.get(model_version)
+        if code is None:
+            code = self.__version_codes[model_version] = len(self.__versions)
+            self.__versions.append(model_version)
+        return code
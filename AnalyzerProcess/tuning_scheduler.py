@@ -0,0 +1,230 @@
+import json
+import os
+import re
+import statistics
+import time
+from collections import deque
+
+from Shared.messages import ObjectivesMsg, TUNABLE_METRIC_NAMES
+
+# cost of tuning one objective, in CPU-seconds, before any tuning run has been recorded for its layer
+DEFAULT_COSTS = {1: 300.0, 2: 1800.0}
+
+_LEGACY_RUN = re.compile(r'Layer (\d+):.*?Training time: ([0-9.]+)', re.DOTALL)
+
+
+class TuningCostModel:
+    """
+    Expected CPU-seconds of tuning each objective of each layer, learned from the tuning history of the hypertuner.
+
+    Records of tuning_history.jsonl give the CPU time of a run and its objectives, the cost of a run is split
+    evenly among them and averaged per (layer, objective) with an EWMA. Objectives never tuned fall back to the
+    median cost per objective of their layer, then to DEFAULT_COSTS. Runs of the older optimal_tuning_hps.txt
+    have no objectives nor CPU time: their wall time only counts for the median of the layer.
+    The files are read again whenever they change.
+    """
+
+    def __init__(self, paths: list[str], alpha: float = 0.3):
+        """
+        :param paths: tuning_history.jsonl and optimal_tuning_hps.txt files to learn from, missing ones are skipped.
+        :param alpha: weight of the last run of an objective in its cost.
+        """
+        import analyzer_main
+        self.LOGGER = analyzer_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+
+        self.paths = paths
+        self.alpha = alpha
+
+        self.__mtimes = None
+        # (layer, objective) -> EWMA of CPU-seconds
+        self.__costs = {}
+        # layer -> CPU-seconds per objective of every run
+        self.__layer_costs = {}
+
+    def cost(self, layer: int, objective: str) -> float:
+        self.__refresh()
+
+        if (layer, objective) in self.__costs:
+            return self.__costs[(layer, objective)]
+        if self.__layer_costs.get(layer):
+            return statistics.median(self.__layer_costs[layer])
+        return DEFAULT_COSTS[layer]
+
+    def __refresh(self):
+        mtimes = [os.path.getmtime(path) if os.path.exists(path) else None for path in self.paths]
+        if mtimes == self.__mtimes:
+            return
+        self.__mtimes = mtimes
+
+        self.__costs, self.__layer_costs = {}, {}
+        runs = 0
+
+        for path in self.paths:
+            if not os.path.exists(path):
+                continue
+
+            with open(path, 'r') as f:
+                content = f.read()
+
+            if path.endswith('.jsonl'):
+                for line in content.splitlines():
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.__learn(record['layer'], record['objectives'], record['cpu_seconds'])
+                    runs += 1
+            else:
+                for layer, seconds in _LEGACY_RUN.findall(content):
+                    self.__learn(int(layer), [], float(seconds))
+                    runs += 1
+
+        self.LOGGER.debug(f'Learned tuning costs from {runs} run(s): {self.__costs}')
+
+    def __learn(self, layer: int, objectives: list[str], seconds: float):
+        per_objective = seconds / max(len(objectives), 1)
+        self.__layer_costs.setdefault(layer, []).append(per_objective)
+
+        for objective in objectives:
+            previous = self.__costs.get((layer, objective))
+            self.__costs[(layer, objective)] = per_objective if previous is None \
+                else (1 - self.alpha) * previous + self.alpha * per_objective
+
+
+class TuningScheduler:
+    """
+    Decides which objectives are worth a tuning run, among the ones the hypertuner can optimize. Each objective
+    is scored by its expected gain, how far the EWMA of its metric is past the target, per expected CPU-second
+    of tuning. Objectives are requested by decreasing score while they fit in the CPU budget of the last hour,
+    and not for a layer tuned less than cooldown seconds ago. Objectives left out are deferred, the detectors
+    raise them again at the next ticks.
+    Every change of decision, and every request actually sent, is appended to an audit log of JSON lines.
+    """
+
+    WINDOW = 3600
+
+    def __init__(self, cost_model: TuningCostModel, budget_per_hour: float, cooldown: float,
+                 audit_path: str = 'tuning_decisions.jsonl'):
+        """
+        :param cost_model: expected cost of tuning each objective.
+        :param budget_per_hour: CPU-seconds of tuning that can be requested within an hour.
+        :param cooldown: seconds between two tuning requests for the same layer.
+        :param audit_path: path of the audit log.
+        """
+        import analyzer_main
+        self.LOGGER = analyzer_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+
+        self.cost_model = cost_model
+        self.budget_per_hour = budget_per_hour
+        self.cooldown = cooldown
+        self.audit_path = audit_path
+
+        # (time, expected CPU-seconds) of the requests within the window
+        self.__spent = deque()
+        # layer -> time of the last request
+        self.__last_request = {}
+        self.__last_decision = None
+
+    def budget_left(self, now: float = None) -> float:
+        now = time.time() if now is None else now
+
+        while self.__spent and now - self.__spent[0][0] > self.WINDOW:
+            self.__spent.popleft()
+
+        return self.budget_per_hour - sum(cost for _, cost in self.__spent)
+
+    def plan(self, objectives: ObjectivesMsg, now: float = None) -> ObjectivesMsg:
+        """
+        :return: the objectives to request now, with their rationale, empty if none is worth it.
+        """
+        now = time.time() if now is None else now
+        planned = ObjectivesMsg(model_version=objectives.model_version, correlation_id=objectives.correlation_id)
+
+        candidates = []
+        for rationale in objectives.rationale:
+            if rationale.metric not in TUNABLE_METRIC_NAMES:
+                # a tuning run for it would spend the budget and the cooldown without producing a model
+                self.LOGGER.debug(f'Objective {rationale.metric} of layer{rationale.layer} cannot be tuned, ignored.')
+                continue
+
+            cost = self.cost_model.cost(rationale.layer, rationale.metric)
+            gain = abs(rationale.ewma - rationale.threshold)
+            candidates.append({'layer': rationale.layer, 'metric': rationale.metric, 'gain': gain,
+                               'cost': cost, 'score': gain / cost, 'rationale': rationale})
+
+        budget_left = self.budget_left(now)
+        requested, deferred = [], []
+
+        for candidate in sorted(candidates, key=lambda c: c['score'], reverse=True):
+            cooling_down = now - self.__last_request.get(candidate['layer'], -float('inf')) < self.cooldown
+
+            if cooling_down:
+                deferred.append(dict(candidate, reason='cooldown'))
+            elif candidate['cost'] > budget_left and not (budget_left == self.budget_per_hour and not requested):
+                # an objective costing more than the whole budget still runs, alone, in an idle hour
+                deferred.append(dict(candidate, reason='budget'))
+            else:
+                budget_left -= candidate['cost']
+                requested.append(candidate)
+
+        for candidate in requested:
+            objs = planned.objs_layer1 if candidate['layer'] == 1 else planned.objs_layer2
+            objs.append(candidate['metric'])
+            planned.rationale.append(candidate['rationale'])
+
+        # the detectors raise the same objectives at each tick, only changes of decision are audited
+        decision = ([(c['layer'], c['metric']) for c in requested],
+                    [(c['layer'], c['metric'], c['reason']) for c in deferred])
+        if decision != self.__last_decision:
+            self.__last_decision = decision
+            self.LOGGER.info(f'Tuning decision: requested {decision[0]}, deferred {decision[1]}, '
+                             f'{budget_left:.0f}/{self.budget_per_hour:.0f} CPU-seconds left this hour.')
+            self.__audit({
+                'event': 'decision',
+                'time': now,
+                'model_version': objectives.model_version,
+                'correlation_id': objectives.correlation_id,
+                'requested': [self.__audit_entry(c) for c in requested],
+                'deferred': [self.__audit_entry(c) for c in deferred],
+                'budget_left': budget_left,
+                'budget_per_hour': self.budget_per_hour
+            })
+
+        return planned
+
+    def on_requested(self, planned: ObjectivesMsg, now: float = None):
+        """
+        Charges the budget and starts the cooldown of the layers of objectives actually sent to the hypertuner.
+        """
+        now = time.time() if now is None else now
+
+        charged = {}
+        for layer, objs in ((1, planned.objs_layer1), (2, planned.objs_layer2)):
+            if objs:
+                charged[layer] = sum(self.cost_model.cost(layer, metric) for metric in objs)
+                self.__last_request[layer] = now
+                self.__spent.append((now, charged[layer]))
+
+        budget_left = self.budget_left(now)
+        self.LOGGER.info(f'Requested tuning of {planned.objs_layer1} for layer1 and {planned.objs_layer2} for '
+                         f'layer2, expected {sum(charged.values()):.0f} CPU-seconds, {budget_left:.0f} left '
+                         f'this hour.')
+        self.__audit({
+            'event': 'requested',
+            'time': now,
+            'model_version': planned.model_version,
+            'correlation_id': planned.correlation_id,
+            'objs_layer1': planned.objs_layer1,
+            'objs_layer2': planned.objs_layer2,
+            'cost': charged,
+            'budget_left': budget_left
+        })
+
+    @staticmethod
+    def __audit_entry(candidate: dict) -> dict:
+        return {key: candidate[key] for key in ('layer', 'metric', 'gain', 'cost', 'score', 'reason')
+                if key in candidate}
+
+    def __audit(self, record: dict):
+        with open(self.audit_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
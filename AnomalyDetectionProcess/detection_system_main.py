@@ -1,24 +1,23 @@
 import argparse
-import json
 import logging
 import sys
 import os
+import socket
 import time
 import threading
-import boto3
-import joblib
-
-from botocore.exceptions import ClientError
 
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
-from Shared.message_handler import FullMsgHandler
+from Shared.message_handler import FullMsgHandler, MessageDispatcher
 from artificial_traffic import Runner
 from storage import Storage
 from Shared.sqs_wrapper import Connector
+from Shared.outbox import Outbox, default_journal_path
 from metrics import Metrics
+from snapshot_tracker import SnapshotTracker
 from Shared.msg_enum import msg_type
-from Shared import utils
+from Shared import model_store, transports, utils
+from Shared.messages import ModelUpdateMsg, MultipleUpdateMsg, ObjectivesMsg
 from classification_pipeline import ClassificationProcess
 
 
@@ -31,9 +30,11 @@ class DetectionSystemMain(FullMsgHandler):
     stop_forward_metrics = threading.Event()
 
     def __init__(self, metrics_snapshot_timer: float, polling_timer: float, classification_delay: float,
-                 storage: Storage, classification_pipeline: ClassificationProcess):
+                 storage: Storage, classification_pipeline: ClassificationProcess, snapshot_timeout: float = 3600,
+                 instance_id: str = None, outbox_journal: str = None):
 
-        self.snapshot_event = threading.Event()
+        self.outbox_journal = outbox_journal or default_journal_path('detection_system', instance_id)
+        self.snapshot_tracker = SnapshotTracker(response_timeout=snapshot_timeout, instance_id=instance_id)
         self.metrics_snapshot_timer = metrics_snapshot_timer
         self.polling_timer = polling_timer
         self.classification_delay = classification_delay
@@ -48,9 +49,6 @@ class DetectionSystemMain(FullMsgHandler):
         self.runner = Runner()
 
     def __sqs_setup(self):
-        self.sqs_client = boto3.client('sqs')
-        self.sqs_resource = boto3.resource('sqs')
-
         self.queue_urls = [
             'https://sqs.eu-west-3.amazonaws.com/818750160971/detection-system-update.fifo',
             'https://sqs.eu-west-3.amazonaws.com/818750160971/tuned-models-ds.fifo'
@@ -60,51 +58,45 @@ class DetectionSystemMain(FullMsgHandler):
         ]
 
         self.connector = Connector(
-            sqs_client=self.sqs_client,
-            sqs_resource=self.sqs_resource,
+            transport=transports.create_transport(),
             queue_urls=self.queue_urls,
             queue_names=self.queue_names
         )
+        self.outbox = Outbox(self.connector, journal_path=self.outbox_journal)
+
+        # objectives are meant for the hypertuner, they are rejected here
+        self.dispatcher = MessageDispatcher({
+            msg_type.MODEL_UPDATE_MSG: self.handle_models_update_msg,
+            msg_type.MULTIPLE_UPDATE_MSG: self.handle_multiple_updates_msg
+        })
 
     def terminate(self):
         self.FULL_CLOSE = True
+        self.outbox.close()
         self.connector.close()
 
     def force_default_models(self):
         LOGGER.warning('FORCING DEFAULT MODELS!')
 
-        self.storage.layer1 = joblib.load("StartingModels/random_forest_model_default.pkl")
-        self.storage.layer2 = joblib.load("StartingModels/support_vector_machine_model_default.pkl")
+        self.storage.layer1 = model_store.load_model("StartingModels/random_forest_model_default.pkl")
+        self.storage.layer2 = model_store.load_model("StartingModels/support_vector_machine_model_default.pkl")
+        self.snapshot_tracker.on_models_updated(
+            model_store.models_version("StartingModels/random_forest_model_default.pkl",
+                                       "StartingModels/support_vector_machine_model_default.pkl"),
+            sender='Default'
+        )
 
     def poll_queues(self):
-        while True:
-            LOGGER.info('Fetching messages..')
-
-            try:
-                msg_body = self.connector.receive_messages()
-            except Exception as e:
-                LOGGER.error(f"Error in fetching messages from queue: {e}")
-                raise KeyboardInterrupt
-
-            if msg_body:
-
-                json_dict = json.loads(msg_body)
+        LOGGER.info('Listening for messages..')
 
-                # Case 1: Update models sent from Hypertuner or KnowledgeBase
-                if json_dict['MSG_TYPE'] == str(msg_type.MODEL_UPDATE_MSG):
-                    self.handle_models_update_msg(json_dict)
-
-                # Case 2: Multiple objects update from KnowledgeBase
-                elif json_dict['MSG_TYPE'] == str(msg_type.MULTIPLE_UPDATE_MSG):
-                    self.handle_multiple_updates_msg(json_dict)
-
-                else:
-                    LOGGER.debug(f'Received unexpected message of type {json_dict["MSG_TYPE"]}')
-
-            time.sleep(self.polling_timer)
+        try:
+            self.connector.listen(self.dispatcher.dispatch, wait_time=self.polling_timer)
+        except Exception as e:
+            LOGGER.error(f"Error in fetching messages from queue: {e}")
+            raise KeyboardInterrupt
 
-    def handle_multiple_updates_msg(self, json_dict: dict):
-        to_update = json_dict['UPDATE']
+    def handle_multiple_updates_msg(self, message: MultipleUpdateMsg):
+        to_update = message.update
 
         LOGGER.debug(f'Received multiple update notification: {to_update}')
 
@@ -117,10 +109,10 @@ class DetectionSystemMain(FullMsgHandler):
         for update in to_update:
             update_calls[update]()
 
-    def handle_objs_msg(self, json_dict: dict):
+    def handle_objs_msg(self, message: ObjectivesMsg):
         pass
 
-    def handle_models_update_msg(self, json_dict: dict):
+    def handle_models_update_msg(self, message: ModelUpdateMsg):
         LOGGER.debug('Parsed an UPDATE MODELS message, updating from S3.')
 
         self.storage.loader.s3_models()
@@ -129,10 +121,11 @@ class DetectionSystemMain(FullMsgHandler):
             self.storage.loader.load_models('NSL_l1_classifier.pkl', 'NSL_l2_classifier.pkl')
         )
 
-        # Activate snapshots only after the models have been updated
-        if json_dict['SENDER'] == 'Hypertuner':
-            LOGGER.debug('Update message from the tuner, starting snapshots back.')
-            self.snapshot_event.set()
+        # Snapshots from now on describe the new models
+        self.snapshot_tracker.on_models_updated(
+            self.storage.loader.models_version('NSL_l1_classifier.pkl', 'NSL_l2_classifier.pkl'),
+            sender=message.sender
+        )
 
         LOGGER.debug('Replaced current models with models from S3.')
 
@@ -156,26 +149,26 @@ class DetectionSystemMain(FullMsgHandler):
         while True:
             if self.classification_pipeline.metrics.BEGIN_SNAPSHOTS:
 
-                # Reset the wait event before forwarding metrics
-                self.snapshot_event.clear()
+                # Snapshots keep their cadence while the models are being tuned, the analyzer
+                # recognizes the ones of models already under tuning from their version
+                model_version, correlation_id = self.snapshot_tracker.next_snapshot()
 
                 with self.classification_pipeline.metrics.get_lock():
                     LOGGER.info('Snapshotting metrics..')
-                    metrics_json = self.classification_pipeline.metrics.snapshot_metrics()
+                    snapshot = self.classification_pipeline.metrics.snapshot_metrics(
+                        model_version, correlation_id, self.snapshot_tracker.instance_id
+                    )
 
-                    msg_body = metrics_json if metrics_json is not None else "ERROR"
+                    msg_body = snapshot if snapshot is not None else "ERROR"
 
                 if not self.STATIC_EVAL:
-                    try:
-                        self.connector.send_message_to_queues(msg_body)
-                    except ClientError as e:
-                        LOGGER.error(f"Error in snapshot metrics: {e}")
-                        raise KeyboardInterrupt
+                    # journaled and sent in the background, a failing queue only delays the snapshot
+                    self.outbox.send(msg_body)
+                    self.snapshot_tracker.on_snapshot_sent(correlation_id)
 
-                    # After sending the snapshot, suspend the snapshot process until an answer is received
-                    self.snapshot_event.wait()
+                    LOGGER.debug(f'Outbox: {self.outbox.get_stats()}')
 
-                time.sleep(self.metrics_snapshot_timer)
+            time.sleep(self.metrics_snapshot_timer)
 
     def run_tasks(self):
         queue_reading_thread = threading.Thread(target=self.poll_queues, daemon=True)
@@ -211,7 +204,26 @@ class CommandLineParser:
         parser.add_argument('-polling_timer',
                             type=float,
                             default=5,
-                            help='Specify the polling timer (float)'
+                            help='Specify the long polling wait time on each queue, at most 20 seconds (float)'
+                            )
+        parser.add_argument('-snapshot_timeout',
+                            type=float,
+                            default=3600,
+                            help='Specify the seconds after which a snapshot with no model update is not '
+                                 'in flight anymore (float)'
+                            )
+        parser.add_argument('-instance_id',
+                            type=str,
+                            default=os.environ.get('IDS_INSTANCE_ID', f'{socket.gethostname()}-{os.getpid()}'),
+                            help='Specify the id of this instance in the snapshots, unique across the replicas '
+                                 '(str)'
+                            )
+        parser.add_argument('-outbox_journal',
+                            type=str,
+                            default=None,
+                            help='Specify the journal of the outgoing messages, outbox_detection_system-'
+                                 '<instance id>.jsonl by default: set a stable instance id for the messages left '
+                                 'by a stopped instance to be sent at its next start (str)'
                             )
         parser.add_argument('-classification_delay',
                             type=float,
@@ -233,6 +245,8 @@ class CommandLineParser:
         metrics_snapshot_timer = args.metrics_snapshot_timer
         polling_timer = args.polling_timer
         classification_delay = args.classification_delay
+        snapshot_timeout = args.snapshot_timeout
+        instance_id = args.instance_id
 
         # You can check if the arguments are provided and then use them in your script
         if metrics_snapshot_timer is not None:
@@ -244,11 +258,15 @@ class CommandLineParser:
         if classification_delay is not None:
             LOGGER.debug(f'Classification Delay: {classification_delay}')
 
-        return metrics_snapshot_timer, polling_timer, classification_delay
+        LOGGER.debug(f'Instance Id: {instance_id}')
+
+        return metrics_snapshot_timer, polling_timer, classification_delay, snapshot_timeout, instance_id, \
+            args.outbox_journal
 
 
 def main():
-    snapshot_timer, poll_timer, clf_delay = CommandLineParser.process_command_line_args()
+    snapshot_timer, poll_timer, clf_delay, snapshot_timeout, instance_id, outbox_journal = \
+        CommandLineParser.process_command_line_args()
 
     metrics = Metrics()
     storage = Storage()
@@ -262,6 +280,9 @@ def main():
         metrics_snapshot_timer=snapshot_timer,
         polling_timer=poll_timer,
         classification_delay=clf_delay,
+        snapshot_timeout=snapshot_timeout,
+        instance_id=instance_id,
+        outbox_journal=outbox_journal,
         classification_pipeline=classification_pipeline,
         storage=storage
     )
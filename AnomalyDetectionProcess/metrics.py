@@ -3,7 +3,8 @@ import os
 import threading
 
 from Shared import utils
-from Shared.msg_enum import msg_type
+from Shared.confusion import metrics_dict
+from Shared.messages import CONFUSION_NAMES, MetricsSnapshotMsg, LayerMetrics, ClassificationMetrics, ConfusionCounts
 
 
 class Metrics:
@@ -95,32 +96,10 @@ class Metrics:
             tprs = self._tprs_2
             fprs = self._fprs_2
 
-        # Calculate true positive rate (recall)
-        tpr = counts['tp'] / (counts['tp'] + counts['fn'])
-        metrics['tpr'] = tpr
-        tprs.append(tpr)
-
-        # Calculate false positive rate
-        fpr = counts['fp'] / (counts['fp'] + counts['tn'])
-        metrics['fpr'] = fpr
-        fprs.append(fpr)
-
-        # Calculate true negative rate
-        metrics['tnr'] = counts['tn'] / (counts['tn'] + counts['fn'])
-
-        # Calculate false negative rate
-        metrics['fnr'] = counts['fn'] / (counts['tn'] + counts['fn'])
-
-        # Calculate accuracy
-        metrics['accuracy'] = (counts['tp'] + counts['tn']) / (
-                counts['tp'] + counts['tn'] + counts['fp'] + counts['fn'])
-
-        # Calculate precision
-        metrics['precision'] = counts['tp'] / (counts['tp'] + counts['fp'])
-
-        # Calculate F1 score
-        metrics['fscore'] = 2 * (metrics['precision'] * metrics['tpr']) / (
-                metrics['precision'] + metrics['tpr'])
+        # every metric from the same counts, with the kernel the tuner scores its trials with
+        metrics.update(metrics_dict([counts[name] for name in CONFUSION_NAMES]))
+        tprs.append(metrics['tpr'])
+        fprs.append(metrics['fpr'])
 
         # set the event, enough data has been collected
         self.enough_data_event.set()
@@ -182,40 +161,31 @@ class Metrics:
     def get_metrics(self):
         return self._metrics_1, self._metrics_2, self._classification_metrics
 
-    def snapshot_metrics(self):
-        self.LOGGER.debug('Building a json snapshot of current metrics')
-
-        metrics_dict = {
-            "MSG_TYPE": str(msg_type.METRICS_SNAPSHOT_MSG),
-            "metrics_1": {
-                "accuracy": self._metrics_1['accuracy'],
-                "precision": self._metrics_1['precision'],
-                "tpr": self._metrics_1['tpr'],
-                "fpr": self._metrics_1['fpr'],
-                "tnr": self._metrics_1['tnr'],
-                "fnr": self._metrics_1['fnr'],
-                "fscore": self._metrics_1['fscore']
-            },
-            "metrics_2": {
-                "accuracy": self._metrics_2['accuracy'],
-                "precision": self._metrics_2['precision'],
-                "tpr": self._metrics_2['tpr'],
-                "fpr": self._metrics_2['fpr'],
-                "tnr": self._metrics_2['tnr'],
-                "fnr": self._metrics_2['fnr'],
-                "fscore": self._metrics_2['fscore']
-            },
-            "classification_metrics": {
-                "normal_ratio": self._classification_metrics['normal_ratio'],
-                "l1_anomaly_ratio": self._classification_metrics['l1_anomaly_ratio'],
-                "l2_anomaly_ratio": self._classification_metrics['l2_anomaly_ratio'],
-                "quarantined_ratio": self._classification_metrics['quarantine_ratio']
-            }
-        }
-
-        self.write_performance_log(metrics_dict)
-
-        return metrics_dict
+    def snapshot_metrics(self, model_version: str = None, correlation_id: str = None,
+                         instance_id: str = None) -> MetricsSnapshotMsg:
+        self.LOGGER.debug('Building a snapshot of current metrics')
+
+        snapshot = MetricsSnapshotMsg(
+            metrics_1=LayerMetrics.from_dict(self._metrics_1, 'metrics_1'),
+            metrics_2=LayerMetrics.from_dict(self._metrics_2, 'metrics_2'),
+            classification_metrics=ClassificationMetrics(
+                normal_ratio=self._classification_metrics['normal_ratio'],
+                l1_anomaly_ratio=self._classification_metrics['l1_anomaly_ratio'],
+                l2_anomaly_ratio=self._classification_metrics['l2_anomaly_ratio'],
+                quarantined_ratio=self._classification_metrics['quarantine_ratio']
+            ),
+            model_version=model_version,
+            correlation_id=correlation_id,
+            instance_id=instance_id,
+            counts_1=ConfusionCounts(self._count_1['tp'], self._count_1['fp'], self._count_1['tn'],
+                                     self._count_1['fn']),
+            counts_2=ConfusionCounts(self._count_2['tp'], self._count_2['fp'], self._count_2['tn'],
+                                     self._count_2['fn'])
+        )
+
+        self.write_performance_log(snapshot.to_dict())
+
+        return snapshot
 
     def write_performance_log(self, metrics_dict):
         # Save metrics just before forwarding them
@@ -0,0 +1,76 @@
+import os
+import threading
+import time
+import uuid
+
+
+class SnapshotTracker:
+    """
+    Keeps track of the metrics snapshots sent for the models currently in use. Snapshots are never held back:
+    each one is tagged with the version of the models that produced it and a correlation id, so that the
+    analyzer can tell which snapshots describe models that are already being tuned.
+    """
+
+    def __init__(self, response_timeout: float, instance_id: str = None):
+        """
+        :param response_timeout: seconds after which a snapshot with no model update is not in flight anymore.
+        :param instance_id: id of this detection system among the replicas, sent with each snapshot.
+        """
+        import detection_system_main
+        self.LOGGER = detection_system_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+
+        self.response_timeout = response_timeout
+        self.instance_id = instance_id
+
+        self.__lock = threading.Lock()
+        self.__model_version = None
+        # correlation_id -> time the snapshot was sent, for the current model version
+        self.__in_flight = {}
+
+    @property
+    def model_version(self):
+        return self.__model_version
+
+    def next_snapshot(self) -> tuple:
+        """
+        :return: the (model_version, correlation_id) pair to tag the next snapshot with.
+        """
+        with self.__lock:
+            return self.__model_version, uuid.uuid4().hex
+
+    def on_snapshot_sent(self, correlation_id: str):
+        with self.__lock:
+            self.__expire()
+            self.__in_flight[correlation_id] = time.monotonic()
+
+    def on_models_updated(self, model_version: str, sender: str = None):
+        """
+        Switches to new models: the snapshots sent for the previous ones are not in flight anymore.
+        """
+        with self.__lock:
+            if self.__in_flight:
+                waited = time.monotonic() - min(self.__in_flight.values())
+                self.LOGGER.debug(f'Models {self.__model_version} replaced by {model_version} from {sender} '
+                                  f'{waited:.1f}s after the first of {len(self.__in_flight)} snapshot(s) sent.')
+
+            self.__model_version = model_version
+            self.__in_flight.clear()
+
+    def in_flight(self) -> int:
+        """
+        :return: the number of snapshots sent for the current models within the response timeout.
+        """
+        with self.__lock:
+            self.__expire()
+            return len(self.__in_flight)
+
+    def __expire(self):
+        now = time.monotonic()
+        expired = [cid for cid, sent_at in self.__in_flight.items() if now - sent_at > self.response_timeout]
+
+        for correlation_id in expired:
+            del self.__in_flight[correlation_id]
+
+        if expired:
+            self.LOGGER.debug(f'{len(expired)} snapshot(s) for models {self.__model_version} received no model '
+                              f'update within {self.response_timeout}s.')
@@ -0,0 +1,120 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'AnalyzerProcess'))
+
+import analyzer_main
+from analyzer import Analyzer, HIGHER_IS_WORSE
+from Shared import messages
+from Shared.messages import (MetricsSnapshotMsg, LayerMetrics, ClassificationMetrics, ConfusionCounts, METRIC_NAMES,
+                             CLASSIFICATION_METRIC_NAMES)
+
+THRESHOLDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'AnalyzerProcess', 'thresholds.json')
+
+
+def simulate_counts(rng, instances: int, ticks: int, degraded_from: int) -> np.ndarray:
+    """
+    :return: cumulative confusion counts of shape (ticks, instances, 2, 4). From degraded_from on, a quarter of
+             the instances let through more false positives on layer1.
+    """
+    # tp, fp, tn, fn per tick, for a detector with tpr 0.9 and fpr 0.05 on 100 samples
+    rates = np.array([45, 2.5, 47.5, 5])
+    per_tick = rng.poisson(rates, size=(ticks, instances, 2, 4))
+
+    degraded = rng.random(instances) < 0.25
+    per_tick[degraded_from:, degraded, 0, 1] += rng.poisson(20, size=(ticks - degraded_from, degraded.sum()))
+
+    return per_tick.cumsum(axis=0)
+
+
+def build_snapshots(counts: np.ndarray) -> list:
+    metrics = LayerMetrics(*np.zeros(len(METRIC_NAMES)))
+    classification = ClassificationMetrics(*np.zeros(len(CLASSIFICATION_METRIC_NAMES)))
+
+    return [
+        MetricsSnapshotMsg(metrics, metrics, classification, 'v1', None, f'ds-{i}',
+                           ConfusionCounts(*map(int, counts[i, 0])), ConfusionCounts(*map(int, counts[i, 1])))
+        for i in range(len(counts))
+    ]
+
+
+def python_loop_tick(snapshots: list, thresholds: list) -> int:
+    # per-instance evaluation without the fleet arrays: metrics and thresholds checked one instance at a time
+    past_threshold = 0
+    for snapshot in snapshots:
+        for counts, layer_thresholds in zip((snapshot.counts_1, snapshot.counts_2), thresholds):
+            tp, fp, tn, fn = counts.as_tuple()
+            tpr, precision = tp / (tp + fn), tp / (tp + fp)
+            values = {
+                'accuracy': (tp + tn) / (tp + tn + fp + fn), 'precision': precision,
+                'fscore': 2 * precision * tpr / (precision + tpr), 'tpr': tpr, 'fpr': fp / (fp + tn),
+                'tnr': tn / (tn + fp), 'fnr': fn / (fn + tp)
+            }
+            for metric, value in values.items():
+                worse = value > layer_thresholds[metric] if metric in HIGHER_IS_WORSE \
+                    else value < layer_thresholds[metric]
+                past_threshold += worse
+    return past_threshold
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cost of the fleet analyzer with many detection system instances.')
+    parser.add_argument('-instances', type=int, nargs='+', default=[1000, 5000, 20000],
+                        help='Fleet sizes simulated (int)')
+    parser.add_argument('-ticks', type=int, default=40, help='Ticks simulated for each fleet size (int)')
+    args = parser.parse_args()
+
+    analyzer_main.LOGGER.setLevel(logging.INFO)
+    rng = np.random.default_rng(0)
+
+    print(f'{"instances":>10}{"record (us)":>13}{"decode+record (us)":>20}{"tick (ms)":>11}'
+          f'{"loop tick (ms)":>16}{"alarm tick":>12}')
+
+    for instances in args.instances:
+        analyzer = Analyzer(THRESHOLDS, stale_after=3600)
+        counts = simulate_counts(rng, instances, args.ticks, degraded_from=args.ticks // 2)
+
+        record_time = decode_time = tick_time = loop_time = 0.0
+        alarm_tick = None
+
+        for tick in range(args.ticks):
+            snapshots = build_snapshots(counts[tick])
+            bodies = [messages.encode(snapshot) for snapshot in snapshots]
+
+            start = time.perf_counter()
+            for snapshot in snapshots:
+                analyzer.record_snapshot(snapshot)
+            record_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            for body in bodies:
+                analyzer.record_snapshot(messages.decode(body))
+            decode_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            objectives = analyzer.evaluate_fleet()
+            tick_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            python_loop_tick(snapshots, (analyzer._metrics_thresholds_1, analyzer._metrics_thresholds_2))
+            loop_time += time.perf_counter() - start
+
+            if alarm_tick is None and not objectives.is_empty():
+                alarm_tick = tick
+
+        samples = instances * args.ticks
+        print(f'{instances:>10}{record_time / samples * 1e6:>13.2f}{decode_time / samples * 1e6:>20.2f}'
+              f'{tick_time / args.ticks * 1e3:>11.2f}{loop_time / args.ticks * 1e3:>16.2f}'
+              f'{str(alarm_tick):>12}')
+
+    print(f'\nThe degradation starts at tick {args.ticks // 2}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import accuracy_score, confusion_matrix, precision_score
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Shared.confusion import confusion_rates
+
+
+def builtin_sum_scoring(y: pd.Series, predicted: np.ndarray) -> dict:
+    # how each optimizer scored its trial: builtin sum over boolean Series, then sklearn for the scores
+    tp = sum((y == 1) & (predicted == 1))
+    fn = sum((y == 1) & (predicted == 0))
+    fp = sum((y == 0) & (predicted == 1))
+    tn = sum((y == 0) & (predicted == 0))
+
+    return {
+        'tpr': tp / (tp + fn), 'fpr': fp / (fp + tn), 'tnr': tn / (tn + fp), 'fnr': fn / (fn + tp),
+        'precision': precision_score(y, predicted), 'accuracy': accuracy_score(y, predicted)
+    }
+
+
+def sklearn_confusion_scoring(y: pd.Series, predicted: np.ndarray) -> dict:
+    tn, fp, fn, tp = confusion_matrix(y, predicted, labels=[0, 1]).ravel()
+
+    return {
+        'tpr': tp / (tp + fn), 'fpr': fp / (fp + tn), 'tnr': tn / (tn + fp), 'fnr': fn / (fn + tp),
+        'precision': tp / (tp + fp), 'accuracy': (tp + tn) / (tp + tn + fp + fn)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cost of scoring the validation predictions of one trial.')
+    parser.add_argument('-rows', type=int, nargs='+', default=[1000, 10000, 50000],
+                        help='Rows of the validation set (int)')
+    parser.add_argument('-repeat', type=int, default=5, help='Best of this many timings (int)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f'{"rows":>8}{"builtin sum (ms)":>18}{"sklearn matrix (ms)":>21}{"kernel (ms)":>13}{"speedup":>9}')
+
+    for rows in args.rows:
+        y = pd.Series(rng.integers(0, 2, rows))
+        predicted = np.where(rng.random(rows) < 0.9, y.to_numpy(), 1 - y.to_numpy())
+
+        # same rates from every implementation
+        expected = builtin_sum_scoring(y, predicted)
+        kernel = confusion_rates(y, predicted)
+        assert all(np.isclose(expected[name], kernel[name]) for name in expected)
+
+        timings = []
+        for scoring in (builtin_sum_scoring, sklearn_confusion_scoring, confusion_rates):
+            timer = timeit.Timer(lambda: scoring(y, predicted))
+            number = max(1, timer.autorange()[0] // 5)
+            timings.append(min(timer.repeat(repeat=args.repeat, number=number)) / number)
+
+        print(f'{rows:>8}{timings[0] * 1e3:>18.3f}{timings[1] * 1e3:>21.3f}{timings[2] * 1e3:>13.3f}'
+              f'{timings[0] / timings[2]:>8.0f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.svm import SVC
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Shared import model_store
+
+
+def memory_status_kb():
+    # RssAnon is the private memory of the process, RssFile the file pages it shares through the page cache
+    status = {}
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in ('RssAnon', 'RssFile'):
+                status[key] = int(value.split()[0])
+    return status
+
+
+def train_models(n_samples: int, n_features: int, n_trees: int):
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(n_samples, n_features))
+    # noisy labels, so that trees grow deep and most points end up as support vectors
+    y = ((x[:, 0] + rng.normal(scale=1.5, size=n_samples)) > 0).astype(int)
+
+    rf = RandomForestClassifier(n_estimators=n_trees, max_depth=None, n_jobs=-1, random_state=0).fit(x, y)
+    svm = SVC(C=10, gamma=0.1, probability=True, random_state=0).fit(x[:n_samples // 4], y[:n_samples // 4])
+
+    return rf, svm, x[:100]
+
+
+def load_worker(path: str, mode: str, sample, barrier, results):
+    model_store.LOGGER.setLevel(logging.WARNING)
+    before = memory_status_kb()
+    barrier.wait()
+
+    start = time.perf_counter()
+    if mode == 'pickle':
+        with open(path, 'rb') as f:
+            model = pickle.load(f)
+    else:
+        model = model_store.load_model(path, mmap=True)
+    elapsed = time.perf_counter() - start
+
+    model.predict(sample)
+    # the detector calls predict_proba on layer2, libsvm needs writeable arrays for it
+    model.predict_proba(sample)
+    after = memory_status_kb()
+
+    results.put((elapsed, after['RssAnon'] - before['RssAnon'], after['RssFile'] - before['RssFile']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load time and private memory of pickled against mapped models.')
+    parser.add_argument('-workers', type=int, default=4, help='Number of processes loading each model (int)')
+    parser.add_argument('-samples', type=int, default=40000, help='Number of training samples (int)')
+    parser.add_argument('-trees', type=int, default=100, help='Number of trees of the forest (int)')
+    args = parser.parse_args()
+
+    model_store.LOGGER.setLevel(logging.WARNING)
+    rf, svm, sample = train_models(args.samples, 12, args.trees)
+    print(f'RandomForest: {args.trees} trees, {sum(t.tree_.node_count for t in rf.estimators_)} nodes. '
+          f'SVC: {svm.support_vectors_.shape[0]} support vectors.')
+
+    ctx = multiprocessing.get_context('spawn')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print(f'{"model":<8}{"format":<10}{"size (MB)":>11}{"mean load (s)":>15}'
+              f'{"private (MB)":>14}{"shared file (MB)":>18}')
+
+        for model_name, model in [('rf', rf), ('svm', svm)]:
+            pickle_path = os.path.join(tmp_dir, f'{model_name}.pkl')
+            with open(pickle_path, 'wb') as f:
+                pickle.dump(model, f)
+
+            mapped_path = os.path.join(tmp_dir, f'{model_name}.joblib')
+            model_store.save_model(model, mapped_path)
+
+            for mode, path in [('pickle', pickle_path), ('mmap', mapped_path)]:
+                barrier = ctx.Barrier(args.workers)
+                results = ctx.Queue()
+                workers = [ctx.Process(target=load_worker, args=(path, mode, sample, barrier, results))
+                           for _ in range(args.workers)]
+                for worker in workers:
+                    worker.start()
+                stats = [results.get() for _ in workers]
+                for worker in workers:
+                    worker.join()
+
+                load_time, private_kb, file_kb = np.mean(stats, axis=0)
+                print(f'{model_name:<8}{mode:<10}{os.path.getsize(path) / 2 ** 20:>11.1f}{load_time:>15.3f}'
+                      f'{private_kb / 1024:>14.1f}{file_kb / 1024:>18.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import argparse
+import logging
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import optuna
+import pandas as pd
+from sklearn.datasets import make_classification
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'TunerProcess'))
+
+import hypertuner_main
+from TunerProcess.optimizer import OptimizationManager, RFTrainer, SVMTrainer
+from TunerProcess.parallel import ProcessPoolStudyRunner
+from TunerProcess.budget import cpu_seconds
+from TunerProcess.tuner import TunerLayer1
+
+
+def synthetic_storage(samples: int, features: int) -> SimpleNamespace:
+    # layer1 train and validation sets with the shape of the PCA encoded KDD sets
+    x, y = make_classification(n_samples=2 * samples, n_features=features, n_informative=features // 2,
+                               weights=[0.6], random_state=0)
+    columns = [f'pc{i}' for i in range(features)]
+
+    return SimpleNamespace(
+        x_train_l1=pd.DataFrame(x[:samples], columns=columns), y_train_l1=pd.Series(y[:samples]),
+        x_validate_l1=pd.DataFrame(x[samples:], columns=columns), y_validate_l1=pd.Series(y[samples:])
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Trials per second of the threaded and process tuning backends.')
+    parser.add_argument('-workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count()],
+                        help='Threads or processes compared (int)')
+    parser.add_argument('-n_trials', type=int, default=16, help='Trials of each study (int)')
+    parser.add_argument('-samples', type=int, default=20000, help='Rows of the train set (int)')
+    parser.add_argument('-features', type=int, default=20, help='Columns of the train set (int)')
+    parser.add_argument('-objectives', nargs='+', default=['accuracy', 'fpr'], help='Objectives tuned (str)')
+    args = parser.parse_args()
+
+    hypertuner_main.LOGGER.setLevel(logging.WARNING)
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+
+    temp_storage = synthetic_storage(args.samples, args.features)
+    rf_trainer = RFTrainer()
+    rf_trainer.set_temp_storage(temp_storage)
+
+    manager = OptimizationManager(sqlite_manager=None, rf_trainer=rf_trainer, svm_trainer=SVMTrainer())
+    manager.temp_storage = temp_storage
+    optimizers = manager.optimizers_mapper(args.objectives, 1)
+
+    print(f'{os.cpu_count()} core(s), {args.n_trials} trials on {args.samples}x{args.features}, '
+          f'objectives {args.objectives}')
+    print(f'{"workers":>8}{"threads (trials/s)":>20}{"processes (trials/s)":>22}{"speedup":>9}'
+          f'{"threads (CPU-s)":>17}{"processes (CPU-s)":>19}')
+
+    for workers in sorted(set(args.workers)):
+        rates, cpu = [], []
+        for runner in (None, ProcessPoolStudyRunner(n_workers=workers)):
+            tuner = TunerLayer1(n_trials=args.n_trials, n_cores=workers, optimizer=manager, runner=runner)
+
+            start, cpu_start = time.perf_counter(), cpu_seconds()
+            study = tuner.tune_layer(optimizers)
+            rates.append(len(study.trials) / (time.perf_counter() - start))
+            # with the worker processes, as reported in the tuning history
+            cpu.append(cpu_seconds() - cpu_start)
+
+        print(f'{workers:>8}{rates[0]:>20.2f}{rates[1]:>22.2f}{rates[1] / rates[0]:>8.2f}x'
+              f'{cpu[0]:>17.1f}{cpu[1]:>19.1f}')
+
+
+if __name__ == '__main__':
+    main()
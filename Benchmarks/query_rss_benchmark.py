@@ -0,0 +1,113 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Shared import sql_query
+
+# same shape as the original KDDTrain+ set
+N_ROWS = 125973
+CAT_FEATURES = ['protocol_type', 'service', 'flag']
+N_NUM_FEATURES = 38
+
+
+def build_x_train_db(path: str, n_rows: int):
+    rng = np.random.default_rng(42)
+
+    data = {f'num_{i}': rng.random(n_rows) for i in range(N_NUM_FEATURES)}
+    data['protocol_type'] = rng.choice(['tcp', 'udp', 'icmp'], n_rows)
+    data['service'] = rng.choice(['http', 'private', 'ftp_data', 'smtp', 'other'], n_rows)
+    data['flag'] = rng.choice(['SF', 'S0', 'REJ', 'RSTR'], n_rows)
+    data['label'] = rng.choice(['normal', 'neptune', 'satan', 'smurf', 'guess_passwd'], n_rows)
+
+    with sqlite3.connect(path) as connection:
+        pd.DataFrame(data).to_sql('x_train', connection, index=False, if_exists='replace')
+
+
+def peak_rss_kb():
+    # VmHWM is tracked per address space, unlike ru_maxrss which Linux carries over from the parent process
+    try:
+        with open('/proc/self/status', 'r') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_mode(mode: str, db_path: str, chunk_size: int, results):
+    sql_query.LOGGER.setLevel(logging.INFO)
+    connection = sqlite3.connect(db_path)
+    numerical = [f'num_{i}' for i in range(N_NUM_FEATURES)]
+
+    baseline = peak_rss_kb()
+    start = time.perf_counter()
+
+    if mode == 'read_sql':
+        # previous behaviour: the whole table is materialized at once
+        df = sql_query.read_query(connection, {'select': '*', 'from': 'x_train'})
+        total = df[numerical].to_numpy().sum(axis=0)
+        n_rows = df.shape[0]
+
+    elif mode == 'chunks_projected':
+        total = np.zeros(N_NUM_FEATURES)
+        n_rows = 0
+        for chunk in sql_query.iter_query_chunks(connection, {'select': numerical, 'from': 'x_train'},
+                                                 chunk_size=chunk_size):
+            total += chunk.sum(axis=0)
+            n_rows += chunk.shape[0]
+
+    else:
+        total = np.zeros(N_NUM_FEATURES)
+        n_rows = 0
+        for chunk in sql_query.iter_query_chunks(connection, {'select': '*', 'from': 'x_train'},
+                                                 chunk_size=chunk_size, dtype=object):
+            total += chunk[:, :N_NUM_FEATURES].astype(np.float64).sum(axis=0)
+            n_rows += chunk.shape[0]
+
+    elapsed = time.perf_counter() - start
+    connection.close()
+
+    results.put((mode, n_rows, peak_rss_kb() - baseline, elapsed, float(total.sum())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Peak RSS of the x_train select, full read against chunked reads.')
+    parser.add_argument('-rows', type=int, default=N_ROWS, help='Number of rows of the synthetic x_train (int)')
+    parser.add_argument('-chunk_size', type=int, default=10000, help='Rows per chunk (int)')
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'x_train.sqlite')
+        build_x_train_db(db_path, args.rows)
+
+        print(f'x_train: {args.rows} rows, chunk size {args.chunk_size}')
+        print(f'{"mode":<20}{"rows":>10}{"peak RSS delta (MB)":>22}{"time (s)":>12}')
+
+        # each mode runs in a fresh process, since the peak RSS of a process never decreases
+        for mode in ['read_sql', 'chunks_projected', 'chunks_all']:
+            results = ctx.Queue()
+            process = ctx.Process(target=run_mode, args=(mode, db_path, args.chunk_size, results))
+            process.start()
+            name, n_rows, rss_delta, elapsed, _ = results.get()
+            process.join()
+
+            print(f'{name:<20}{n_rows:>10}{rss_delta / 1024:>22.1f}{elapsed:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
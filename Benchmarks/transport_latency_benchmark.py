@@ -0,0 +1,83 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Shared import local_broker, sqs_wrapper, transports
+from Shared.sqs_wrapper import Connector
+
+QUEUE_NAME = 'latency-benchmark.fifo'
+
+
+def measure(transport_factory, queue_url: str, n_messages: int, interval: float) -> np.ndarray:
+    producer = Connector(transport=transport_factory(), queue_names=[QUEUE_NAME])
+    consumer = Connector(transport=transport_factory(), queue_urls=[queue_url])
+
+    def produce():
+        for i in range(n_messages):
+            producer.send_message_to_queues({'MSG_TYPE': 'BENCHMARK', 'i': i, 'sent': time.perf_counter()})
+            time.sleep(interval)
+
+    producer_thread = threading.Thread(target=produce, daemon=True)
+    producer_thread.start()
+
+    latencies = []
+    while len(latencies) < n_messages:
+        msg_body = consumer.receive_messages()
+        if msg_body:
+            latencies.append(time.perf_counter() - json.loads(msg_body)['sent'])
+
+    producer_thread.join()
+    producer.close()
+
+    return np.array(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send-to-receive latency of the Connector transports.')
+    parser.add_argument('-messages', type=int, default=200, help='Number of messages per transport (int)')
+    parser.add_argument('-interval', type=float, default=0.005, help='Seconds between two sends (float)')
+    parser.add_argument('-sqs_queue_url', type=str, default=None,
+                        help=f'URL of an existing {QUEUE_NAME} SQS queue, to include Amazon SQS (str)')
+    args = parser.parse_args()
+
+    sqs_wrapper.LOGGER.setLevel(logging.WARNING)
+    transports.LOGGER.setLevel(logging.WARNING)
+
+    ctx = multiprocessing.get_context('spawn')
+    address = os.path.join(tempfile.mkdtemp(), 'broker.sock')
+    broker_process = ctx.Process(target=local_broker.serve_broker, args=(address,), daemon=True)
+    broker_process.start()
+
+    while not os.path.exists(address):
+        time.sleep(0.05)
+
+    backends = [
+        ('inprocess', lambda: transports.LocalTransport(), QUEUE_NAME),
+        ('socket', lambda: transports.LocalTransport(local_broker.connect_broker(address)), QUEUE_NAME),
+    ]
+    if args.sqs_queue_url:
+        backends.append(('sqs', lambda: transports.create_transport('sqs'), args.sqs_queue_url))
+
+    print(f'{"transport":<12}{"messages":>10}{"p50 (ms)":>12}{"p95 (ms)":>12}{"p99 (ms)":>12}{"max (ms)":>12}')
+
+    try:
+        for name, factory, queue_url in backends:
+            latencies = measure(factory, queue_url, args.messages, args.interval)
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            print(f'{name:<12}{len(latencies):>10}{p50:>12.3f}{p95:>12.3f}{p99:>12.3f}{latencies.max():>12.3f}')
+    finally:
+        broker_process.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import json
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Shared import messages, utils
+from Shared.messages import (MetricsSnapshotMsg, LayerMetrics, ClassificationMetrics, ObjectivesMsg,
+                             ModelUpdateMsg, METRIC_NAMES, CLASSIFICATION_METRIC_NAMES)
+
+
+def sample_messages():
+    rng = np.random.default_rng(0)
+
+    snapshot = MetricsSnapshotMsg(
+        LayerMetrics(*rng.random(len(METRIC_NAMES))),
+        LayerMetrics(*rng.random(len(METRIC_NAMES))),
+        ClassificationMetrics(*rng.random(len(CLASSIFICATION_METRIC_NAMES)))
+    )
+    objectives = ObjectivesMsg(['accuracy', 'fscore', 'fpr'], ['precision', 'tpr'])
+    model_update = ModelUpdateMsg('Hypertuner')
+
+    return [('METRICS_SNAPSHOT', snapshot), ('OBJECTIVES', objectives), ('MODEL_UPDATE', model_update)]
+
+
+def legacy_json_decode(body: str):
+    # the decoding done by the components before the typed messages
+    json_dict = json.loads(body)
+    if json_dict['MSG_TYPE'] == str(messages.msg_type.METRICS_SNAPSHOT_MSG):
+        return utils.parse_metrics_msg(json_dict)
+    return json_dict
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Size and speed of the JSON and binary message encodings.')
+    parser.add_argument('-repeat', type=int, default=20000, help='Number of encodings and decodings timed (int)')
+    args = parser.parse_args()
+
+    print(f'{"message":<18}{"format":<14}{"size (B)":>10}{"encode (us)":>13}{"decode (us)":>13}')
+
+    for name, message in sample_messages():
+        json_body = json.dumps(message.to_dict())
+
+        messages.WIRE_FORMAT = 'binary'
+        binary_body = messages.encode(message)
+
+        runs = [
+            ('json (legacy)', json_body,
+             lambda: json.dumps(message.to_dict()), lambda: legacy_json_decode(json_body)),
+            ('json', json_body,
+             lambda: json.dumps(message.to_dict()), lambda: messages.decode(json_body)),
+            ('binary', binary_body,
+             lambda: messages.encode(message), lambda: messages.decode(binary_body)),
+        ]
+
+        for format_name, body, encode, decode in runs:
+            encode_us = timeit.timeit(encode, number=args.repeat) / args.repeat * 1e6
+            decode_us = timeit.timeit(decode, number=args.repeat) / args.repeat * 1e6
+            print(f'{name:<18}{format_name:<14}{len(body.encode()):>10}{encode_us:>13.2f}{decode_us:>13.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+
+# These are how attacks are categorized in the trainset
+NORMAL, DOS, PROBE, U2R, R2L = range(5)
+UNKNOWN = -1
+
+CATEGORY_LABELS = {
+    NORMAL: ['normal'],
+    DOS: ['back', 'land', 'neptune', 'pod', 'smurf', 'teardrop'],
+    PROBE: ['ipsweep', 'portsweep', 'satan', 'nmap'],
+    U2R: ['loadmodule', 'perl', 'rootkit', 'buffer_overflow'],
+    R2L: ['ftp_write', 'guess_passwd', 'imap', 'multihop', 'phf', 'spy', 'warezclient', 'warezmaster'],
+}
+
+LABEL_TO_CATEGORY = {label: category for category, labels in CATEGORY_LABELS.items() for label in labels}
+
+
+def encode_labels(labels) -> np.ndarray:
+    """
+    Maps each attack label to the integer code of its category, labels outside the known lists become UNKNOWN.
+    :param labels: iterable of attack labels, usually the 'label' column of the original train set.
+    :return: int8 array with one category code per label.
+    """
+    codes = pd.Series(labels).map(LABEL_TO_CATEGORY).fillna(UNKNOWN)
+    return codes.to_numpy(dtype=np.int8)
+
+
+class CategoryIndex:
+    """
+    Row indexes of each attack category, computed once from the category codes of a dataset.
+    Rows are stored grouped by category, so that the rows of a single category are a slice (a view)
+    of one array, and binary targets are cached after the first request.
+    """
+
+    def __init__(self, codes):
+        self.codes = np.asarray(codes, dtype=np.int8)
+
+        self._order = np.argsort(self.codes, kind='stable')
+        # bounds[c - UNKNOWN] is the first position of category c in the grouped order
+        self._bounds = np.searchsorted(self.codes[self._order], np.arange(UNKNOWN, R2L + 2))
+        self._targets = {}
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def rows(self, *categories: int) -> np.ndarray:
+        """
+        Returns the row positions belonging to the given categories, in ascending order.
+        A single category is returned as a read-only view, several categories are concatenated.
+        """
+        slices = [self._order[self._bounds[c - UNKNOWN]:self._bounds[c - UNKNOWN + 1]] for c in categories]
+
+        if len(slices) == 1:
+            view = slices[0].view()
+            view.flags.writeable = False
+            return view
+
+        return np.sort(np.concatenate(slices))
+
+    def count(self, category: int) -> int:
+        return int(self._bounds[category - UNKNOWN + 1] - self._bounds[category - UNKNOWN])
+
+    def targets(self, *categories: int) -> np.ndarray:
+        """
+        Returns a binary target over all rows: 1 for the rows in the given categories, 0 otherwise.
+        """
+        key = tuple(sorted(set(categories)))
+
+        if key not in self._targets:
+            targets = np.isin(self.codes, key).astype(np.uint8)
+            targets.flags.writeable = False
+            self._targets[key] = targets
+
+        return self._targets[key]
@@ -1,10 +1,10 @@
-import pickle
-
 import joblib
 import numpy as np
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.svm import SVC
 
+from Shared import model_store
+
 
 class DefaultTrainer:
 
@@ -38,8 +38,7 @@ class DefaultTrainer:
 
         classifier.fit(self.x_train_l1, self.y_train_l1)
 
-        with open('StartingModels/random_forest_model_default.pkl', 'wb') as f:
-            pickle.dump(classifier, f)
+        model_store.save_model(classifier, 'StartingModels/random_forest_model_default.pkl')
 
     def train_svm(self):
         classifier = SVC(
@@ -60,8 +59,7 @@ class DefaultTrainer:
 
         classifier.fit(self.x_train_l2, self.y_train_l2)
 
-        with open('StartingModels/support_vector_machine_model_default.pkl', 'wb') as f:
-            pickle.dump(classifier, f)
+        model_store.save_model(classifier, 'StartingModels/support_vector_machine_model_default.pkl')
 
 
 def main():
@@ -1,7 +1,8 @@
 import json
 import os
+from typing import Iterable
 
-import pandas as pd
+import numpy as np
 
 from KBProcess.storage import Storage
 from Shared import utils
@@ -13,15 +14,20 @@ class DataManager:
         import knowledge_base_main
         self.LOGGER = knowledge_base_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
 
-    def analyze_datasets(self, x_train: pd.DataFrame):
+    def analyze_datasets(self, columns: list[str], chunks: Iterable[np.ndarray]):
+        """
+        :param columns: features of the train set.
+        :param chunks: rows of the train set, in chunks of at most a few thousand rows.
+        :return: True if the features or the number of samples changed.
+        """
         self.LOGGER.debug('Analyzing datasets.')
 
         old_dataset_properties = json.loads("dataset_properties")
 
         new_dataset_properties = {
-            "features_num": x_train.shape[1],
-            "features": x_train.columns.tolist(),
-            "train_samples": x_train.shape[0],
+            "features_num": len(columns),
+            "features": list(columns),
+            "train_samples": sum(chunk.shape[0] for chunk in chunks),
         }
 
         if (old_dataset_properties["features_num"] != new_dataset_properties["features_num"] or
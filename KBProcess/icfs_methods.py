@@ -1,8 +1,8 @@
-import copy
-
 import numpy as np
 import pandas as pd
 
+from KBProcess.attack_categories import CategoryIndex, encode_labels, NORMAL, DOS, PROBE, U2R, R2L
+
 
 def __pearson_correlated_features(x, y, threshold):
     y['target'] = y['target'].astype(int)
@@ -30,49 +30,30 @@ def __compute_set_difference(df1, df2):
     return df_diff
 
 
-def perform_icfs(x_train):
+def perform_icfs(x_train, category_index: CategoryIndex = None):
+    # the category index is precomputed by the storage at load time, build it here only when missing
+    if category_index is None:
+        category_index = CategoryIndex(encode_labels(x_train['label']))
+
     # now ICFS only on the numerical features
-    num_train = copy.deepcopy(x_train)
-    del num_train['protocol_type']
-    del num_train['service']
-    del num_train['flag']
-
-    target = pd.DataFrame()
-    target['target'] = np.array([1 if x != 'normal' else 0 for x in num_train['label']])
-    num_train = pd.concat([num_train, target], axis=1)
-
-    # These are how attacks are categorized in the trainset
-    dos_list = ['back', 'land', 'neptune', 'pod', 'smurf', 'teardrop']
-    probe_list = ['ipsweep', 'portsweep', 'satan', 'nmap']
-    u2r_list = ['loadmodule', 'perl', 'rootkit', 'buffer_overflow']
-    r2l_list = ['ftp_write', 'guess_passwd', 'imap', 'multihop', 'phf', 'spy', 'warezclient', 'warezmaster']
-    normal = ['normal']
+    num_train = x_train.drop(columns=['protocol_type', 'service', 'flag', 'label', 'attack_category'],
+                             errors='ignore').astype(float)
 
     # useful sub-sets
-    x_normal = num_train[num_train['label'].isin(normal)]
-    x_u2r = num_train[num_train['label'].isin(u2r_list)]
-    x_r2l = num_train[num_train['label'].isin(r2l_list)]
-    x_dos = num_train[num_train['label'].isin(dos_list)]
-    x_probe = num_train[num_train['label'].isin(probe_list)]
+    normal_rows = category_index.rows(NORMAL)
+    u2r_rows = category_index.rows(U2R)
+    r2l_rows = category_index.rows(R2L)
 
     # start the ICFS with l1
 
     # features for dos
-    dos = copy.deepcopy(num_train)
-    del dos['target']
-    y = np.array([1 if x in dos_list else 0 for x in dos['label']])
-    y_dos = pd.DataFrame(y, columns=['target'])
-    del dos['label']
-    dos_all = __pearson_correlated_features(dos, y_dos, 0.1)
+    y_dos = pd.DataFrame(category_index.targets(DOS), columns=['target'], index=num_train.index)
+    dos_all = __pearson_correlated_features(num_train, y_dos, 0.1)
     print(dos_all)
 
     # features for probe
-    probe = copy.deepcopy(num_train)
-    del probe['target']
-    y = np.array([1 if x in probe_list else 0 for x in probe['label']])
-    y_probe = pd.DataFrame(y, columns=['target'])
-    del probe['label']
-    probe_all = __pearson_correlated_features(probe, y_probe, 0.1)
+    y_probe = pd.DataFrame(category_index.targets(PROBE), columns=['target'], index=num_train.index)
+    probe_all = __pearson_correlated_features(num_train, y_probe, 0.1)
     print(probe_all)
 
     # intersect for the optimal features
@@ -86,21 +67,17 @@ def perform_icfs(x_train):
     # now l2 needs the features to describe the difference between rare attacks and normal traffic
 
     # features for u2r
-    u2r = pd.concat([x_u2r, x_normal], axis=0)
-    del u2r['target']
-    y = np.array([1 if x in u2r_list else 0 for x in u2r['label']])
-    y_u2r = pd.DataFrame(y, columns=['target'])
-    del u2r['label']
-    u2r_all = __pearson_correlated_features(u2r, y_u2r, 0.01)
+    u2r_rows = np.concatenate([u2r_rows, normal_rows])
+    u2r = num_train.iloc[u2r_rows]
+    y_u2r = pd.DataFrame(category_index.targets(U2R)[u2r_rows], columns=['target'], index=u2r.index)
+    u2r_all = __pearson_correlated_features(u2r.copy(), y_u2r, 0.01)
     print(u2r_all)
 
     # features for r2l
-    r2l = pd.concat([x_r2l, x_normal], axis=0)
-    del r2l['target']
-    y = np.array([1 if x in r2l_list else 0 for x in r2l['label']])
-    y_r2l = pd.DataFrame(y, columns=['target'])
-    del r2l['label']
-    r2l_all = __pearson_correlated_features(r2l, y_r2l, 0.01)
+    r2l_rows = np.concatenate([r2l_rows, normal_rows])
+    r2l = num_train.iloc[r2l_rows]
+    y_r2l = pd.DataFrame(category_index.targets(R2L)[r2l_rows], columns=['target'], index=r2l.index)
+    r2l_all = __pearson_correlated_features(r2l.copy(), y_r2l, 0.01)
     print(r2l_all)
 
     # intersect for the optimal features
@@ -1,29 +1,30 @@
 import argparse
 import logging
 import sys
-import json
 import os
 import threading
 import time
-import boto3
 
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
 from KBProcess.storage import Storage
-from KBProcess import features_selector
-from Shared.msg_enum import msg_type
-from Shared import sqs_wrapper, utils
+from KBProcess import features_selector, icfs_methods
+from Shared import sqs_wrapper, transports, utils
+from Shared.messages import ModelUpdateMsg, MultipleUpdateMsg
+from Shared.message_handler import SimpleMsgHandler, MessageDispatcher
+from Shared.outbox import Outbox, default_journal_path
 
 LOGGER = utils.get_logger(os.path.splitext(os.path.basename(__file__))[0])
 
 
-class KnowledgeBase:
+class KnowledgeBase(SimpleMsgHandler):
     FULL_CLOSE = False
     DEBUG = True
 
-    def __init__(self, polling_timer: int):
+    def __init__(self, polling_timer: int, outbox_journal: str = None):
 
         self.polling_timer = polling_timer
+        self.outbox_journal = outbox_journal or default_journal_path('knowledge_base')
 
         LOGGER.debug('Creating an instance of KnowledgeBase.')
         self.storage = Storage()
@@ -32,9 +33,6 @@ class KnowledgeBase:
         self.__sqs_setup()
 
     def __sqs_setup(self):
-        self.sqs_resource = boto3.resource('sqs')
-        self.sqs_client = boto3.client('sqs')
-
         queue_urls = [
             'https://sqs.eu-west-3.amazonaws.com/818750160971/tuned-models-kb.fifo',
         ]
@@ -45,67 +43,84 @@ class KnowledgeBase:
         ]
 
         self.connector = sqs_wrapper.Connector(
-            sqs_resource=self.sqs_resource,
-            sqs_client=self.sqs_client,
+            transport=transports.create_transport(),
             queue_names=queue_names,
             queue_urls=queue_urls
         )
+        self.outbox = Outbox(self.connector, journal_path=self.outbox_journal)
+        self.dispatcher = MessageDispatcher.for_handler(self)
 
     def terminate(self):
+        self.outbox.close()
         self.connector.close()
 
     def poll_queues(self):
-        while True:
-            LOGGER.debug('Fetching messages..')
+        LOGGER.debug('Listening for messages..')
 
-            try:
-                msg_body = self.connector.receive_messages()
+        try:
+            self.connector.listen(self.dispatcher.dispatch, wait_time=self.polling_timer)
+        except Exception as e:
+            LOGGER.error(f"Error in fetching messages from queue: {e}")
+            raise KeyboardInterrupt
 
-            except Exception as e:
-                LOGGER.error(f"Error in fetching messages from queue: {e}")
-                raise KeyboardInterrupt
+    def handle_models_update_msg(self, message: ModelUpdateMsg):
+        LOGGER.debug(f'Received update notification: {message}')
+        self.storage.loader.s3_models()
 
-            if msg_body:
+    def __select_features_procedure(self, feature_selection_func):
 
-                json_dict = json.loads(msg_body)
+        # the attack category codes are an index maintained by the storage, not a dataset feature
+        columns = [column for column in self.storage.table_columns('x_train') if column != 'attack_category']
+        query_dict = {
+            "select": columns,
+            "from": "x_train"
+        }
+        # the train set is streamed in chunks, it is never loaded whole
+        chunks = self.storage.perform_query_chunks(query_dict, dtype=object)
+        if feature_selection_func(columns, chunks):
 
-                if json_dict['MSG_TYPE'] == str(msg_type.MODEL_UPDATE_MSG):
-                    LOGGER.debug(f'Received update notification: {json_dict}')
-                    self.storage.loader.s3_models()
-                else:
-                    LOGGER.debug(f'Unexpected message type received: {json_dict["MSG_TYPE"]}')
+            update_msg = MultipleUpdateMsg(update=['FEATURES', 'TRAIN', 'VALIDATE'], sender='KnowledgeBase')
 
-            time.sleep(self.polling_timer)
+            self.outbox.send(update_msg)
 
-    def __select_features_procedure(self, feature_selection_func):
+        else:
+            LOGGER.error('Feature selection function failed. Retry.')
+
+    def __icfs_procedure(self):
 
+        # ICFS correlates the numerical features only, the categories come from the index of the storage
+        excluded = ['protocol_type', 'service', 'flag', 'label', 'attack_category']
         query_dict = {
-            "select": "*",
+            "select": [column for column in self.storage.table_columns('x_train') if column not in excluded],
             "from": "x_train"
         }
-        if feature_selection_func(self.storage.perform_query(query_dict)):
+        x_train = self.storage.perform_query(query_dict)
+        if x_train is None:
+            LOGGER.error('Could not read the train set for ICFS. Retry.')
+            return
 
-            update_msg = {
-                "MSG_TYPE": str(msg_type.MULTIPLE_UPDATE_MSG),
-                "UPDATE": ['FEATURES', 'TRAIN', 'VALIDATE'],
-                "SENDER": 'KnowledgeBase'
-            }
+        try:
+            icfs_methods.perform_icfs(x_train, self.storage.category_index('x_train'))
+        except OSError:
+            LOGGER.exception('Could not save the features selected by ICFS. Retry.')
+            return
 
-            self.connector.send_message_to_queues(update_msg)
+        update_msg = MultipleUpdateMsg(update=['FEATURES'], sender='KnowledgeBase')
 
-        else:
-            LOGGER.error('Feature selection function failed. Retry.')
+        self.outbox.send(update_msg)
 
     def input_reading(self):
 
         action_mapping = {
-            1: self.features_selector.analyze_datasets
+            1: lambda: self.__select_features_procedure(self.features_selector.analyze_datasets),
+            2: self.__icfs_procedure
         }
 
         while True:
 
             print("\nSelect the number of the action to perform:"
                   "\n1. Analyze the dataset for changes"
+                  "\n2. Select the minimal features with ICFS"
                   "\n'exit' to quit to program.")
 
             choice = input('>> ')
@@ -115,9 +130,9 @@ class KnowledgeBase:
 
             try:
                 action_number = int(choice)
-                selected_function = action_mapping.get(action_number)
-                if selected_function:
-                    self.__select_features_procedure(selected_function)
+                selected_procedure = action_mapping.get(action_number)
+                if selected_procedure:
+                    selected_procedure()
                 else:
                     print("Invalid action number.")
                     continue
@@ -157,7 +172,7 @@ def process_command_line_args():
     parser.add_argument('-polling_timer',
                         type=float,
                         default=5,
-                        help='Specify the polling timer (float)'
+                        help='Specify the long polling wait time on each queue, at most 20 seconds (float)'
                         )
     parser.add_argument('-classification_delay',
                         type=float,
@@ -169,6 +184,12 @@ def process_command_line_args():
                         default=False,
                         help='Specify the if additional prints are needed'
                         )
+    parser.add_argument('-outbox_journal',
+                        type=str,
+                        default=None,
+                        help='Specify the journal of the outgoing messages, one for each running knowledge base, '
+                             'outbox_knowledge_base.jsonl by default (str)'
+                        )
     parser.add_argument('-verbose',
                         action='store_true',
                         help='Set the logging default to "DEBUG"'
@@ -185,12 +206,12 @@ def process_command_line_args():
     if polling_timer is not None:
         LOGGER.debug(f'Polling Timer: {polling_timer}')
 
-    return polling_timer
+    return polling_timer, args.outbox_journal
 
 
 def main():
-    poll_timer = process_command_line_args()
-    kb = KnowledgeBase(poll_timer)
+    poll_timer, outbox_journal = process_command_line_args()
+    kb = KnowledgeBase(poll_timer, outbox_journal)
 
     try:
         kb.run_tasks()
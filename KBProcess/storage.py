@@ -1,12 +1,16 @@
+import numpy as np
 import pandas as pd
 import os
 import boto3
 import sqlite3
 
+from KBProcess import attack_categories
 from Shared.s3_wrapper import Loader
-from Shared import utils
+from Shared.shared_datasets import SharedDatasetRegistry
+from Shared import sql_query, utils
 
 class Storage:
+    SHARE_DATASETS = True
 
     def __init__(self):
 
@@ -15,8 +19,30 @@ class Storage:
 
         self.__s3_setup()
         self.__load_data_instances()
+
+        if self.SHARE_DATASETS:
+            self.__publish_shared_datasets()
+
         self.__sqlite3_setup()
 
+    def __publish_shared_datasets(self):
+        # co-located processes (the Hypertuner) attach to these instead of parsing the same files again
+        self.LOGGER.debug('Publishing the processed datasets in shared memory.')
+
+        datasets = {
+            'KDDTrain+_l1_pca': (self.x_train_l1, self.y_train_l1),
+            'KDDTrain+_l2_pca': (self.x_train_l2, self.y_train_l2),
+            'KDDValidate+_l1_pca': (self.x_validate_l1, self.y_validate_l1),
+            'KDDValidate+_l2_pca': (self.x_validate_l2, self.y_validate_l2)
+        }
+
+        try:
+            registry = SharedDatasetRegistry()
+            for name, (x, y) in datasets.items():
+                registry.publish(name, {'x': x, 'y': y})
+        except (OSError, ValueError):
+            self.LOGGER.exception('Could not publish the datasets in shared memory.')
+
     def __sqlite3_setup(self):
         self.LOGGER.debug('Connecting to sqlite3 in memory database.')
         self.sql_connection = sqlite3.connect(':memory:', check_same_thread=False)
@@ -73,6 +99,14 @@ class Storage:
         self.LOGGER.debug('Loading original reduced train set.')
         self.x_train_20p = self.loader.load_og_dataset('KDDTrain+20_percent_with_labels.txt')
 
+        self.LOGGER.debug('Indexing attack categories.')
+        self.x_train['attack_category'] = attack_categories.encode_labels(self.x_train['label'])
+        self.x_train_20p['attack_category'] = attack_categories.encode_labels(self.x_train_20p['label'])
+        self.category_indexes = {
+            'x_train': attack_categories.CategoryIndex(self.x_train['attack_category']),
+            'x_train_20p': attack_categories.CategoryIndex(self.x_train_20p['attack_category'])
+        }
+
         self.LOGGER.debug('Loading train sets.')
         self.x_train_l1, self.y_train_l1 = self.loader.load_dataset(
             'KDDTrain+_l1_pca.pkl',
@@ -120,6 +154,12 @@ class Storage:
         self.x_train.to_sql('x_train', self.sql_connection, index=False, if_exists='replace')
         self.x_train_20p.to_sql('x_train_20p', self.sql_connection, index=False, if_exists='replace')
 
+        # index the attack labels and categories, so that per-category queries do not scan the tables
+        for table_name in ['x_train', 'x_train_20p']:
+            for column_name in ['label', 'attack_category']:
+                self.cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_{column_name} '
+                                    f'ON {table_name} ({column_name})')
+
         # create a table for each validation set
         self.x_validate_l1.to_sql('x_validate_l1', self.sql_connection, index=False, if_exists='replace')
         self.x_validate_l2.to_sql('x_validate_l2', self.sql_connection, index=False, if_exists='replace')
@@ -145,26 +185,32 @@ class Storage:
         # del self.x_test, self.y_test
         del self.x_train, self.x_train_20p
 
+    def category_index(self, table_name: str) -> attack_categories.CategoryIndex:
+        """
+        Returns the rows of each attack category (see KBProcess.attack_categories) of a table, in table order.
+        """
+        return self.category_indexes[table_name]
+
+    def table_columns(self, table_name: str) -> list[str]:
+        return sql_query.query_columns(self.sql_connection, table_name)
+
     def perform_query(self, received):
         self.LOGGER.debug(f'Received a query.')
 
         try:
-            select_clause = received.get("select")
-            from_clause = received.get("from")
-            where_clause = received.get("where")
-
-            if where_clause is None:
-                sql_query = f'SELECT {select_clause} FROM {from_clause}'
-            else:
-                sql_query = f'SELECT {select_clause} FROM {from_clause} WHERE {where_clause}'
+            result_df = sql_query.read_query(self.sql_connection, received)
 
-            self.LOGGER.debug(f'Executing the query: {sql_query}')
-
-            result_df = pd.read_sql_query(sql_query, self.sql_connection)
-
-        except pd.errors.DatabaseError:
+        except (pd.errors.DatabaseError, ValueError):
             self.LOGGER.exception('Could not fulfill the requests.')
             return None
 
         self.LOGGER.debug('Query was executed correctly.')
         return result_df
+
+    def perform_query_chunks(self, received, chunk_size: int = 10000, dtype=np.float64):
+        """
+        Streams the result of a query as NumPy arrays of at most chunk_size rows.
+        See Shared.sql_query.build_query for the supported query keys.
+        """
+        self.LOGGER.debug('Received a chunked query.')
+        return sql_query.iter_query_chunks(self.sql_connection, received, chunk_size=chunk_size, dtype=dtype)
@@ -0,0 +1,67 @@
+import numpy as np
+
+from Shared.messages import CONFUSION_NAMES, METRIC_NAMES
+
+# columns of the counts arrays
+TP, FP, TN, FN = range(len(CONFUSION_NAMES))
+
+# bins of 2 * y_true + predicted, in the order of CONFUSION_NAMES
+_BINS = np.array([3, 1, 0, 2])
+
+
+def confusion_counts(y_true, predicted) -> np.ndarray:
+    """
+    Confusion counts of binary predictions, in one pass over the labels.
+    :param y_true: labels, 0 or 1.
+    :param predicted: predictions, 0 or 1.
+    :return: array of shape (4,), in the order of CONFUSION_NAMES.
+    """
+    y_true = np.asarray(y_true).astype(np.int64, copy=False)
+    predicted = np.asarray(predicted).astype(np.int64, copy=False)
+
+    bins = np.bincount(2 * y_true + predicted, minlength=4)
+    if len(bins) > 4:
+        raise ValueError(f'Labels and predictions must be 0 or 1, got up to {len(bins) - 1} for 2 * label + prediction.')
+
+    return bins[_BINS]
+
+
+def metrics_from_counts(counts: np.ndarray) -> np.ndarray:
+    """
+    Metrics of METRIC_NAMES for any number of confusion counts at once.
+    :param counts: array of shape (..., 4), in the order of CONFUSION_NAMES.
+    :return: array of shape (..., 7), NaN where a metric is undefined.
+    """
+    counts = np.asarray(counts, dtype=float)
+    tp, fp, tn, fn = counts[..., TP], counts[..., FP], counts[..., TN], counts[..., FN]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tpr = tp / (tp + fn)
+        precision = tp / (tp + fp)
+        metrics = {
+            'accuracy': (tp + tn) / (tp + tn + fp + fn),
+            'precision': precision,
+            'fscore': 2 * precision * tpr / (precision + tpr),
+            'tpr': tpr,
+            'fpr': fp / (fp + tn),
+            'tnr': tn / (tn + fp),
+            'fnr': fn / (fn + tp)
+        }
+
+    return np.stack([metrics[metric] for metric in METRIC_NAMES], axis=-1)
+
+
+def metrics_dict(counts) -> dict:
+    """
+    :param counts: confusion counts of one classifier, in the order of CONFUSION_NAMES.
+    :return: metric -> value, 0.0 where the metric is undefined.
+    """
+    values = np.nan_to_num(metrics_from_counts(counts), nan=0.0)
+    return dict(zip(METRIC_NAMES, values.tolist()))
+
+
+def confusion_rates(y_true, predicted) -> dict:
+    """
+    :return: every metric of METRIC_NAMES for binary predictions, 0.0 where undefined.
+    """
+    return metrics_dict(confusion_counts(y_true, predicted))
@@ -0,0 +1,100 @@
+from botocore.exceptions import ClientError
+
+from Shared.local_broker import LocalBroker
+from Shared.transports import queue_name_from_url
+
+FAKE_QUEUE_URL = 'https://sqs.local.fake/000000000000/{}'
+
+
+def _client_error(operation: str, message: str):
+    return ClientError({'Error': {'Code': 'InvalidParameterValue', 'Message': message}}, operation)
+
+
+class FakeQueue:
+    """
+    Subset of the boto3 SQS Queue resource used by the SQSTransport.
+    """
+
+    def __init__(self, broker: LocalBroker, queue_name: str, attributes: dict):
+        self.broker = broker
+        self.name = queue_name
+        self.attributes = attributes
+        self.url = FAKE_QUEUE_URL.format(queue_name)
+
+    def send_message(self, MessageBody, MessageGroupId=None, MessageAttributes=None, MessageDeduplicationId=None):
+        if MessageGroupId is None:
+            raise _client_error('SendMessage', 'The request must contain the parameter MessageGroupId.')
+
+        message_id = self.broker.send_message(self.name, MessageBody, MessageGroupId, MessageDeduplicationId)
+        return {'MessageId': message_id}
+
+    def send_messages(self, Entries):
+        if not 1 <= len(Entries) <= 10:
+            raise _client_error('SendMessageBatch', 'A batch must contain between 1 and 10 entries.')
+        if any('MessageGroupId' not in entry for entry in Entries):
+            raise _client_error('SendMessageBatch', 'The request must contain the parameter MessageGroupId.')
+
+        message_ids = self.broker.send_message_batch(
+            self.name,
+            [(entry['MessageBody'], entry['MessageGroupId'], entry.get('MessageDeduplicationId')) for entry in Entries]
+        )
+        return {
+            'Successful': [{'Id': entry['Id'], 'MessageId': message_id}
+                           for entry, message_id in zip(Entries, message_ids)],
+            'Failed': []
+        }
+
+    def delete(self):
+        self.broker.delete_queue(self.name)
+
+
+class FakeSQSResource:
+    """
+    Subset of the boto3 SQS resource, with queues kept in a LocalBroker instead of Amazon SQS.
+    """
+
+    def __init__(self, broker: LocalBroker):
+        self.broker = broker
+
+    def create_queue(self, QueueName, Attributes=None):
+        self.broker.create_queue(QueueName)
+        return FakeQueue(self.broker, QueueName, Attributes or {})
+
+
+class FakeSQSClient:
+    """
+    Subset of the boto3 SQS client, with queues kept in a LocalBroker instead of Amazon SQS.
+    It checks the same limits of the real service on the batch calls.
+    """
+
+    def __init__(self, broker: LocalBroker):
+        self.broker = broker
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, VisibilityTimeout=30, WaitTimeSeconds=0,
+                        AttributeNames=None, MessageAttributeNames=None):
+        if not 1 <= MaxNumberOfMessages <= 10:
+            raise _client_error('ReceiveMessage', 'MaxNumberOfMessages must be between 1 and 10.')
+        if not 0 <= WaitTimeSeconds <= 20:
+            raise _client_error('ReceiveMessage', 'WaitTimeSeconds must be between 0 and 20.')
+
+        messages = self.broker.receive_messages(queue_name_from_url(QueueUrl), MaxNumberOfMessages,
+                                                WaitTimeSeconds, VisibilityTimeout)
+        return {'Messages': messages} if messages else {}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self.broker.delete_message(queue_name_from_url(QueueUrl), ReceiptHandle)
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        if not 1 <= len(Entries) <= 10:
+            raise _client_error('DeleteMessageBatch', 'A batch must contain between 1 and 10 entries.')
+
+        self.broker.delete_message_batch(queue_name_from_url(QueueUrl), [entry['ReceiptHandle'] for entry in Entries])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+
+def create_fake_sqs(broker: LocalBroker = None):
+    """
+    :return: a (sqs_client, sqs_resource) pair sharing the same fake queues, to build a Connector without AWS.
+    """
+    broker = broker if broker is not None else LocalBroker()
+    return FakeSQSClient(broker), FakeSQSResource(broker)
@@ -0,0 +1,202 @@
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from multiprocessing.managers import BaseManager
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Shared import utils
+
+LOGGER = utils.get_logger(os.path.splitext(os.path.basename(__file__))[0])
+
+DEFAULT_ADDRESS = (r'\\.\pipe\self-tuning-ids-broker' if sys.platform == 'win32'
+                   else os.path.join(tempfile.gettempdir(), 'self-tuning-ids-broker.sock'))
+DEFAULT_AUTHKEY = b'self-tuning-ids'
+
+
+class _LocalQueue:
+
+    def __init__(self, name: str):
+        self.name = name
+        # (message_id, group_id, body, sent_timestamp) waiting to be received, in arrival order
+        self.messages = deque()
+        # receipt_handle -> (message, visible_again_at) for received but not deleted messages
+        self.in_flight = {}
+        # deduplication_id -> time it was accepted
+        self.dedup_ids = {}
+
+
+class LocalBroker:
+    """
+    Thread-safe FIFO queues with the same semantics of the Amazon SQS FIFO queues used by the components:
+    messages of a group are delivered in order and never while an earlier message of the group is in flight,
+    received messages become visible again if not deleted within the visibility timeout, and a message whose
+    deduplication id was accepted in the last five minutes is dropped.
+    """
+
+    DEDUPLICATION_INTERVAL = 300
+
+    def __init__(self):
+        self.__queues = {}
+        self.__condition = threading.Condition()
+
+    def create_queue(self, queue_name: str) -> str:
+        with self.__condition:
+            self.__queues.setdefault(queue_name, _LocalQueue(queue_name))
+        return queue_name
+
+    def delete_queue(self, queue_name: str):
+        with self.__condition:
+            self.__queues.pop(queue_name, None)
+
+    def send_message(self, queue_name: str, body: str, group_id: str, deduplication_id: str) -> str:
+        return self.send_message_batch(queue_name, [(body, group_id, deduplication_id)])[0]
+
+    def send_message_batch(self, queue_name: str, entries: list[tuple]) -> list[str]:
+        """
+        Appends (body, group_id, deduplication_id) entries to a queue, in order and atomically.
+        :return: the message id of each entry.
+        """
+        with self.__condition:
+            queue = self.__queues.setdefault(queue_name, _LocalQueue(queue_name))
+            now = time.monotonic()
+
+            for dedup_id, accepted_at in list(queue.dedup_ids.items()):
+                if now - accepted_at > self.DEDUPLICATION_INTERVAL:
+                    del queue.dedup_ids[dedup_id]
+
+            message_ids = []
+            for body, group_id, deduplication_id in entries:
+                message_id = str(uuid.uuid4())
+                message_ids.append(message_id)
+
+                # like SQS, a duplicate is acknowledged but not delivered a second time
+                if deduplication_id in queue.dedup_ids:
+                    continue
+
+                queue.dedup_ids[deduplication_id] = now
+                queue.messages.append((message_id, group_id, body, str(int(time.time() * 1000))))
+
+            self.__condition.notify_all()
+
+        return message_ids
+
+    def receive_messages(self, queue_name: str, max_messages: int = 1, wait_time: float = 0,
+                         visibility_timeout: float = 30) -> list[dict]:
+        deadline = time.monotonic() + wait_time
+
+        with self.__condition:
+            while True:
+                messages = self.__take(queue_name, max_messages, visibility_timeout)
+                remaining = deadline - time.monotonic()
+
+                if messages or remaining <= 0:
+                    return messages
+
+                # wake up at least once per second to make expired in-flight messages visible again
+                self.__condition.wait(timeout=min(remaining, 1.0))
+
+    def delete_message(self, queue_name: str, receipt_handle: str):
+        self.delete_message_batch(queue_name, [receipt_handle])
+
+    def delete_message_batch(self, queue_name: str, receipt_handles: list[str]):
+        with self.__condition:
+            queue = self.__queues.get(queue_name)
+            if queue is None:
+                return
+
+            deleted = [queue.in_flight.pop(handle, None) is not None for handle in receipt_handles]
+            if any(deleted):
+                # the next messages of the groups can now be delivered
+                self.__condition.notify_all()
+
+    def __take(self, queue_name: str, max_messages: int, visibility_timeout: float) -> list[dict]:
+        queue = self.__queues.get(queue_name)
+        if queue is None:
+            return []
+
+        now = time.monotonic()
+
+        # expired in-flight messages go back to the head of the queue, preserving their order
+        expired = [handle for handle, (_, visible_at) in queue.in_flight.items() if visible_at <= now]
+        for handle in reversed(expired):
+            message, _ = queue.in_flight.pop(handle)
+            queue.messages.appendleft(message)
+
+        locked_groups = {message[1] for message, _ in queue.in_flight.values()}
+        taken = []
+
+        for message in list(queue.messages):
+            if len(taken) >= max_messages:
+                break
+            if message[1] in locked_groups:
+                continue
+
+            queue.messages.remove(message)
+            taken.append(message)
+
+        received = []
+        for message in taken:
+            receipt_handle = str(uuid.uuid4())
+            queue.in_flight[receipt_handle] = (message, now + visibility_timeout)
+            received.append({'MessageId': message[0], 'ReceiptHandle': receipt_handle, 'Body': message[2],
+                             'Attributes': {'SentTimestamp': message[3]}})
+
+        return received
+
+
+class BrokerManager(BaseManager):
+    pass
+
+
+def serve_broker(address=DEFAULT_ADDRESS, authkey: bytes = DEFAULT_AUTHKEY):
+    """
+    Serves a LocalBroker on a Unix socket (a named pipe on Windows) until the process is interrupted.
+    """
+    broker = LocalBroker()
+    BrokerManager.register('get_broker', callable=lambda: broker)
+
+    if isinstance(address, str) and sys.platform != 'win32' and os.path.exists(address):
+        os.remove(address)
+
+    manager = BrokerManager(address=address, authkey=authkey)
+    server = manager.get_server()
+
+    LOGGER.info(f'Local broker listening on {address}.')
+    server.serve_forever()
+
+
+def connect_broker(address=DEFAULT_ADDRESS, authkey: bytes = DEFAULT_AUTHKEY):
+    """
+    Connects to a broker started with serve_broker and returns a proxy with the LocalBroker methods.
+    """
+    BrokerManager.register('get_broker')
+
+    manager = BrokerManager(address=address, authkey=authkey)
+    manager.connect()
+
+    return manager.get_broker()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local message broker for co-located components.')
+    parser.add_argument('-address',
+                        type=str,
+                        default=DEFAULT_ADDRESS,
+                        help='Specify the Unix socket path or named pipe to listen on (str)'
+                        )
+    args = parser.parse_args()
+
+    try:
+        serve_broker(args.address, os.environ.get('IDS_BROKER_AUTHKEY', DEFAULT_AUTHKEY.decode()).encode())
+    except KeyboardInterrupt:
+        LOGGER.debug('Received keyboard interrupt. Terminating local broker.')
+
+
+if __name__ == '__main__':
+    main()
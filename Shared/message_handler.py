@@ -1,24 +1,149 @@
+import os
+import threading
+import time
 from abc import ABC, abstractmethod
+from typing import Callable
 
-class MetricsMsgHandler(ABC):
+from Shared import messages, utils
+from Shared.msg_enum import msg_type
+
+LOGGER = utils.get_logger(os.path.splitext(os.path.basename(__file__))[0])
+
+
+class MessageHandler(ABC):
 
     @abstractmethod
-    def handle_metrics_msg(self, json_dict: dict):
+    def message_handlers(self) -> dict:
+        """
+        :return: the handler of each message type processed by this component.
+        """
         pass
 
-class SimpleMsgHandler(ABC):
+
+class MetricsMsgHandler(MessageHandler):
 
     @abstractmethod
-    def handle_models_update_msg(self, json_dict: dict):
+    def handle_metrics_msg(self, message):
         pass
 
+    def message_handlers(self) -> dict:
+        return {msg_type.METRICS_SNAPSHOT_MSG: self.handle_metrics_msg}
+
+
+class SimpleMsgHandler(MessageHandler):
+
+    @abstractmethod
+    def handle_models_update_msg(self, message):
+        pass
+
+    def message_handlers(self) -> dict:
+        return {msg_type.MODEL_UPDATE_MSG: self.handle_models_update_msg}
+
+
 class FullMsgHandler(SimpleMsgHandler):
 
     @abstractmethod
-    def handle_multiple_updates_msg(self, json_dict: dict):
+    def handle_multiple_updates_msg(self, message):
         pass
 
     @abstractmethod
-    def handle_objs_msg(self, json_dict: dict):
+    def handle_objs_msg(self, message):
         pass
 
+    def message_handlers(self) -> dict:
+        return {
+            **super().message_handlers(),
+            msg_type.MULTIPLE_UPDATE_MSG: self.handle_multiple_updates_msg,
+            msg_type.OBJECTIVES_MSG: self.handle_objs_msg
+        }
+
+
+class MessageDispatcher:
+    """
+    Registry of the handler of each message type. A message body is decoded once into its typed message
+    (see Shared.messages), then passed to the handler registered for its type. Malformed messages and messages
+    of types with no handler are rejected before reaching any handler.
+    The number of messages and the handling time of each type are recorded, and logged every LOG_EVERY messages.
+    """
+
+    LOG_EVERY = 100
+
+    def __init__(self, handlers: dict[msg_type, Callable] = None):
+        self.__handlers = {}
+        self.__lock = threading.Lock()
+        self.__stats = {}
+        self.__dispatched = 0
+
+        for message_type, handler in (handlers or {}).items():
+            self.register(message_type, handler)
+
+    @classmethod
+    def for_handler(cls, handler: MessageHandler):
+        return cls(handler.message_handlers())
+
+    def register(self, message_type: msg_type, handler: Callable):
+        if not isinstance(message_type, msg_type):
+            raise ValueError(f'Unknown message type: {message_type}')
+
+        self.__handlers[message_type] = handler
+
+    def dispatch(self, msg_body: str) -> bool:
+        """
+        Decodes a message body and runs the handler of its type. Errors of a handler are logged and counted,
+        they do not stop the dispatch of the next messages.
+        :return: whether the message has been handled successfully.
+        """
+        try:
+            message = messages.decode(msg_body)
+        except ValueError as e:
+            LOGGER.error(f'Rejected malformed message: {e}')
+            self.__record('MALFORMED', 0.0, rejected=True)
+            return False
+
+        handler = self.__handlers.get(message.MSG_TYPE)
+        if handler is None:
+            LOGGER.warning(f'Rejected message of type {message.MSG_TYPE}, no handler registered.')
+            self.__record(message.MSG_TYPE.value, 0.0, rejected=True)
+            return False
+
+        start = time.perf_counter()
+        try:
+            handler(message)
+            failed = False
+        except Exception:
+            LOGGER.exception(f'Handler of {message.MSG_TYPE} failed on {message}.')
+            failed = True
+
+        self.__record(message.MSG_TYPE.value, time.perf_counter() - start, failed=failed)
+        return not failed
+
+    def get_stats(self) -> dict:
+        """
+        :return: for each message type, the number of messages handled, failed and rejected, the total,
+                 mean and maximum handling time in seconds.
+        """
+        with self.__lock:
+            return {
+                message_type: dict(stats, mean_time=stats['time'] / stats['handled'] if stats['handled'] else 0.0)
+                for message_type, stats in self.__stats.items()
+            }
+
+    def __record(self, message_type: str, elapsed: float, failed: bool = False, rejected: bool = False):
+        with self.__lock:
+            stats = self.__stats.setdefault(
+                message_type, {'handled': 0, 'failed': 0, 'rejected': 0, 'time': 0.0, 'max_time': 0.0}
+            )
+
+            if rejected:
+                stats['rejected'] += 1
+            else:
+                stats['handled'] += 1
+                stats['failed'] += failed
+                stats['time'] += elapsed
+                stats['max_time'] = max(stats['max_time'], elapsed)
+
+            self.__dispatched += 1
+            log_now = self.__dispatched % self.LOG_EVERY == 0
+
+        if log_now:
+            LOGGER.info(f'Message handling stats: {self.get_stats()}')
@@ -0,0 +1,489 @@
+import base64
+import binascii
+import json
+import os
+import struct
+
+from Shared import utils
+from Shared.msg_enum import msg_type
+
+LOGGER = utils.get_logger(os.path.splitext(os.path.basename(__file__))[0])
+
+# 'binary' sends the compact encoding where a message supports it, 'json' always sends JSON.
+# Receivers decode both, so components can be switched one at a time.
+WIRE_FORMAT = os.environ.get('IDS_WIRE_FORMAT', 'binary').lower()
+
+# 1: initial layouts. 2: model version and correlation id on snapshots and objectives.
+# 3: rationale of the objectives. 4: instance id and confusion counts on snapshots.
+SCHEMA_VERSION = 4
+
+# header of the binary encoding: magic, schema version, message type code
+_HEADER = struct.Struct('<2sBB')
+_MAGIC = b'ID'
+
+METRIC_NAMES = ('accuracy', 'precision', 'fscore', 'tpr', 'fpr', 'tnr', 'fnr')
+# metrics the hypertuner has an optimizer for, the objectives worth requesting
+TUNABLE_METRIC_NAMES = ('accuracy', 'precision', 'tpr', 'fpr', 'tnr', 'fnr')
+CLASSIFICATION_METRIC_NAMES = ('normal_ratio', 'l1_anomaly_ratio', 'l2_anomaly_ratio', 'quarantined_ratio')
+CONFUSION_NAMES = ('tp', 'fp', 'tn', 'fn')
+
+
+class LayerMetrics:
+    __slots__ = METRIC_NAMES
+
+    def __init__(self, accuracy: float, precision: float, fscore: float, tpr: float, fpr: float, tnr: float,
+                 fnr: float):
+        self.accuracy = accuracy
+        self.precision = precision
+        self.fscore = fscore
+        self.tpr = tpr
+        self.fpr = fpr
+        self.tnr = tnr
+        self.fnr = fnr
+
+    def as_tuple(self) -> tuple:
+        return tuple(getattr(self, name) for name in METRIC_NAMES)
+
+    def as_dict(self) -> dict:
+        return dict(zip(METRIC_NAMES, self.as_tuple()))
+
+    @classmethod
+    def from_dict(cls, data: dict, name: str = 'metrics'):
+        try:
+            return cls(*(float(data[metric]) for metric in METRIC_NAMES))
+        except KeyError as e:
+            raise ValueError(f"Missing key in {name}: {e}")
+
+    def __repr__(self):
+        return f'LayerMetrics({self.as_dict()})'
+
+
+class ClassificationMetrics:
+    __slots__ = CLASSIFICATION_METRIC_NAMES
+
+    def __init__(self, normal_ratio: float, l1_anomaly_ratio: float, l2_anomaly_ratio: float,
+                 quarantined_ratio: float):
+        self.normal_ratio = normal_ratio
+        self.l1_anomaly_ratio = l1_anomaly_ratio
+        self.l2_anomaly_ratio = l2_anomaly_ratio
+        self.quarantined_ratio = quarantined_ratio
+
+    def as_tuple(self) -> tuple:
+        return tuple(getattr(self, name) for name in CLASSIFICATION_METRIC_NAMES)
+
+    def as_dict(self) -> dict:
+        return dict(zip(CLASSIFICATION_METRIC_NAMES, self.as_tuple()))
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        try:
+            return cls(*(float(data[metric]) for metric in CLASSIFICATION_METRIC_NAMES))
+        except KeyError as e:
+            raise ValueError(f"Missing key in classification_metrics: {e}")
+
+    def __repr__(self):
+        return f'ClassificationMetrics({self.as_dict()})'
+
+
+class ConfusionCounts:
+    __slots__ = CONFUSION_NAMES
+
+    def __init__(self, tp: int, fp: int, tn: int, fn: int):
+        self.tp = tp
+        self.fp = fp
+        self.tn = tn
+        self.fn = fn
+
+    def as_tuple(self) -> tuple:
+        return tuple(getattr(self, name) for name in CONFUSION_NAMES)
+
+    def as_dict(self) -> dict:
+        return dict(zip(CONFUSION_NAMES, self.as_tuple()))
+
+    @classmethod
+    def from_dict(cls, data: dict, name: str = 'counts'):
+        try:
+            return cls(*(int(data[count]) for count in CONFUSION_NAMES))
+        except KeyError as e:
+            raise ValueError(f"Missing key in {name}: {e}")
+
+    def __repr__(self):
+        return f'ConfusionCounts({self.as_dict()})'
+
+
+class MetricsSnapshotMsg:
+    """
+    Metrics of the two layers and classification ratios, sent by the detection system to the analyzer,
+    tagged with the version of the models that produced them and a correlation id. Snapshots also carry
+    the id of the detection system instance and the confusion counts of each layer, which the analyzer
+    pools across instances.
+    Binary payload: the 18 metrics as little-endian doubles, in the order of METRIC_NAMES and
+    CLASSIFICATION_METRIC_NAMES, then model version, correlation id and instance id as length-prefixed
+    strings, then a flag and, if set, the counts of both layers as unsigned 64-bit integers.
+    """
+    __slots__ = ('metrics_1', 'metrics_2', 'classification_metrics', 'model_version', 'correlation_id',
+                 'instance_id', 'counts_1', 'counts_2')
+
+    MSG_TYPE = msg_type.METRICS_SNAPSHOT_MSG
+    _PAYLOAD = struct.Struct(f'<{2 * len(METRIC_NAMES) + len(CLASSIFICATION_METRIC_NAMES)}d')
+    _HAS_COUNTS = struct.Struct('<B')
+    _COUNTS = struct.Struct(f'<{2 * len(CONFUSION_NAMES)}Q')
+
+    def __init__(self, metrics_1: LayerMetrics, metrics_2: LayerMetrics,
+                 classification_metrics: ClassificationMetrics, model_version: str = None,
+                 correlation_id: str = None, instance_id: str = None, counts_1: ConfusionCounts = None,
+                 counts_2: ConfusionCounts = None):
+        self.metrics_1 = metrics_1
+        self.metrics_2 = metrics_2
+        self.classification_metrics = classification_metrics
+        self.model_version = model_version
+        self.correlation_id = correlation_id
+        self.instance_id = instance_id
+        self.counts_1 = counts_1
+        self.counts_2 = counts_2
+
+    def has_counts(self) -> bool:
+        return self.counts_1 is not None and self.counts_2 is not None
+
+    def to_dict(self) -> dict:
+        return {
+            "MSG_TYPE": str(self.MSG_TYPE),
+            "metrics_1": self.metrics_1.as_dict(),
+            "metrics_2": self.metrics_2.as_dict(),
+            "classification_metrics": self.classification_metrics.as_dict(),
+            "model_version": self.model_version,
+            "correlation_id": self.correlation_id,
+            "instance_id": self.instance_id,
+            "counts_1": self.counts_1.as_dict() if self.counts_1 is not None else None,
+            "counts_2": self.counts_2.as_dict() if self.counts_2 is not None else None
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        try:
+            return cls(
+                LayerMetrics.from_dict(data["metrics_1"], 'metrics_1'),
+                LayerMetrics.from_dict(data["metrics_2"], 'metrics_2'),
+                ClassificationMetrics.from_dict(data["classification_metrics"]),
+                data.get("model_version"),
+                data.get("correlation_id"),
+                data.get("instance_id"),
+                ConfusionCounts.from_dict(data["counts_1"], 'counts_1') if data.get("counts_1") else None,
+                ConfusionCounts.from_dict(data["counts_2"], 'counts_2') if data.get("counts_2") else None
+            )
+        except KeyError as e:
+            raise ValueError(f"Missing key in JSON: {e}")
+
+    def to_bytes(self) -> bytes:
+        payload = (self._PAYLOAD.pack(*self.metrics_1.as_tuple(), *self.metrics_2.as_tuple(),
+                                      *self.classification_metrics.as_tuple())
+                   + _pack_str(self.model_version) + _pack_str(self.correlation_id) + _pack_str(self.instance_id))
+
+        if not self.has_counts():
+            return payload + self._HAS_COUNTS.pack(0)
+        return (payload + self._HAS_COUNTS.pack(1)
+                + self._COUNTS.pack(*self.counts_1.as_tuple(), *self.counts_2.as_tuple()))
+
+    @classmethod
+    def from_bytes(cls, payload: bytes, version: int = SCHEMA_VERSION):
+        values = cls._PAYLOAD.unpack_from(payload)
+        n = len(METRIC_NAMES)
+
+        model_version = correlation_id = None
+        if version >= 2:
+            model_version, offset = _unpack_str(payload, cls._PAYLOAD.size)
+            correlation_id, offset = _unpack_str(payload, offset)
+
+        instance_id = counts_1 = counts_2 = None
+        if version >= 4:
+            instance_id, offset = _unpack_str(payload, offset)
+            has_counts, = cls._HAS_COUNTS.unpack_from(payload, offset)
+            if has_counts:
+                counts = cls._COUNTS.unpack_from(payload, offset + cls._HAS_COUNTS.size)
+                counts_1 = ConfusionCounts(*counts[:len(CONFUSION_NAMES)])
+                counts_2 = ConfusionCounts(*counts[len(CONFUSION_NAMES):])
+
+        return cls(LayerMetrics(*values[:n]), LayerMetrics(*values[n:2 * n]), ClassificationMetrics(*values[2 * n:]),
+                   model_version, correlation_id, instance_id, counts_1, counts_2)
+
+    def __repr__(self):
+        return (f'MetricsSnapshotMsg({self.metrics_1}, {self.metrics_2}, {self.classification_metrics}, '
+                f'model_version={self.model_version!r}, correlation_id={self.correlation_id!r}, '
+                f'instance_id={self.instance_id!r}, counts_1={self.counts_1}, counts_2={self.counts_2})')
+
+
+class ObjectiveRationale:
+    """
+    Why the analyzer asks to improve a metric: the state of its change-point detector when it raised the alarm.
+    """
+    __slots__ = ('layer', 'metric', 'value', 'ewma', 'threshold', 'cusum', 'samples')
+
+    _LAYOUT = struct.Struct('<BBddddI')
+
+    def __init__(self, layer: int, metric: str, value: float, ewma: float, threshold: float, cusum: float,
+                 samples: int):
+        self.layer = layer
+        self.metric = metric
+        self.value = value
+        self.ewma = ewma
+        self.threshold = threshold
+        self.cusum = cusum
+        self.samples = samples
+
+    def as_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        try:
+            return cls(int(data['layer']), data['metric'], float(data['value']), float(data['ewma']),
+                       float(data['threshold']), float(data['cusum']), int(data['samples']))
+        except KeyError as e:
+            raise ValueError(f"Missing key in rationale: {e}")
+
+    def to_bytes(self) -> bytes:
+        return self._LAYOUT.pack(self.layer, METRIC_NAMES.index(self.metric), self.value, self.ewma,
+                                 self.threshold, self.cusum, self.samples)
+
+    @classmethod
+    def from_bytes(cls, payload: bytes, offset: int) -> tuple:
+        layer, metric, value, ewma, threshold, cusum, samples = cls._LAYOUT.unpack_from(payload, offset)
+        return cls(layer, METRIC_NAMES[metric], value, ewma, threshold, cusum, samples), offset + cls._LAYOUT.size
+
+    def __repr__(self):
+        return (f'ObjectiveRationale(layer{self.layer}.{self.metric}: value={self.value:.4f}, '
+                f'ewma={self.ewma:.4f}, threshold={self.threshold}, cusum={self.cusum:.2f}, '
+                f'samples={self.samples})')
+
+
+class ObjectivesMsg:
+    """
+    Metrics to improve on each layer, sent by the analyzer to the hypertuner, with the model version and the
+    correlation id of the snapshot they come from, and the rationale of each objective.
+    Binary payload: one bitmask per layer over METRIC_NAMES, then model version and correlation id as
+    length-prefixed strings, then the number of rationales and each of them.
+    """
+    __slots__ = ('objs_layer1', 'objs_layer2', 'model_version', 'correlation_id', 'rationale')
+
+    MSG_TYPE = msg_type.OBJECTIVES_MSG
+    _PAYLOAD = struct.Struct('<BB')
+    _COUNT = struct.Struct('<B')
+
+    def __init__(self, objs_layer1: list[str] = None, objs_layer2: list[str] = None, model_version: str = None,
+                 correlation_id: str = None, rationale: list[ObjectiveRationale] = None):
+        self.objs_layer1 = objs_layer1 if objs_layer1 is not None else []
+        self.objs_layer2 = objs_layer2 if objs_layer2 is not None else []
+        self.model_version = model_version
+        self.correlation_id = correlation_id
+        self.rationale = rationale if rationale is not None else []
+
+    def is_empty(self) -> bool:
+        return not self.objs_layer1 and not self.objs_layer2
+
+    def to_dict(self) -> dict:
+        return {
+            "MSG_TYPE": str(self.MSG_TYPE),
+            "objs_layer1": list(self.objs_layer1),
+            "objs_layer2": list(self.objs_layer2),
+            "model_version": self.model_version,
+            "correlation_id": self.correlation_id,
+            "rationale": [rationale.as_dict() for rationale in self.rationale]
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(list(data.get("objs_layer1", [])), list(data.get("objs_layer2", [])),
+                   data.get("model_version"), data.get("correlation_id"),
+                   [ObjectiveRationale.from_dict(rationale) for rationale in data.get("rationale", [])])
+
+    def to_bytes(self) -> bytes:
+        # raises ValueError for metrics outside METRIC_NAMES, which are then sent as JSON
+        return (self._PAYLOAD.pack(_to_bitmask(self.objs_layer1), _to_bitmask(self.objs_layer2))
+                + _pack_str(self.model_version) + _pack_str(self.correlation_id)
+                + self._COUNT.pack(len(self.rationale))
+                + b''.join(rationale.to_bytes() for rationale in self.rationale))
+
+    @classmethod
+    def from_bytes(cls, payload: bytes, version: int = SCHEMA_VERSION):
+        mask_1, mask_2 = cls._PAYLOAD.unpack_from(payload)
+
+        model_version = correlation_id = None
+        if version >= 2:
+            model_version, offset = _unpack_str(payload, cls._PAYLOAD.size)
+            correlation_id, offset = _unpack_str(payload, offset)
+
+        rationale = []
+        if version >= 3:
+            count, = cls._COUNT.unpack_from(payload, offset)
+            offset += cls._COUNT.size
+            for _ in range(count):
+                entry, offset = ObjectiveRationale.from_bytes(payload, offset)
+                rationale.append(entry)
+
+        return cls(_from_bitmask(mask_1), _from_bitmask(mask_2), model_version, correlation_id, rationale)
+
+    def __repr__(self):
+        return (f'ObjectivesMsg(layer1={self.objs_layer1}, layer2={self.objs_layer2}, '
+                f'model_version={self.model_version!r}, correlation_id={self.correlation_id!r}, '
+                f'rationale={self.rationale})')
+
+
+class ModelUpdateMsg:
+    """
+    Notification that new models are available on S3.
+    Binary payload: the sender as a length-prefixed UTF-8 string.
+    """
+    __slots__ = ('sender',)
+
+    MSG_TYPE = msg_type.MODEL_UPDATE_MSG
+
+    def __init__(self, sender: str):
+        self.sender = sender
+
+    def to_dict(self) -> dict:
+        return {
+            "MSG_TYPE": str(self.MSG_TYPE),
+            "SENDER": self.sender
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(data.get("SENDER"))
+
+    def to_bytes(self) -> bytes:
+        return _pack_str(self.sender)
+
+    @classmethod
+    def from_bytes(cls, payload: bytes, version: int = SCHEMA_VERSION):
+        sender, _ = _unpack_str(payload, 0)
+        return cls(sender)
+
+    def __repr__(self):
+        return f'ModelUpdateMsg(sender={self.sender!r})'
+
+
+class MultipleUpdateMsg:
+    """
+    Notification that some of the objects on S3 have been updated. Always sent as JSON.
+    """
+    __slots__ = ('update', 'sender')
+
+    MSG_TYPE = msg_type.MULTIPLE_UPDATE_MSG
+
+    def __init__(self, update: list[str], sender: str):
+        self.update = update
+        self.sender = sender
+
+    def to_dict(self) -> dict:
+        return {
+            "MSG_TYPE": str(self.MSG_TYPE),
+            "UPDATE": list(self.update),
+            "SENDER": self.sender
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        try:
+            return cls(list(data["UPDATE"]), data.get("SENDER"))
+        except KeyError as e:
+            raise ValueError(f"Missing key in JSON: {e}")
+
+    def __repr__(self):
+        return f'MultipleUpdateMsg(update={self.update}, sender={self.sender!r})'
+
+
+# type code of the binary header of each message class, never reuse a code
+_TYPE_CODES = {
+    ModelUpdateMsg: 1,
+    MetricsSnapshotMsg: 3,
+    ObjectivesMsg: 4,
+}
+_CLASSES_BY_CODE = {code: cls for cls, code in _TYPE_CODES.items()}
+_CLASSES_BY_TYPE = {str(cls.MSG_TYPE): cls for cls in (ModelUpdateMsg, MetricsSnapshotMsg, ObjectivesMsg,
+                                                       MultipleUpdateMsg)}
+
+
+def encode(message) -> str:
+    """
+    Encodes a message for the body of an SQS message. Message objects with a binary layout are sent as
+    base64 text of the binary encoding when WIRE_FORMAT is 'binary', everything else as JSON.
+    Plain dictionaries and other JSON values are sent as JSON, as before.
+    """
+    if not hasattr(message, 'to_dict'):
+        return json.dumps(message)
+
+    if WIRE_FORMAT == 'binary' and type(message) in _TYPE_CODES:
+        try:
+            payload = _HEADER.pack(_MAGIC, SCHEMA_VERSION, _TYPE_CODES[type(message)]) + message.to_bytes()
+            return base64.b64encode(payload).decode('ascii')
+        except (ValueError, struct.error) as e:
+            LOGGER.debug(f'Cannot encode {message} in binary, falling back to JSON: {e}')
+
+    return json.dumps(message.to_dict())
+
+
+def decode(body: str):
+    """
+    Decodes the body of a message sent by any component, in either encoding, into a message object.
+    :raises ValueError: if the body is malformed, of an unknown type or of a newer schema version.
+    """
+    if body.lstrip().startswith('{'):
+        data = json.loads(body)
+
+        message_type = data.get('MSG_TYPE')
+        # a type that is not a string, e.g. a list, is as unknown as a misspelled one
+        cls = _CLASSES_BY_TYPE.get(message_type) if isinstance(message_type, str) else None
+        if cls is None:
+            raise ValueError(f'Unknown message type: {message_type!r}')
+
+        # fields of the wrong type fail in from_dict with any of these, they are malformed messages all the same
+        try:
+            return cls.from_dict(data)
+        except (TypeError, KeyError, AttributeError) as e:
+            raise ValueError(f'Malformed {message_type} message: {e!r}')
+
+    try:
+        payload = base64.b64decode(body, validate=True)
+        magic, version, type_code = _HEADER.unpack_from(payload)
+    except (binascii.Error, struct.error) as e:
+        raise ValueError(f'Malformed message body: {e}')
+
+    if magic != _MAGIC:
+        raise ValueError('Malformed message body: bad magic.')
+    if version > SCHEMA_VERSION:
+        raise ValueError(f'Unsupported schema version {version}, this component reads up to {SCHEMA_VERSION}.')
+    if type_code not in _CLASSES_BY_CODE:
+        raise ValueError(f'Unknown message type code: {type_code}')
+
+    try:
+        return _CLASSES_BY_CODE[type_code].from_bytes(payload[_HEADER.size:], version)
+    except (struct.error, UnicodeDecodeError, IndexError) as e:
+        raise ValueError(f'Malformed message payload: {e}')
+
+
+def _to_bitmask(metrics: list[str]) -> int:
+    mask = 0
+    for metric in metrics:
+        mask |= 1 << METRIC_NAMES.index(metric)
+    return mask
+
+
+def _from_bitmask(mask: int) -> list[str]:
+    return [metric for i, metric in enumerate(METRIC_NAMES) if mask & (1 << i)]
+
+
+def _pack_str(value: str) -> bytes:
+    # None and the empty string are both sent as a zero length string and read back as None
+    encoded = (value or '').encode('utf-8')
+    return struct.pack('<B', len(encoded)) + encoded
+
+
+def _unpack_str(payload: bytes, offset: int) -> tuple:
+    """
+    :return: the string at offset, None if empty, and the offset right after it.
+    """
+    (length,) = struct.unpack_from('<B', payload, offset)
+    end = offset + 1 + length
+    if len(payload) < end:
+        raise struct.error('string shorter than its length prefix')
+    return payload[offset + 1:end].decode('utf-8') or None, end
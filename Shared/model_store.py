@@ -0,0 +1,117 @@
+import hashlib
+import os
+import time
+
+import joblib
+import numpy as np
+from sklearn.svm._base import BaseLibSVM
+
+from Shared import utils
+
+LOGGER = utils.get_logger(os.path.splitext(os.path.basename(__file__))[0])
+
+
+def save_model(model, path: str):
+    """
+    Persists a model with joblib, uncompressed, so that its NumPy arrays (support vectors, dual coefficients,
+    tree node arrays, ...) are written as raw buffers that load_model can memory map.
+    The file is written next to its destination and then moved, so readers never see a partial model.
+    """
+    start = time.perf_counter()
+
+    tmp_path = path + '.tmp'
+    joblib.dump(model, tmp_path, compress=0)
+    os.replace(tmp_path, path)
+
+    LOGGER.info(f'Saved model {type(model).__name__} to {path} in {time.perf_counter() - start:.3f}s.')
+
+
+def load_model(path: str, mmap: bool = True):
+    """
+    Loads a model saved with save_model. With mmap, the arrays stored in the file are mapped read-only instead
+    of being copied, so every process loading the same file shares them through the page cache.
+    Files written with plain pickle are still loaded, without memory mapping.
+    libsvm writes into the arrays of SVMs when predicting probabilities, so those are copied to private memory,
+    including the ones of SVMs within ensembles and pipelines.
+    :param path: path of the model file.
+    :param mmap: whether to memory map the arrays of the model.
+    :return: the loaded model.
+    """
+    start = time.perf_counter()
+
+    model = joblib.load(path, mmap_mode='r' if mmap else None)
+    if mmap:
+        copy_svm_mapped_arrays(model)
+
+    LOGGER.info(f'Loaded model {type(model).__name__} from {path} in {time.perf_counter() - start:.3f}s, '
+                f'{count_mapped_arrays(model)} array(s) memory mapped.')
+
+    return model
+
+
+def models_version(*paths: str) -> str:
+    """
+    Version of a set of model files, a digest of their content: the same models always have the same version,
+    wherever and whenever they are loaded.
+    """
+    digest = hashlib.sha256()
+
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+
+    return digest.hexdigest()[:12]
+
+
+def copy_mapped_arrays(model):
+    """
+    Replaces the memory mapped array attributes of a model with writeable copies.
+    """
+    for name, value in vars(model).items():
+        if isinstance(value, np.memmap):
+            setattr(model, name, np.array(value))
+
+
+def copy_svm_mapped_arrays(model, visited: set = None):
+    """
+    Copies the memory mapped arrays of the SVMs of a model: the model itself, or any estimator it holds in its
+    attributes, such as the estimators_ of an ensemble or the steps of a pipeline.
+    """
+    visited = set() if visited is None else visited
+    if id(model) in visited:
+        return
+    visited.add(id(model))
+
+    if isinstance(model, BaseLibSVM):
+        copy_mapped_arrays(model)
+        return
+
+    if isinstance(model, dict):
+        values = model.values()
+    elif isinstance(model, (list, tuple)):
+        values = model
+    elif hasattr(model, '__dict__') and not isinstance(model, np.ndarray):
+        values = vars(model).values()
+    else:
+        return
+
+    for value in values:
+        if isinstance(value, (dict, list, tuple)) or hasattr(value, 'get_params'):
+            copy_svm_mapped_arrays(value, visited)
+
+
+def count_mapped_arrays(model) -> int:
+    """
+    Counts the memory mapped arrays among the attributes of a model and of its sub-estimators.
+    Note that scikit-learn trees copy their node arrays when unpickled, so only plain array attributes count.
+    """
+    count = 0
+
+    for value in vars(model).values():
+        if isinstance(value, np.memmap):
+            count += 1
+        elif isinstance(value, (list, tuple)):
+            count += sum(count_mapped_arrays(item) for item in value if hasattr(item, '__dict__'))
+
+    return count
@@ -0,0 +1,260 @@
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from Shared import utils
+from Shared.messages import encode as encode_message
+from Shared.sqs_wrapper import Connector, MAX_BATCH_SIZE
+
+LOGGER = utils.get_logger(os.path.splitext(os.path.basename(__file__))[0])
+
+
+def default_journal_path(component: str, instance_id: str = None) -> str:
+    """
+    Journal of a component, distinct for each instance id: replicas started in the same directory must not
+    share a journal, or each of them would send the messages queued by the others.
+    :param component: name of the process, e.g. 'analyzer'.
+    :param instance_id: id of the replica, stable across restarts for its pending messages to be recovered.
+    :return: the path of the journal, relative to the working directory.
+    """
+    name = component if instance_id is None else f'{component}-{instance_id}'
+    return f'outbox_{re.sub(r"[^A-Za-z0-9_.-]", "_", name)}.jsonl'
+
+
+class Outbox:
+    """
+    Durable queue of the messages sent by a component. send appends the message to a local journal and returns
+    immediately, a background thread delivers it through the Connector and retries with exponential backoff
+    until it succeeds. Messages still in the journal when the process stops are sent at the next start.
+
+    Each message gets its deduplication id when it is journaled and keeps it across retries and restarts,
+    so a message whose send succeeded but was not acknowledged in the journal is not delivered twice
+    (within the five minutes deduplication interval of SQS FIFO queues).
+
+    The journal is a file of JSON lines: {"op": "add", ...} when a message is queued, {"op": "ack", "id": ...}
+    when it has been sent. It is rewritten with the pending messages only once enough acks have accumulated.
+    """
+
+    COMPACT_AFTER = 1000
+
+    def __init__(self, connector: Connector, journal_path: str, base_delay: float = 0.5, max_delay: float = 60,
+                 fsync: bool = True):
+        """
+        :param connector: connector with the queues to send to.
+        :param journal_path: path of the journal file, created if missing.
+        :param base_delay: delay before the first retry of a failed send, doubled at each further failure.
+        :param max_delay: maximum delay between two retries.
+        :param fsync: whether each queued message is flushed to disk before send returns.
+        """
+        self.connector = connector
+        self.journal_path = journal_path
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.fsync = fsync
+
+        self.__condition = threading.Condition()
+        # entry_id -> entry, in the order messages have been queued
+        self.__pending = OrderedDict()
+        self.__acks_since_compaction = 0
+        self.__closed = False
+
+        self.__stats = {'queued': 0, 'sent': 0, 'failed_attempts': 0, 'latency': 0.0, 'max_latency': 0.0}
+
+        self.__recover()
+        self.__journal = open(self.journal_path, 'a', encoding='utf-8')
+
+        self.__thread = threading.Thread(target=self.__run, name='outbox-sender', daemon=True)
+        self.__thread.start()
+
+    def send(self, message_body, queue_names: list[str] = None):
+        """
+        Queues a message for the given queues, all the queues of the connector by default, like
+        Connector.send_message_to_queues. Returns as soon as the message is in the journal.
+        """
+        body = encode_message(message_body)
+        queued_at = time.time()
+
+        with self.__condition:
+            if self.__closed:
+                raise RuntimeError('The outbox has been closed.')
+
+            for queue_name in queue_names if queue_names is not None else self.connector.queue_names:
+                entry = {
+                    'op': 'add',
+                    'id': uuid.uuid4().hex,
+                    'queue': queue_name,
+                    'body': body,
+                    'dedup': uuid.uuid4().hex,
+                    'queued_at': queued_at
+                }
+                self.__journal.write(json.dumps(entry) + '\n')
+                self.__pending[entry['id']] = entry
+                self.__stats['queued'] += 1
+
+            self.__journal.flush()
+            if self.fsync:
+                os.fsync(self.__journal.fileno())
+
+            self.__condition.notify()
+
+    def depth(self) -> int:
+        """
+        :return: the number of messages waiting to be sent.
+        """
+        with self.__condition:
+            return len(self.__pending)
+
+    def get_stats(self) -> dict:
+        """
+        :return: the queue depth, the number of messages queued and sent, of failed send attempts, and the
+                 mean and maximum seconds between queuing and sending a message.
+        """
+        with self.__condition:
+            stats = dict(self.__stats, depth=len(self.__pending))
+
+        stats['mean_latency'] = stats.pop('latency') / stats['sent'] if stats['sent'] else 0.0
+        return stats
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Waits until every queued message has been sent.
+        :return: False if messages are still pending after timeout seconds.
+        """
+        with self.__condition:
+            return self.__condition.wait_for(lambda: not self.__pending, timeout=timeout)
+
+    def close(self, timeout: float = 5):
+        """
+        Stops the sender after trying to deliver the pending messages for at most timeout seconds,
+        the ones left are sent at the next start.
+        """
+        self.flush(timeout)
+
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+        self.__thread.join()
+        self.__journal.close()
+        self.__compact()
+
+        if self.depth():
+            LOGGER.warning(f'{self.depth()} message(s) left in the outbox journal {self.journal_path}.')
+
+    def __recover(self):
+        if not os.path.exists(self.journal_path):
+            return
+
+        with open(self.journal_path, 'r', encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a partial line, written when the process stopped
+                    continue
+
+                if record['op'] == 'add':
+                    self.__pending[record['id']] = record
+                elif record['op'] == 'ack':
+                    self.__pending.pop(record['id'], None)
+
+        unknown = [entry_id for entry_id, entry in self.__pending.items()
+                   if entry['queue'] not in self.connector.queues]
+        for entry_id in unknown:
+            LOGGER.error(f"Dropping journaled message for unknown queue '{self.__pending.pop(entry_id)['queue']}'.")
+
+        if self.__pending:
+            LOGGER.info(f'Recovered {len(self.__pending)} unsent message(s) from {self.journal_path}.')
+
+        self.__compact()
+
+    def __compact(self):
+        # rewrite the journal with the pending messages only
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as journal:
+            for entry in self.__pending.values():
+                journal.write(json.dumps(entry) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        os.replace(tmp_path, self.journal_path)
+        self.__acks_since_compaction = 0
+
+    def __next_batch(self):
+        # the oldest pending message and the ones after it for the same queue, up to a batch
+        first = next(iter(self.__pending.values()))
+        return [entry for entry in self.__pending.values() if entry['queue'] == first['queue']][:MAX_BATCH_SIZE]
+
+    def __run(self):
+        failures = 0
+
+        while True:
+            with self.__condition:
+                while not self.__pending and not self.__closed:
+                    self.__condition.wait()
+
+                if self.__closed:
+                    return
+
+                batch = self.__next_batch()
+
+            try:
+                message_ids = self.connector.send_encoded_batch(
+                    batch[0]['queue'],
+                    [entry['body'] for entry in batch],
+                    [entry['dedup'] for entry in batch]
+                )
+            except Exception as e:
+                LOGGER.error(f"Could not send {len(batch)} message(s) to '{batch[0]['queue']}': {e}")
+                message_ids = [None] * len(batch)
+
+            # messages of a FIFO queue are delivered in order: stop at the first one that was not sent
+            sent = []
+            for entry, message_id in zip(batch, message_ids):
+                if message_id is None:
+                    break
+                sent.append(entry)
+
+            self.__ack(sent)
+
+            if len(sent) < len(batch):
+                failures += 1
+                with self.__condition:
+                    self.__stats['failed_attempts'] += 1
+
+                    # full jitter, so that restarted components do not retry in lockstep
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (failures - 1)))
+                    self.__condition.wait_for(lambda: self.__closed, timeout=delay)
+            else:
+                failures = 0
+
+    def __ack(self, entries: list[dict]):
+        if not entries:
+            return
+
+        now = time.time()
+
+        with self.__condition:
+            for entry in entries:
+                self.__journal.write(json.dumps({'op': 'ack', 'id': entry['id']}) + '\n')
+                del self.__pending[entry['id']]
+
+                latency = now - entry['queued_at']
+                self.__stats['sent'] += 1
+                self.__stats['latency'] += latency
+                self.__stats['max_latency'] = max(self.__stats['max_latency'], latency)
+
+            self.__journal.flush()
+            self.__acks_since_compaction += len(entries)
+
+            if self.__acks_since_compaction >= self.COMPACT_AFTER:
+                self.__journal.close()
+                self.__compact()
+                self.__journal = open(self.journal_path, 'a', encoding='utf-8')
+
+            self.__condition.notify_all()
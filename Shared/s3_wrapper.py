@@ -4,7 +4,7 @@ import joblib
 import numpy as np
 import pandas as pd
 
-from Shared import utils
+from Shared import model_store, utils
 
 LOGGER = utils.get_logger(os.path.splitext(os.path.basename(__file__))[0])
 
@@ -197,10 +197,15 @@ class Loader:
 
     @staticmethod
     def load_models(model1, model2):
-        model1 = joblib.load(f'AWS Downloads/Models/ModelsToUse/{model1}')
-        model2 = joblib.load(f'AWS Downloads/Models/ModelsToUse/{model2}')
+        model1 = model_store.load_model(f'AWS Downloads/Models/ModelsToUse/{model1}')
+        model2 = model_store.load_model(f'AWS Downloads/Models/ModelsToUse/{model2}')
         return model1, model2
 
+    @staticmethod
+    def models_version(model1, model2):
+        return model_store.models_version(f'AWS Downloads/Models/ModelsToUse/{model1}',
+                                          f'AWS Downloads/Models/ModelsToUse/{model2}')
+
     @staticmethod
     def load_encoders(ohe1_file, ohe2_file):
         ohe1 = joblib.load(f'AWS Downloads/OneHotEncoders/{ohe1_file}')
@@ -0,0 +1,161 @@
+import json
+import os
+import tempfile
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from Shared import utils
+
+LOGGER = utils.get_logger(os.path.splitext(os.path.basename(__file__))[0])
+
+# /dev/shm is memory backed on Linux, elsewhere the page cache of the temp folder is shared as well
+DEFAULT_ROOT = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'self_tuning_ids')
+
+
+class SharedDataset:
+    """
+    A published version of a dataset. Each array is a read-only memory map of the published file,
+    so every process attached to the same version shares the same physical pages.
+    """
+
+    def __init__(self, name: str, version: int, arrays: dict[str, np.ndarray], columns: dict[str, list]):
+        self.name = name
+        self.version = version
+        self.arrays = arrays
+        self.columns = columns
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        return self.arrays[key]
+
+    def as_dataframe(self, key: str) -> pd.DataFrame:
+        """
+        Wraps a 2D array in a DataFrame without copying it, using the published column names if any.
+        """
+        return pd.DataFrame(self.arrays[key], columns=self.columns.get(key), copy=False)
+
+
+class SharedDatasetRegistry:
+    """
+    Registry of named datasets exchanged between processes on the same host through memory mapped .npy files.
+
+    A publisher writes every array of a new version to its own files and then atomically replaces the manifest
+    of the dataset, so readers always see one complete version: the one they attached to keeps being valid
+    until they drop it, while later attach calls get the new one.
+    Only one process (the KnowledgeBase) is expected to publish a given dataset.
+    """
+
+    KEEP_VERSIONS = 2
+
+    def __init__(self, root: str = DEFAULT_ROOT):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def __manifest_path(self, name: str) -> str:
+        return os.path.join(self.root, f'{name}.json')
+
+    def __read_manifest(self, name: str) -> Optional[dict]:
+        try:
+            with open(self.__manifest_path(name), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def current_version(self, name: str) -> Optional[int]:
+        manifest = self.__read_manifest(name)
+        return manifest['version'] if manifest is not None else None
+
+    def publish(self, name: str, arrays: dict, columns: dict[str, list] = None) -> int:
+        """
+        Publishes a new version of a dataset.
+        :param name: dataset name, e.g. 'KDDTrain+_l1_pca'.
+        :param arrays: arrays of the dataset by key, DataFrames are stored with their column names.
+        :param columns: optional column names by key for plain arrays.
+        :return: the published version number.
+        """
+        columns = dict(columns or {})
+        version = (self.current_version(name) or 0) + 1
+
+        files = {}
+        for key, array in arrays.items():
+            if isinstance(array, pd.DataFrame):
+                columns.setdefault(key, [str(column) for column in array.columns])
+
+            array = np.ascontiguousarray(array)
+            if array.dtype == object:
+                raise ValueError(f'Array {key} of dataset {name} has object dtype and cannot be memory mapped.')
+
+            file_name = f'{name}.v{version}.{key}.npy'
+            tmp_path = os.path.join(self.root, file_name + '.tmp')
+            with open(tmp_path, 'wb') as f:
+                np.save(f, array, allow_pickle=False)
+            os.replace(tmp_path, os.path.join(self.root, file_name))
+
+            files[key] = file_name
+
+        manifest = {
+            'version': version,
+            'files': files,
+            'columns': columns
+        }
+
+        tmp_manifest = self.__manifest_path(name) + '.tmp'
+        with open(tmp_manifest, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_manifest, self.__manifest_path(name))
+
+        LOGGER.info(f'Published version {version} of dataset {name} with arrays {list(files)}.')
+        self.__remove_old_versions(name, version)
+
+        return version
+
+    def attach(self, name: str) -> Optional[SharedDataset]:
+        """
+        Attaches read-only to the current version of a dataset.
+        :return: the shared dataset, or None if the dataset was never published.
+        """
+        manifest = self.__read_manifest(name)
+        if manifest is None:
+            return None
+
+        arrays = {
+            key: np.load(os.path.join(self.root, file_name), mmap_mode='r', allow_pickle=False)
+            for key, file_name in manifest['files'].items()
+        }
+
+        LOGGER.debug(f'Attached to version {manifest["version"]} of dataset {name}.')
+        return SharedDataset(name, manifest['version'], arrays, manifest.get('columns', {}))
+
+    def is_current(self, dataset: SharedDataset) -> bool:
+        return self.current_version(dataset.name) == dataset.version
+
+    def remove(self, name: str):
+        """
+        Removes every version of a dataset, readers still attached keep their memory maps.
+        """
+        try:
+            os.remove(self.__manifest_path(name))
+        except FileNotFoundError:
+            pass
+
+        self.__remove_old_versions(name, float('inf'))
+
+    def __remove_old_versions(self, name: str, version: int):
+        prefix = f'{name}.v'
+
+        for file_name in os.listdir(self.root):
+            if not file_name.startswith(prefix) or not file_name.endswith('.npy'):
+                continue
+
+            try:
+                file_version = int(file_name[len(prefix):].split('.', 1)[0])
+            except ValueError:
+                continue
+
+            if file_version <= version - self.KEEP_VERSIONS:
+                try:
+                    # readers still mapping the file keep their pages, the name is only unlinked
+                    os.remove(os.path.join(self.root, file_name))
+                except OSError:
+                    LOGGER.debug(f'Could not remove {file_name} yet, it is still in use.')
@@ -0,0 +1,124 @@
+import os
+import re
+import sqlite3
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+
+from Shared import utils
+
+LOGGER = utils.get_logger(os.path.splitext(os.path.basename(__file__))[0])
+
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_+]*$')
+
+
+def quote_identifier(name: str) -> str:
+    """
+    Quotes a table or column name so that it can be safely interpolated in a SQL statement.
+    :param name: table or column name.
+    :return: the double-quoted identifier.
+    """
+    if not isinstance(name, str) or not _IDENTIFIER.match(name):
+        raise ValueError(f'Invalid SQL identifier: {name!r}')
+
+    return f'"{name}"'
+
+
+def build_query(received: dict) -> tuple[str, list]:
+    """
+    Builds a SELECT statement and its bound parameters from a query dictionary.
+
+    Supported keys:
+        - "select": "*", a raw select clause, or a list of column names to project.
+        - "from": the table name.
+        - "where": optional where clause, using '?' placeholders for values.
+        - "params": optional list of values bound to the where placeholders.
+        - "limit" / "offset": optional row range, bound as parameters.
+
+    :param received: query dictionary.
+    :return: the SQL statement and the list of parameters to bind.
+    """
+    select_clause = received.get("select", "*")
+    from_clause = received.get("from")
+    where_clause = received.get("where")
+
+    if isinstance(select_clause, (list, tuple)):
+        select_clause = ', '.join(quote_identifier(column) for column in select_clause)
+
+    sql_query = f'SELECT {select_clause} FROM {quote_identifier(from_clause)}'
+    params = list(received.get("params", []))
+
+    if where_clause is not None:
+        sql_query += f' WHERE {where_clause}'
+
+    limit = received.get("limit")
+    offset = received.get("offset")
+
+    if limit is not None or offset is not None:
+        # SQLite requires a LIMIT clause for OFFSET, -1 means no upper bound
+        sql_query += ' ORDER BY rowid LIMIT ? OFFSET ?'
+        params += [int(limit) if limit is not None else -1, int(offset) if offset is not None else 0]
+
+    return sql_query, params
+
+
+def read_query(connection: sqlite3.Connection, received: dict) -> pd.DataFrame:
+    """
+    Executes a query dictionary and materializes the whole result as a DataFrame.
+    """
+    sql_query, params = build_query(received)
+    LOGGER.debug(f'Executing the query: {sql_query} with parameters {params}')
+
+    return pd.read_sql_query(sql_query, connection, params=params)
+
+
+def iter_query_chunks(connection: sqlite3.Connection, received: dict, chunk_size: int = 10000,
+                      dtype=np.float64) -> Iterator[np.ndarray]:
+    """
+    Executes a query dictionary and streams the result in fixed-size chunks, so that at most
+    chunk_size rows are held in memory at once.
+    :param connection: sqlite3 connection to run the query on.
+    :param received: query dictionary, see build_query.
+    :param chunk_size: maximum number of rows in each yielded chunk.
+    :param dtype: dtype of the yielded arrays, use object for tables with text columns.
+    :return: generator of 2D NumPy arrays of shape (<= chunk_size, n_columns).
+    """
+    if chunk_size <= 0:
+        raise ValueError('chunk_size must be a positive integer.')
+
+    sql_query, params = build_query(received)
+    LOGGER.debug(f'Streaming the query: {sql_query} in chunks of {chunk_size} rows.')
+
+    # use a dedicated cursor so that concurrent queries on the connection do not interfere
+    cursor = connection.cursor()
+    try:
+        cursor.execute(sql_query, params)
+        n_columns = len(cursor.description)
+
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+
+            yield np.array(rows, dtype=dtype).reshape(len(rows), n_columns)
+    finally:
+        cursor.close()
+
+
+def query_columns(connection: sqlite3.Connection, table_name: str) -> list[str]:
+    """
+    Returns the column names of a table without reading any of its rows.
+    """
+    cursor = connection.execute(f'SELECT * FROM {quote_identifier(table_name)} LIMIT 0')
+    try:
+        return [description[0] for description in cursor.description]
+    finally:
+        cursor.close()
+
+
+def query_row_count(connection: sqlite3.Connection, table_name: str) -> int:
+    """
+    Returns the number of rows of a table, to size the arrays its chunks are read into.
+    """
+    return connection.execute(f'SELECT COUNT(*) FROM {quote_identifier(table_name)}').fetchone()[0]
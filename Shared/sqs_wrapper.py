@@ -1,37 +1,84 @@
-import json
 import os
 import random
 import string
-from typing import List
+import threading
+import time
+from collections import deque
+from queue import Queue, Empty, Full
+from typing import Callable, List, Optional
 
 from Shared import utils
+from Shared.messages import encode as encode_message
+from Shared.transports import Transport, SQSTransport, queue_name_from_url
 from botocore.exceptions import ClientError
 
 
 LOGGER = utils.get_logger(os.path.splitext(os.path.basename(__file__))[0])
 
+# Amazon SQS limits for a single batch call
+MAX_BATCH_SIZE = 10
+MAX_BATCH_BYTES = 262144
+
+
+class ConnectorStats:
+    """
+    Per-operation counters of the calls made by a Connector to its transport.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__stats = {}
+
+    def record(self, operation: str, elapsed: float, n_messages: int = 0):
+        with self.__lock:
+            stats = self.__stats.setdefault(operation, {'calls': 0, 'messages': 0, 'empty_calls': 0, 'time': 0.0,
+                                                        'max_time': 0.0})
+            stats['calls'] += 1
+            stats['messages'] += n_messages
+            stats['empty_calls'] += n_messages == 0
+            stats['time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+
+    def snapshot(self) -> dict:
+        """
+        :return: for each operation, the number of calls, of messages, of calls with no message,
+                 the total, the mean and the maximum time of a call in seconds.
+        """
+        with self.__lock:
+            return {
+                operation: dict(stats, mean_time=stats['time'] / stats['calls'])
+                for operation, stats in self.__stats.items()
+            }
+
 
 class Connector:
     """
     This class is used to interact with Amazon SQS. It is responsible for creating queues, sending messages
-    and receiving messages, deleting the queues, and more. Acts as a wrapper around Amazon SQS.
+    and receiving messages, deleting the queues, and more. Acts as a wrapper around Amazon SQS, or around
+    any other Transport backend (see Shared.transports) with the same FIFO semantics.
     """
 
-    def __init__(self, sqs_client=None, sqs_resource=None, queue_urls: List[str] = None, queue_names: List[str] = None):
+    def __init__(self, sqs_client=None, sqs_resource=None, queue_urls: List[str] = None, queue_names: List[str] = None,
+                 transport: Transport = None):
         """
         :param sqs_client: client instance to read messages from Amazon SQS.
         :param sqs_resource: resource to interact with Amazon SQS.
 
         :param queue_urls: queue urls to fetch messages from.
         :param queue_names: queue names to be created.
+        :param transport: backend moving the messages, Amazon SQS through sqs_client and sqs_resource if None.
         """
         self.queues = {}
         self.queue_names = queue_names
         self.sqs_resource = sqs_resource
         self.sqs_client = sqs_client
         self.queue_urls = queue_urls
+        self.transport = transport if transport is not None else SQSTransport(sqs_client, sqs_resource)
 
         self.msg_counter = 1
+        self.stats = ConnectorStats()
+        # messages received in a batch and not yet returned by receive_messages
+        self.__received = deque()
 
         if queue_names is not None:
             self.__create_queues()
@@ -51,68 +98,135 @@ class Connector:
         :param queue_name: The name of the queue. This is part of the URL assigned to the queue.
         :param attributes: The attributes of the queue, such as maximum message size or
                            whether it's a FIFO queue.
-        :return: A Queue object that contains metadata about the queue and that can be used
-                 to perform queue operations like sending and receiving messages.
+        :return: The URL of the queue.
         """
         if not attributes:
             attributes = {}
 
         try:
-            queue = self.sqs_resource.create_queue(
-                QueueName=queue_name,
-                Attributes=attributes
-            )
-            self.queues[queue_name] = queue
+            queue_url = self.transport.create_queue(queue_name, attributes)
+            self.queues[queue_name] = queue_url
 
-            LOGGER.info("Created FIFO queue '%s' with URL=%s", queue_name, queue.url)
+            LOGGER.info("Created FIFO queue '%s' with URL=%s", queue_name, queue_url)
         except ClientError as error:
             LOGGER.exception("Couldn't create queue named '%s'.", queue_name)
             raise error
         else:
-            return queue
+            return queue_url
 
     def send_message_to_queues(self, message_body: dict, attributes=None):
         """
         Proxy method that sends a message to all the queues in the wrapper.
-        :param message_body: String or dictionary that contains the body of the message.
+        :param message_body: Dictionary or message object (see Shared.messages) that contains the body of the message.
         :param attributes: Optional attributes of the message. These are key-value pairs that can be whatever you want.
         """
         for queue_name in self.queue_names:
-            queue = self.queues[queue_name]
-            self.send_message(queue, queue_name, message_body, attributes)
+            self.send_message(queue_name, message_body, attributes)
 
-    def send_message(self, queue, queue_name, message_body, message_attributes=None):
+    def send_message(self, queue_name, message_body, message_attributes=None):
         """
         Send a message to an Amazon SQS queue.
-        :param queue:
-        :param queue_name:
-        :param message_body: The body text of the message.
+        :param queue_name: The name of a queue created by this connector.
+        :param message_body: The message, a dictionary or a message object encoded with Shared.messages.encode.
         :param message_attributes: Custom attributes of the message. These are key-value
                                    pairs that can be whatever you want.
-        :return: The response from SQS that contains the assigned message ID.
+        :return: The message ID assigned to the message.
         """
         if not message_attributes:
             message_attributes = {}
 
         deduplication_id = self.__gen_random_id()
-        json_to_send = json.dumps(message_body)
+        body_to_send = encode_message(message_body)
 
         try:
-            response = queue.send_message(
-                MessageBody=json_to_send,
-                MessageGroupId=queue_name,
-                MessageAttributes=message_attributes,
-                MessageDeduplicationId=deduplication_id,
+            start = time.perf_counter()
+            message_id = self.transport.send_message(
+                queue_name,
+                body_to_send,
+                group_id=queue_name,
+                deduplication_id=deduplication_id,
+                attributes=message_attributes
             )
+            self.stats.record('send', time.perf_counter() - start, 1)
+
             LOGGER.info(f"Sent message #{self.msg_counter}: '{message_body}' to '{queue_name}'.")
-            LOGGER.info(f"Sent message with message_id: {response['MessageId']}")
+            LOGGER.info(f"Sent message with message_id: {message_id}")
             self.msg_counter += 1
 
         except ClientError as error:
             LOGGER.exception("Send message failed: %s", message_body)
             raise error
         else:
-            return response
+            return message_id
+
+    def send_message_batch(self, queue_name, message_bodies: list, message_attributes=None):
+        """
+        Send several messages to an Amazon SQS queue with as few calls as possible: each call carries at most
+        10 messages and 256 KiB. Messages keep their order.
+        :param queue_name: The name of a queue created by this connector.
+        :param message_bodies: The bodies of the messages.
+        :param message_attributes: Custom attributes added to every message.
+        :return: The message IDs assigned to the messages, None for the ones that could not be sent.
+        """
+        return self.send_encoded_batch(
+            queue_name,
+            [encode_message(message_body) for message_body in message_bodies],
+            [self.__gen_random_id() for _ in message_bodies],
+            message_attributes
+        )
+
+    def send_encoded_batch(self, queue_name, bodies: list[str], deduplication_ids: list[str],
+                           message_attributes=None):
+        """
+        Like send_message_batch, for bodies already encoded and with given deduplication ids: sending again
+        a message with the same deduplication id within five minutes does not deliver it twice.
+        """
+        entries = [
+            {
+                'body': body,
+                'group_id': queue_name,
+                'deduplication_id': deduplication_id,
+                'attributes': message_attributes or {}
+            }
+            for body, deduplication_id in zip(bodies, deduplication_ids)
+        ]
+
+        message_ids = []
+        for batch in self.__split_batches(entries):
+            try:
+                start = time.perf_counter()
+                batch_ids = self.transport.send_message_batch(queue_name, batch)
+                self.stats.record('send_batch', time.perf_counter() - start, len(batch))
+
+            except ClientError as error:
+                LOGGER.exception("Send message batch failed for queue '%s'.", queue_name)
+                raise error
+
+            failed = sum(message_id is None for message_id in batch_ids)
+            if failed:
+                LOGGER.error(f"{failed} message(s) of a batch could not be sent to '{queue_name}'.")
+
+            LOGGER.info(f"Sent a batch of {len(batch) - failed} message(s) to '{queue_name}'.")
+            self.msg_counter += len(batch) - failed
+            message_ids += batch_ids
+
+        return message_ids
+
+    @staticmethod
+    def __split_batches(entries: list[dict]):
+        batch, batch_bytes = [], 0
+
+        for entry in entries:
+            entry_bytes = len(entry['body'].encode())
+            if batch and (len(batch) == MAX_BATCH_SIZE or batch_bytes + entry_bytes > MAX_BATCH_BYTES):
+                yield batch
+                batch, batch_bytes = [], 0
+
+            batch.append(entry)
+            batch_bytes += entry_bytes
+
+        if batch:
+            yield batch
 
     @staticmethod
     def __gen_random_id():
@@ -121,41 +235,188 @@ class Connector:
 
     def receive_messages(self):
         """
-        Receive a batch of messages in a single request from an SQS queue.
-        :return: The list of Message objects received. These each contain the body
-                 of the message and metadata and custom attributes.
+        Receive a message from the SQS queues. Messages are fetched in batches of up to 10 and
+        returned one per call.
+        :return: The body of the message received, None if no queue had any message.
+        """
+        if not self.__received:
+            self.__received.extend(self.receive_message_batch())
+
+        if self.__received:
+            return self.__received.popleft()
+
+        return None
+
+    def receive_message_batch(self, max_messages: int = MAX_BATCH_SIZE, wait_time: float = 20):
+        """
+        Receive a batch of messages in a single request from an SQS queue, the first one with messages.
+        Received messages are removed from the queue with a single batch delete.
+        :param max_messages: The maximum number of messages to receive, at most 10.
+        :param wait_time: The maximum time to wait on each queue for a message to arrive.
+        :return: The list of the bodies of the received messages, possibly empty.
+        """
+        for queue_url in self.queue_urls:
+            message_bodies = self.__receive_from(queue_url, max_messages, wait_time)
+            if message_bodies:
+                return message_bodies
+
+        return []
+
+    def listen(self, handler: Callable[[str], Optional[bool]], wait_time: float = 20,
+               stop_event: threading.Event = None, visibility_timeout: float = 60):
+        """
+        Long-polls all the queue URLs at the same time, one thread per queue, and passes the body of each
+        message to handler as soon as it is received: a message on a queue never waits for the long poll
+        of another queue to expire. Handlers run one at a time on the calling thread, in arrival order.
+        A message is deleted from its queue only once handler handled it: the messages not handled when
+        stop_event is set, and the rest of a batch from a message for which handler returned False or raised,
+        are delivered again after the visibility timeout.
+        Blocks until stop_event is set, errors in receiving messages are raised from here.
+        :param handler: Callable receiving the body of a message, returning False if it failed to handle it
+                        (None counts as handled).
+        :param wait_time: The maximum time each long poll waits for a message to arrive, at most 20 seconds.
+        :param stop_event: Event to stop listening, the polling threads exit after their current long poll.
+        :param visibility_timeout: Seconds a received batch stays hidden from other consumers while handled.
         """
+        stop_event = stop_event if stop_event is not None else threading.Event()
+        wait_time = min(max(wait_time, 0), 20)
+
+        # one received batch per queue at most, a poller receives again once its batch has been handled
+        inbox = Queue(maxsize=len(self.queue_urls))
+
         for queue_url in self.queue_urls:
+            threading.Thread(
+                target=self.__poll_queue,
+                args=(queue_url, wait_time, visibility_timeout, inbox, stop_event),
+                name=f'poll-{queue_name_from_url(queue_url)}',
+                daemon=True
+            ).start()
+
+        try:
+            while not stop_event.is_set():
+                try:
+                    item = inbox.get(timeout=1)
+                except Empty:
+                    continue
+
+                if isinstance(item, Exception):
+                    raise item
+
+                self.__handle_batch(handler, *item, stop_event)
+        finally:
+            stop_event.set()
+
+    def __handle_batch(self, handler: Callable[[str], Optional[bool]], queue_url: str, messages: list[dict],
+                       handled_event: threading.Event, stop_event: threading.Event):
+        handled = []
+
+        try:
+            for message in messages:
+                if stop_event.is_set():
+                    break
+
+                if handler(message['Body']) is False:
+                    # as when handler raises, the messages after it are not handled before it is delivered again
+                    LOGGER.warning(f'Message {message.get("MessageId")} not handled, it will be delivered again.')
+                    break
+                handled.append(message['ReceiptHandle'])
+        finally:
+            if handled:
+                self.__delete_messages(queue_url, handled)
+            handled_event.set()
+
+    def __poll_queue(self, queue_url: str, wait_time: float, visibility_timeout: float, inbox: Queue,
+                     stop_event: threading.Event):
+        while not stop_event.is_set():
             try:
-                response = self.sqs_client.receive_message(
-                    QueueUrl=queue_url,
-                    AttributeNames=['All'],
-                    MessageAttributeNames=['All'],
-                    MaxNumberOfMessages=1,
-                    VisibilityTimeout=5,
-                    WaitTimeSeconds=20,
-                )
-
-                if 'Messages' in response:
-                    message = response['Messages'][0]
-                    receipt_handle = message['ReceiptHandle']
-                    message_body = message['Body']
-
-                    LOGGER.info(f"Received message from queue: {message_body}")
-
-                    try:
-                        self.sqs_client.delete_message(
-                            QueueUrl=queue_url,
-                            ReceiptHandle=receipt_handle
-                        )
-                    except ClientError:
-                        LOGGER.critical('Could not remove message from SQS queue.')
-
-                    return message_body
+                messages = self.__receive(queue_url, MAX_BATCH_SIZE, wait_time, visibility_timeout)
+            except Exception as error:
+                self.__put(inbox, error, stop_event)
+                return
 
-            except ClientError as error:
-                LOGGER.exception("Couldn't receive messages from queue.")
-                raise error
+            if not messages:
+                continue
+
+            handled_event = threading.Event()
+            if not self.__put(inbox, (queue_url, messages, handled_event), stop_event):
+                return
+
+            # the batch stays in flight until handled, receiving again before would only return it once more
+            while not handled_event.wait(timeout=1):
+                if stop_event.is_set():
+                    return
+
+    @staticmethod
+    def __put(inbox: Queue, item, stop_event: threading.Event) -> bool:
+        while not stop_event.is_set():
+            try:
+                inbox.put(item, timeout=1)
+                return True
+            except Full:
+                continue
+
+        return False
+
+    def __receive_from(self, queue_url: str, max_messages: int, wait_time: float) -> list[str]:
+        messages = self.__receive(queue_url, max_messages, wait_time, visibility_timeout=5)
+        if not messages:
+            return []
+
+        self.__delete_messages(queue_url, [message['ReceiptHandle'] for message in messages])
+        return [message['Body'] for message in messages]
+
+    def __receive(self, queue_url: str, max_messages: int, wait_time: float,
+                  visibility_timeout: float) -> list[dict]:
+        queue_name = queue_name_from_url(queue_url)
+
+        try:
+            start = time.perf_counter()
+            messages = self.transport.receive_messages(
+                queue_url,
+                max_messages=max_messages,
+                wait_time=wait_time,
+                visibility_timeout=visibility_timeout
+            )
+            elapsed = time.perf_counter() - start
+            self.stats.record('receive', elapsed, len(messages))
+            self.stats.record(f'receive:{queue_name}', elapsed, len(messages))
+
+        except ClientError as error:
+            LOGGER.exception("Couldn't receive messages from queue.")
+            raise error
+
+        if not messages:
+            return []
+
+        # time spent by each message in the queue, from the moment it was sent to the moment it was received
+        received_at = time.time()
+        for message in messages:
+            sent_timestamp = message.get('Attributes', {}).get('SentTimestamp')
+            if sent_timestamp is not None:
+                self.stats.record(f'latency:{queue_name}', max(received_at - int(sent_timestamp) / 1000, 0), 1)
+
+        LOGGER.info(f"Received {len(messages)} message(s) from queue '{queue_name}': "
+                    f"{[message['Body'] for message in messages]}")
+        return messages
+
+    def __delete_messages(self, queue_url: str, receipt_handles: list[str]):
+        try:
+            start = time.perf_counter()
+            failed = self.transport.delete_message_batch(queue_url, receipt_handles)
+            self.stats.record('delete_batch', time.perf_counter() - start, len(receipt_handles))
+
+            if failed:
+                LOGGER.critical(f'Could not remove {len(failed)} message(s) from SQS queue.')
+        except ClientError:
+            LOGGER.critical('Could not remove messages from SQS queue.')
+
+    def get_stats(self) -> dict:
+        """
+        :return: the ConnectorStats snapshot. Besides the totals per operation, 'receive:<queue name>' holds
+                 the receive calls on each queue and 'latency:<queue name>' the time its messages waited
+                 between being sent and being received.
+        """
+        return self.stats.snapshot()
 
     def close(self):
         """
@@ -164,10 +425,10 @@ class Connector:
 
         :return: None
         """
-        for queue in self.queues.values():
+        for queue_name, queue_url in self.queues.items():
             try:
-                queue.delete()
-                LOGGER.info("Deleted queue with URL=%s.", queue.url)
+                self.transport.delete_queue(queue_name)
+                LOGGER.info("Deleted queue with URL=%s.", queue_url)
             except ClientError as error:
-                LOGGER.exception("Couldn't delete queue with URL=%s!", queue.url)
+                LOGGER.exception("Couldn't delete queue with URL=%s!", queue_url)
                 raise error
@@ -0,0 +1,221 @@
+import os
+from abc import ABC, abstractmethod
+
+import boto3
+
+from Shared import utils
+from Shared.local_broker import LocalBroker, connect_broker, DEFAULT_ADDRESS, DEFAULT_AUTHKEY
+
+LOGGER = utils.get_logger(os.path.splitext(os.path.basename(__file__))[0])
+
+
+def queue_name_from_url(queue_url: str) -> str:
+    """
+    Queues are identified by URL when receiving and by name when sending, the name is the last part of the URL.
+    """
+    return queue_url.rstrip('/').rsplit('/', 1)[-1]
+
+
+class Transport(ABC):
+    """
+    Backend used by the Connector to move messages between components.
+    Received messages are dictionaries with the 'MessageId', 'ReceiptHandle', 'Body' and optionally 'Attributes'
+    keys, as in SQS.
+    """
+
+    @abstractmethod
+    def create_queue(self, queue_name: str, attributes: dict) -> str:
+        """
+        Creates the queue if needed and returns its URL.
+        """
+        pass
+
+    @abstractmethod
+    def send_message(self, queue_name: str, body: str, group_id: str, deduplication_id: str,
+                     attributes: dict = None) -> str:
+        """
+        Sends a message and returns its message id.
+        """
+        pass
+
+    def send_message_batch(self, queue_name: str, entries: list[dict]) -> list:
+        """
+        Sends up to 10 messages in a single call. Each entry has the 'body', 'group_id', 'deduplication_id'
+        and optionally 'attributes' keys.
+        :return: the message id of each entry, None for the entries that could not be sent.
+        """
+        return [self.send_message(queue_name, entry['body'], entry['group_id'], entry['deduplication_id'],
+                                  entry.get('attributes')) for entry in entries]
+
+    @abstractmethod
+    def receive_messages(self, queue_url: str, max_messages: int, wait_time: float,
+                         visibility_timeout: float) -> list[dict]:
+        pass
+
+    @abstractmethod
+    def delete_message(self, queue_url: str, receipt_handle: str):
+        pass
+
+    def delete_message_batch(self, queue_url: str, receipt_handles: list[str]) -> list[str]:
+        """
+        Deletes up to 10 received messages in a single call.
+        :return: the receipt handles that could not be deleted.
+        """
+        for receipt_handle in receipt_handles:
+            self.delete_message(queue_url, receipt_handle)
+        return []
+
+    @abstractmethod
+    def delete_queue(self, queue_name: str):
+        pass
+
+
+class SQSTransport(Transport):
+    """
+    Amazon SQS backend, the default one.
+    """
+
+    def __init__(self, sqs_client, sqs_resource):
+        self.sqs_client = sqs_client
+        self.sqs_resource = sqs_resource
+        self.queues = {}
+
+    def create_queue(self, queue_name: str, attributes: dict) -> str:
+        queue = self.sqs_resource.create_queue(
+            QueueName=queue_name,
+            Attributes=attributes
+        )
+        self.queues[queue_name] = queue
+        return queue.url
+
+    def send_message(self, queue_name: str, body: str, group_id: str, deduplication_id: str,
+                     attributes: dict = None) -> str:
+        response = self.queues[queue_name].send_message(
+            MessageBody=body,
+            MessageGroupId=group_id,
+            MessageAttributes=attributes or {},
+            MessageDeduplicationId=deduplication_id,
+        )
+        return response['MessageId']
+
+    def send_message_batch(self, queue_name: str, entries: list[dict]) -> list:
+        response = self.queues[queue_name].send_messages(
+            Entries=[
+                {
+                    'Id': str(i),
+                    'MessageBody': entry['body'],
+                    'MessageGroupId': entry['group_id'],
+                    'MessageAttributes': entry.get('attributes') or {},
+                    'MessageDeduplicationId': entry['deduplication_id']
+                }
+                for i, entry in enumerate(entries)
+            ]
+        )
+
+        message_ids = [None] * len(entries)
+        for successful in response.get('Successful', []):
+            message_ids[int(successful['Id'])] = successful['MessageId']
+        return message_ids
+
+    def receive_messages(self, queue_url: str, max_messages: int, wait_time: float,
+                         visibility_timeout: float) -> list[dict]:
+        response = self.sqs_client.receive_message(
+            QueueUrl=queue_url,
+            AttributeNames=['All'],
+            MessageAttributeNames=['All'],
+            MaxNumberOfMessages=max_messages,
+            VisibilityTimeout=int(visibility_timeout),
+            WaitTimeSeconds=int(wait_time),
+        )
+        return response.get('Messages', [])
+
+    def delete_message(self, queue_url: str, receipt_handle: str):
+        self.sqs_client.delete_message(
+            QueueUrl=queue_url,
+            ReceiptHandle=receipt_handle
+        )
+
+    def delete_message_batch(self, queue_url: str, receipt_handles: list[str]) -> list[str]:
+        response = self.sqs_client.delete_message_batch(
+            QueueUrl=queue_url,
+            Entries=[{'Id': str(i), 'ReceiptHandle': handle} for i, handle in enumerate(receipt_handles)]
+        )
+        return [receipt_handles[int(failed['Id'])] for failed in response.get('Failed', [])]
+
+    def delete_queue(self, queue_name: str):
+        queue = self.queues.pop(queue_name)
+        queue.delete()
+
+
+class LocalTransport(Transport):
+    """
+    Backend on a LocalBroker, either shared by all the components running in this Python process
+    or reached through a Unix socket (see Shared.local_broker).
+    """
+
+    # broker shared by every LocalTransport of the process created without an explicit broker
+    PROCESS_BROKER = LocalBroker()
+
+    def __init__(self, broker=None):
+        self.broker = broker if broker is not None else self.PROCESS_BROKER
+
+    def create_queue(self, queue_name: str, attributes: dict) -> str:
+        return self.broker.create_queue(queue_name)
+
+    def send_message(self, queue_name: str, body: str, group_id: str, deduplication_id: str,
+                     attributes: dict = None) -> str:
+        return self.broker.send_message(queue_name, body, group_id, deduplication_id)
+
+    def send_message_batch(self, queue_name: str, entries: list[dict]) -> list:
+        return self.broker.send_message_batch(
+            queue_name,
+            [(entry['body'], entry['group_id'], entry['deduplication_id']) for entry in entries]
+        )
+
+    def receive_messages(self, queue_url: str, max_messages: int, wait_time: float,
+                         visibility_timeout: float) -> list[dict]:
+        return self.broker.receive_messages(queue_name_from_url(queue_url), max_messages, wait_time,
+                                            visibility_timeout)
+
+    def delete_message(self, queue_url: str, receipt_handle: str):
+        self.broker.delete_message(queue_name_from_url(queue_url), receipt_handle)
+
+    def delete_message_batch(self, queue_url: str, receipt_handles: list[str]) -> list[str]:
+        self.broker.delete_message_batch(queue_name_from_url(queue_url), receipt_handles)
+        return []
+
+    def delete_queue(self, queue_name: str):
+        self.broker.delete_queue(queue_name)
+
+
+def create_transport(kind: str = None) -> Transport:
+    """
+    Creates the transport selected by kind, or by the IDS_TRANSPORT environment variable when kind is None:
+        - 'sqs' (default): Amazon SQS.
+        - 'inprocess': queues shared by the components running in this Python process.
+        - 'socket': a local broker reached at IDS_BROKER_ADDRESS (see Shared.local_broker).
+        - 'fakesqs': the SQS code path on in-process fake queues (see Shared.fake_sqs), to run without AWS.
+    """
+    kind = (kind or os.environ.get('IDS_TRANSPORT', 'sqs')).lower()
+
+    if kind == 'sqs':
+        return SQSTransport(sqs_client=boto3.client('sqs'), sqs_resource=boto3.resource('sqs'))
+
+    if kind == 'inprocess':
+        LOGGER.info('Using the in-process transport.')
+        return LocalTransport()
+
+    if kind == 'socket':
+        address = os.environ.get('IDS_BROKER_ADDRESS', DEFAULT_ADDRESS)
+        authkey = os.environ.get('IDS_BROKER_AUTHKEY', DEFAULT_AUTHKEY.decode()).encode()
+        LOGGER.info(f'Using the local broker at {address}.')
+        return LocalTransport(connect_broker(address, authkey))
+
+    if kind == 'fakesqs':
+        from Shared.fake_sqs import create_fake_sqs
+        LOGGER.info('Using the fake SQS transport.')
+        sqs_client, sqs_resource = create_fake_sqs(LocalTransport.PROCESS_BROKER)
+        return SQSTransport(sqs_client=sqs_client, sqs_resource=sqs_resource)
+
+    raise ValueError(f'Unknown transport: {kind}')
+
@@ -79,54 +79,12 @@ def parse_update_msg(json_dict: dict):
 
 
 def parse_metrics_msg(parsed_data: dict):
+    # validation is done by the typed message, see Shared.messages
+    from Shared.messages import MetricsSnapshotMsg
 
-    try:
-        metrics_1 = parsed_data["metrics_1"]
-        metrics_2 = parsed_data["metrics_2"]
-        classification_metrics = parsed_data["classification_metrics"]
-
-    except KeyError as e:
-        raise ValueError(f"Missing key in JSON: {e}")
-
-    try:
-        metrics1 = {
-            "accuracy": metrics_1["accuracy"],
-            "precision": metrics_1["precision"],
-            "fscore": metrics_1["fscore"],
-            "tpr": metrics_1["tpr"],
-            "fpr": metrics_1["fpr"],
-            "tnr": metrics_1["tnr"],
-            "fnr": metrics_1["fnr"]
-        }
-
-    except KeyError as e:
-        raise ValueError(f"Missing key in metrics1: {e}")
-
-    try:
-        metrics2 = {
-            "accuracy": metrics_2["accuracy"],
-            "precision": metrics_2["precision"],
-            "fscore": metrics_2["fscore"],
-            "tpr": metrics_2["tpr"],
-            "fpr": metrics_2["fpr"],
-            "tnr": metrics_2["tnr"],
-            "fnr": metrics_2["fnr"]
-        }
-    except KeyError as e:
-        raise ValueError(f"Missing key in metrics_2: {e}")
-
-    try:
-        classification_metrics = {
-            "normal_ratio": classification_metrics["normal_ratio"],
-            "l1_anomaly_ratio": classification_metrics["l1_anomaly_ratio"],
-            "l2_anomaly_ratio": classification_metrics["l2_anomaly_ratio"],
-            "quarantined_ratio": classification_metrics["quarantined_ratio"]
-        }
-
-    except KeyError as e:
-        raise ValueError(f"Missing key in classification_metrics: {e}")
+    snapshot = MetricsSnapshotMsg.from_dict(parsed_data)
 
-    return metrics1, metrics2, classification_metrics
+    return snapshot.metrics_1.as_dict(), snapshot.metrics_2.as_dict(), snapshot.classification_metrics.as_dict()
 
 def need_s3_update(path: str):
     try:
@@ -0,0 +1,161 @@
+import os
+import time
+
+import numpy as np
+import optuna
+from optuna.trial import FrozenTrial, TrialState
+
+try:
+    import resource
+except ImportError:
+    # not on Windows, where only the CPU time of the tuner process itself is measured
+    resource = None
+
+
+def cpu_seconds() -> float:
+    """
+    :return: CPU seconds, user and system, of this process and of its child processes that have been waited for,
+             which include the tuning workers once their study is over.
+    """
+    seconds = time.process_time()
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        seconds += children.ru_utime + children.ru_stime
+    return seconds
+
+
+class TuningBudget:
+    """
+    Wall-clock budget of a tuning run, shared by the layers it tunes. The layers still to tune split what is
+    left of it evenly, so that a slow layer1 study cannot starve layer2.
+    """
+
+    def __init__(self, seconds: float = None):
+        """
+        :param seconds: seconds of the whole run, None for no limit.
+        """
+        self.seconds = seconds
+        self.deadline = None
+
+    def start(self):
+        self.deadline = time.monotonic() + self.seconds if self.seconds else None
+
+    def remaining(self) -> float:
+        """
+        :return: seconds left, None for no limit.
+        """
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def exhausted(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def layer_timeout(self, layers_left: int) -> float:
+        """
+        :param layers_left: layers still to tune, including the next one.
+        :return: seconds of the study of the next layer, None for no limit.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return None
+        return remaining / max(1, layers_left)
+
+
+class TuningProgress:
+    """
+    Progress of the study of a layer: trials finished in this run, best values so far and an estimate of the
+    time left. Optuna callback of the studies run in threads, updated from the journal by the process runner.
+    """
+
+    FINISHED = (TrialState.COMPLETE, TrialState.PRUNED, TrialState.FAIL)
+
+    def __init__(self, layer: int, n_trials: int, n_workers: int, timeout: float = None, log_every: float = 30.0):
+        """
+        :param n_trials: trials of this run.
+        :param n_workers: trials running at the same time.
+        :param timeout: seconds of the study, None for no limit.
+        :param log_every: seconds between two progress logs.
+        """
+        import hypertuner_main
+        self.LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+
+        self.layer = layer
+        self.n_trials = n_trials
+        self.n_workers = max(1, n_workers)
+        self.timeout = timeout
+        self.log_every = log_every
+
+        self.started = time.monotonic()
+        self.__logged = None
+        self.__state = {}
+        # trials of earlier runs of a persistent study
+        self.__earlier = set()
+
+    def start(self, trials: list[FrozenTrial]):
+        """
+        :param trials: trials of the study before this run.
+        """
+        self.started = time.monotonic()
+        self.__earlier = {trial.number for trial in trials if trial.state in self.FINISHED}
+
+    def __call__(self, study: optuna.Study, trial: FrozenTrial):
+        self.update(study.get_trials(deepcopy=False))
+
+    def update(self, trials: list[FrozenTrial]):
+        trials = [trial for trial in trials if trial.number not in self.__earlier]
+        finished = [trial for trial in trials if trial.state in self.FINISHED]
+        complete = [trial for trial in finished if trial.state == TrialState.COMPLETE]
+
+        elapsed = time.monotonic() - self.started
+        left = max(0, self.n_trials - len(finished))
+
+        eta = None
+        if finished and left:
+            # mean duration of a trial of this run, its trials running n_workers at a time
+            durations = [trial.duration.total_seconds() for trial in finished if trial.duration is not None]
+            eta = float(np.mean(durations)) * left / self.n_workers if durations else None
+        elif not left:
+            eta = 0.0
+        if self.timeout is not None:
+            budget_left = max(0.0, self.timeout - elapsed)
+            eta = budget_left if eta is None else min(eta, budget_left)
+
+        best = max((trial.values for trial in complete), default=None,
+                   key=lambda values: float(np.mean(values)))
+
+        last_finished = self.__state.get('finished')
+        self.__state = {
+            'layer': self.layer,
+            'n_trials': self.n_trials,
+            'finished': len(finished),
+            'complete': len(complete),
+            'pruned': sum(1 for trial in finished if trial.state == TrialState.PRUNED),
+            'failed': sum(1 for trial in finished if trial.state == TrialState.FAIL),
+            'cancelled': sum(1 for trial in finished if 'cancelled' in trial.user_attrs),
+            'running': sum(1 for trial in trials if trial.state == TrialState.RUNNING),
+            'best_values': best,
+            'elapsed': elapsed,
+            'eta': eta,
+            'timeout': self.timeout
+        }
+
+        done = not left and len(finished) != last_finished
+        if self.__logged is None or time.monotonic() - self.__logged >= self.log_every or done:
+            self.__logged = time.monotonic()
+            self.log()
+
+    def as_dict(self) -> dict:
+        return dict(self.__state)
+
+    def log(self):
+        state = self.__state
+        if not state:
+            return
+
+        eta = f'{state["eta"]:.0f}s' if state['eta'] is not None else 'unknown'
+        budget = f' of a {state["timeout"]:.0f}s budget' if state['timeout'] is not None else ''
+        self.LOGGER.info(f'Layer{self.layer} tuning: {state["finished"]}/{self.n_trials} trial(s) finished '
+                         f'({state["pruned"]} pruned, {state["failed"]} failed, {state["cancelled"]} cancelled), '
+                         f'{state["running"]} running, best so far {state["best_values"]}, '
+                         f'{state["elapsed"]:.0f}s elapsed{budget}, about {eta} left.')
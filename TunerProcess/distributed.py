@@ -0,0 +1,318 @@
+import json
+import multiprocessing
+import os
+import socket
+import time
+import uuid
+from datetime import datetime
+
+import optuna
+from optuna.trial import TrialState
+
+from Shared.shared_datasets import SharedDatasetRegistry
+from TunerProcess.model_cache import ModelCache
+from TunerProcess.parallel import _worker_optimizers, journal_storage
+from TunerProcess.pruning import StagePruner
+
+# states of the trials a worker has started, and of the ones it has finished
+STARTED = (TrialState.RUNNING, TrialState.COMPLETE, TrialState.PRUNED, TrialState.FAIL)
+FINISHED = (TrialState.COMPLETE, TrialState.PRUNED, TrialState.FAIL)
+
+
+def _tasks_dir(shared_dir: str) -> str:
+    return os.path.join(shared_dir, 'tasks')
+
+
+def _read_task(path: str) -> dict:
+    """
+    :return: the task of a task file, None once the coordinator has closed it.
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_task(path: str, task: dict):
+    # replaced atomically, a worker never reads half a task
+    temp_path = f'{path}.{uuid.uuid4().hex[:8]}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(task, f)
+    os.replace(temp_path, path)
+
+
+def run_task(task_path: str):
+    """
+    Runs the trials of a task one at a time until the task is closed, its deadline has passed or its trials have
+    all been started, by this worker or by others.
+    """
+    import hypertuner_main
+    logger = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+
+    task = _read_task(task_path)
+    if task is None:
+        return
+
+    pruner = StagePruner(**task['pruner']) if task['pruner'] is not None else None
+    model_cache = ModelCache(**task['model_cache']) if task.get('model_cache') is not None else None
+    manager, optimizers = _worker_optimizers(task['objectives'], task['layer'], task['registry_root'],
+                                             task['dataset_name'], pruner, model_cache)
+    study = optuna.load_study(study_name=task['study_name'], storage=journal_storage(task['journal_path']),
+                              pruner=pruner.optuna_pruner() if pruner is not None else None)
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+
+    def objective(trial: optuna.Trial):
+        trial.set_user_attr('worker', worker)
+        cpu_start = time.process_time()
+        try:
+            return manager.optimization_wrapper(optimizers, trial)
+        finally:
+            # the coordinator cannot measure the CPU time of the workers of other hosts, they report it
+            trial.set_user_attr('worker_cpu_seconds', time.process_time() - cpu_start)
+
+    n_trials = 0
+    while True:
+        task = _read_task(task_path)
+        if task is None or (task['deadline'] is not None and time.time() >= task['deadline']):
+            break
+        if len(study.get_trials(deepcopy=False, states=STARTED)) - task['started_before'] >= task['n_trials']:
+            break
+
+        try:
+            study.optimize(objective, n_trials=1)
+            n_trials += 1
+        except Exception as e:
+            # e.g. the trial was cancelled by the coordinator while it was running
+            logger.warning(f'Trial of {task["study_name"]} failed on {worker}: {e}')
+
+    logger.info(f'{worker} ran {n_trials} trial(s) of {task_path}.')
+
+
+class DistributedStudyRunner:
+    """
+    Coordinator of the trials of a study run by worker processes on one or several hosts sharing shared_dir,
+    with no database: the study is a journal file, the train and validation sets are published to a
+    SharedDatasetRegistry and the study is offered to the workers as a task file, all in shared_dir.
+
+    Workers, started with TuningWorker on any host mounting shared_dir, pull the trials of the open tasks until
+    n_trials have been started. The coordinator can run n_workers of them itself. It waits for the trials to
+    finish, cancels the ones running for longer than trial_timeout or past the study timeout, closes the task
+    and returns the trials, from which the tuner picks and publishes the final model as with the other runners.
+    """
+
+    # seconds a trial is given past its timeout before the coordinator gives up on it
+    CANCEL_GRACE_SECONDS = 30.0
+    # seconds between two reads of the journal
+    POLL_SECONDS = 2.0
+    # seconds without any trial started after which the missing workers are reported
+    IDLE_WARNING_SECONDS = 60.0
+
+    def __init__(self, shared_dir: str, n_workers: int = 0, trial_timeout: float = None):
+        """
+        :param shared_dir: folder shared by the coordinator and its workers, on a filesystem every host mounts.
+        :param n_workers: worker processes started by the coordinator, -1 for one per core, 0 for none.
+        :param trial_timeout: seconds after which a running trial is cancelled, None for no limit.
+        """
+        import hypertuner_main
+        self.LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+
+        self.shared_dir = os.path.abspath(shared_dir)
+        self.n_workers = os.cpu_count() if n_workers is not None and n_workers < 0 else n_workers or 0
+        self.trial_timeout = trial_timeout
+        self.registry = SharedDatasetRegistry(os.path.join(self.shared_dir, 'datasets'))
+
+        os.makedirs(_tasks_dir(self.shared_dir), exist_ok=True)
+        os.makedirs(os.path.join(self.shared_dir, 'journals'), exist_ok=True)
+
+        self.context = multiprocessing.get_context('spawn')
+
+    def optimize(self, study_name: str, directions: list[str], optimizers: list, layer: int, n_trials: int,
+                 temp_storage, journal_path: str = None, enqueued: list[tuple[dict, dict]] = None,
+                 timeout: float = None, progress=None) -> optuna.Study:
+        """
+        :param optimizers: optimizers of the objectives, rebuilt by each worker from their objective, pruner and
+                           model cache.
+        :param temp_storage: storage holding the train and validation sets of the layer.
+        :param journal_path: journal of an existing study to add the trials to, which the workers must reach.
+        :param enqueued: (params, user_attrs) of configurations to try first.
+        :param timeout: seconds after which no trial is started and the running ones are cancelled.
+        :param progress: TuningProgress updated with the trials of the study while the workers run.
+        :return: the study with the trials of every worker.
+        """
+        task_id = f'{study_name.replace(" ", "_").replace(":", "_")}-{uuid.uuid4().hex[:8]}'
+        journal_path = os.path.abspath(journal_path or os.path.join(self.shared_dir, 'journals', f'{task_id}.log'))
+        task_path = os.path.join(_tasks_dir(self.shared_dir), f'{task_id}.json')
+
+        dataset_name = f'tuning_l{layer}_{task_id}'
+        self.registry.publish(dataset_name, {
+            'x_train': getattr(temp_storage, f'x_train_l{layer}'),
+            'y_train': getattr(temp_storage, f'y_train_l{layer}'),
+            'x_validate': getattr(temp_storage, f'x_validate_l{layer}'),
+            'y_validate': getattr(temp_storage, f'y_validate_l{layer}')
+        })
+
+        local_workers = []
+        try:
+            storage = journal_storage(journal_path)
+            study = optuna.create_study(study_name=study_name, storage=storage, directions=directions,
+                                        load_if_exists=True)
+            if progress is not None:
+                progress.start(study.get_trials(deepcopy=False))
+            for params, user_attrs in enqueued or []:
+                study.enqueue_trial(params, user_attrs=user_attrs)
+
+            start = time.time()
+            pruner, model_cache = optimizers[0].pruner, optimizers[0].model_cache
+            started_before = len(study.get_trials(deepcopy=False, states=STARTED))
+            finished_before = len(study.get_trials(deepcopy=False, states=FINISHED))
+
+            _write_task(task_path, {
+                'study_name': study_name,
+                'journal_path': journal_path,
+                'objectives': [optimizer.objective for optimizer in optimizers],
+                'layer': layer,
+                'n_trials': n_trials,
+                'started_before': started_before,
+                'registry_root': self.registry.root,
+                'dataset_name': dataset_name,
+                'pruner': vars(pruner) if pruner is not None else None,
+                # the models of the trials reach the coordinator only if the workers can write to its directory
+                'model_cache': model_cache.worker_config() if model_cache is not None else None,
+                # wall-clock time, the hosts are expected to keep their clocks in sync
+                'deadline': start + timeout if timeout is not None else None
+            })
+            self.LOGGER.info(f'Offered {n_trials} trial(s) of {study_name} to the workers of {self.shared_dir}.')
+
+            for i in range(self.n_workers):
+                worker = self.context.Process(target=run_task, args=(task_path,), name=f'tuning-worker-{i}',
+                                              daemon=True)
+                worker.start()
+                local_workers.append(worker)
+
+            self.__wait(study, storage, n_trials, started_before, finished_before, start, timeout, progress)
+
+        finally:
+            # closing the task stops the workers before their next trial
+            if os.path.exists(task_path):
+                os.remove(task_path)
+            for worker in local_workers:
+                worker.join(timeout=self.CANCEL_GRACE_SECONDS)
+                if worker.is_alive():
+                    worker.terminate()
+            self.registry.remove(dataset_name)
+
+        trials = optuna.load_study(study_name=study_name, storage=journal_storage(journal_path)).trials
+        if progress is not None:
+            progress.update(trials)
+
+        workers = {trial.user_attrs['worker'] for trial in trials if 'worker' in trial.user_attrs}
+        self.LOGGER.info(f'{len(trials)} trial(s) of {study_name} in {time.time() - start:.1f}s '
+                         f'on {len(workers)} worker(s).')
+
+        # in memory, as the trials of the other runners
+        study = optuna.create_study(study_name=study_name, directions=directions)
+        study.add_trials(trials)
+        study.set_user_attr('remote_cpu_seconds', self.__remote_cpu_seconds(trials, local_workers, start))
+        return study
+
+    @staticmethod
+    def __remote_cpu_seconds(trials: list, local_workers: list, start: float) -> float:
+        """
+        :return: CPU seconds of the trials of this run reported by the workers of other hosts, the ones of the
+                 local workers are measured by the tuner as the CPU time of its child processes.
+        """
+        local = {f'{socket.gethostname()}:{worker.pid}' for worker in local_workers}
+        return sum(
+            trial.user_attrs.get('worker_cpu_seconds', 0.0) for trial in trials
+            if trial.user_attrs.get('worker') not in local
+            and trial.datetime_start is not None and trial.datetime_start.timestamp() >= start
+        )
+
+    def __wait(self, study: optuna.Study, storage, n_trials: int, started_before: int, finished_before: int,
+               start: float, timeout: float, progress):
+        """
+        Waits until n_trials trials have finished, cancelling the hung ones and the ones running past the timeout.
+        """
+        warned = False
+
+        while True:
+            time.sleep(self.POLL_SECONDS)
+            trials = study.get_trials(deepcopy=False)
+
+            if progress is not None:
+                running = {trial.user_attrs.get('worker') for trial in trials if trial.state == TrialState.RUNNING}
+                progress.n_workers = max(1, len(running - {None}))
+                progress.update(trials)
+
+            if sum(1 for trial in trials if trial.state in FINISHED) - finished_before >= n_trials:
+                return
+
+            elapsed = time.time() - start
+            if timeout is not None and elapsed > timeout + self.CANCEL_GRACE_SECONDS:
+                self.__cancel(storage, trials, 'study timeout')
+                return
+
+            if self.trial_timeout is not None:
+                self.__cancel(storage, trials, f'trial timeout of {self.trial_timeout:.0f}s',
+                              self.trial_timeout + self.CANCEL_GRACE_SECONDS)
+
+            started = sum(1 for trial in trials if trial.state in STARTED) - started_before
+            if not warned and not started and elapsed > self.IDLE_WARNING_SECONDS:
+                warned = True
+                self.LOGGER.warning(f'No worker has started a trial of {study.study_name} after {elapsed:.0f}s, '
+                                    f'start some with -tuning_role worker.')
+
+    def __cancel(self, storage, trials: list, reason: str, older_than: float = 0.0):
+        """
+        Marks the running trials started more than older_than seconds ago as failed. Their workers, possibly on
+        other hosts, are not stopped: they find the trial finished when they report it and go on.
+        """
+        now = datetime.now()
+
+        for trial in trials:
+            if trial.state == TrialState.RUNNING and trial.datetime_start is not None \
+                    and (now - trial.datetime_start).total_seconds() > older_than:
+                storage.set_trial_user_attr(trial._trial_id, 'cancelled', reason)
+                storage.set_trial_state_values(trial._trial_id, TrialState.FAIL)
+                self.LOGGER.warning(f'Cancelled trial {trial.number} of {trial.user_attrs.get("worker")}: '
+                                    f'{reason}.')
+
+
+class TuningWorker:
+    """
+    Worker of the DistributedStudyRunner coordinators sharing shared_dir: runs the trials of their open tasks,
+    oldest first, until stopped.
+    """
+
+    POLL_SECONDS = 2.0
+
+    def __init__(self, shared_dir: str):
+        import hypertuner_main
+        self.LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+
+        self.shared_dir = os.path.abspath(shared_dir)
+        os.makedirs(_tasks_dir(self.shared_dir), exist_ok=True)
+
+    def run(self):
+        self.LOGGER.info(f'Waiting for tuning tasks in {_tasks_dir(self.shared_dir)}.')
+        # tasks this worker is done with, until the coordinator closes them
+        done = set()
+
+        while True:
+            tasks = sorted(
+                (entry for entry in os.scandir(_tasks_dir(self.shared_dir)) if entry.name.endswith('.json')),
+                key=lambda entry: entry.stat().st_mtime
+            )
+            pending = [entry.path for entry in tasks if entry.path not in done]
+            done &= {entry.path for entry in tasks}
+
+            if not pending:
+                time.sleep(self.POLL_SECONDS)
+                continue
+
+            try:
+                run_task(pending[0])
+            except Exception:
+                self.LOGGER.exception(f'Tuning task {pending[0]} failed on this worker.')
+            done.add(pending[0])
@@ -2,20 +2,25 @@ import argparse
 import logging
 import sys
 import os
-import json
 import threading
 import time
-import boto3
 
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
 from optimizer import OptimizationManager, RFTrainer, SVMTrainer
-from Shared.msg_enum import msg_type
 from TunerProcess.tuner import TuningHandler
+from TunerProcess.distributed import DistributedStudyRunner, TuningWorker
+from TunerProcess.model_cache import ModelCache
+from TunerProcess.parallel import ProcessPoolStudyRunner
+from TunerProcess.pruning import StagePruner
+from TunerProcess.screening import SurrogateScreener
+from TunerProcess.studies import StudyStore
 from TunerProcess.storage import Storage, S3Manager, SQLiteManager
-from Shared import utils
+from Shared import transports, utils
+from Shared.messages import ModelUpdateMsg, MultipleUpdateMsg, ObjectivesMsg
 from Shared.sqs_wrapper import Connector
-from Shared.message_handler import FullMsgHandler
+from Shared.outbox import Outbox, default_journal_path
+from Shared.message_handler import FullMsgHandler, MessageDispatcher
 from tuner import Tuner, TunerLayer1, TunerLayer2
 
 LOGGER = utils.get_logger(os.path.splitext(os.path.basename(__file__))[0])
@@ -23,22 +28,23 @@ LOGGER = utils.get_logger(os.path.splitext(os.path.basename(__file__))[0])
 
 class MsgManager(FullMsgHandler):
 
-    def __init__(self, storage: Storage, polling_timer: float, tuner: TuningHandler):
+    def __init__(self, storage: Storage, polling_timer: float, tuner: TuningHandler, outbox_journal: str = None):
         self.polling_timer = polling_timer
+        self.outbox_journal = outbox_journal or default_journal_path('hypertuner')
 
         self.storage = storage
         self.tuner = tuner
         self.__sqs_setup()
 
+        self.tuner.start(on_models_tuned=self.send_models_update)
+
     def __sqs_setup(self):
         """
-        Set up AWS SQS client, SQS resource, and Connector for handling SQS queues.
-        This method initializes the SQS client and resource using the boto3 library.
+        Set up the Connector for handling SQS queues.
+        The transport backend (Amazon SQS by default) is selected by Shared.transports.create_transport.
         It also defines the URLs of the queues to fetch messages from
         and names of the queue names to be created (if not already present)
         """
-        self.sqs_client = boto3.client('sqs')
-        self.sqs_resource = boto3.resource('sqs')
 
         queue_urls = [
             'https://sqs.eu-west-3.amazonaws.com/818750160971/forward-objectives.fifo',
@@ -50,38 +56,28 @@ class MsgManager(FullMsgHandler):
         ]
 
         self.connector = Connector(
-            sqs_client=self.sqs_client,
-            sqs_resource=self.sqs_resource,
+            transport=transports.create_transport(),
             queue_urls=queue_urls,
             queue_names=queue_names
         )
+        self.outbox = Outbox(self.connector, journal_path=self.outbox_journal)
+        self.dispatcher = MessageDispatcher.for_handler(self)
 
-    def process_message(self, msg_body: str):
-        json_dict = json.loads(msg_body)
-
-        if json_dict['MSG_TYPE'] == str(msg_type.MODEL_UPDATE_MSG):
-            self.handle_models_update_msg(json_dict)
-
-        elif json_dict['MSG_TYPE'] == str(msg_type.MULTIPLE_UPDATE_MSG):
-            self.handle_models_update_msg(json_dict)
-
-        elif json_dict['MSG_TYPE'] == str(msg_type.OBJECTIVES_MSG):
-            self.handle_objs_msg(json_dict)
-
-    def handle_models_update_msg(self, json_dict: dict):
-        LOGGER.debug(f'Received update notification: {json_dict}')
+    def handle_models_update_msg(self, message: ModelUpdateMsg):
+        LOGGER.debug(f'Received update notification: {message}')
         self.storage.loader.s3_models()
 
-    def handle_objs_msg(self, json_dict: dict):
-        LOGGER.debug(f'Received objectives notification: {json_dict}')
+    def handle_objs_msg(self, message: ObjectivesMsg):
+        LOGGER.debug(f'Received objectives notification: {message}')
 
-        models_update_msg = self.tuner.on_tuning_msg_received(json_dict)
+        # queued for the tuning worker, the message loop goes on
+        self.tuner.on_tuning_msg_received(message)
 
-        time.sleep(100000)
-        #self.connector.send_message_to_queues(models_update_msg)
+    def send_models_update(self, models_update_msg: ModelUpdateMsg):
+        self.outbox.send(models_update_msg)
 
-    def handle_multiple_updates_msg(self, json_dict: dict):
-        to_update = json_dict['UPDATE']
+    def handle_multiple_updates_msg(self, message: MultipleUpdateMsg):
+        to_update = message.update
         LOGGER.debug(f'Received multiple update notification: {to_update}')
 
         update_calls = {
@@ -94,18 +90,13 @@ class MsgManager(FullMsgHandler):
             update_calls[update]()
 
     def poll_queues(self):
-        while True:
-            LOGGER.debug('Fetching messages..')
+        LOGGER.debug('Listening for messages..')
 
-            try:
-                msg_body = self.connector.receive_messages()
-                self.process_message(msg_body)
-
-            except Exception as e:
-                LOGGER.error(f"Error in fetching messages from queue: {e}")
-                raise KeyboardInterrupt
-
-            time.sleep(self.polling_timer)
+        try:
+            self.connector.listen(self.dispatcher.dispatch, wait_time=self.polling_timer)
+        except Exception as e:
+            LOGGER.error(f"Error in fetching messages from queue: {e}")
+            raise KeyboardInterrupt
 
 
 class HypertunerMain:
@@ -123,15 +114,13 @@ class HypertunerMain:
 
     def terminate(self):
         self.__set_full_close()
+        self.message_manager.outbox.close()
         self.message_manager.connector.close()
 
     def inject_failure(self):
 
         LOGGER.warning('TESTING: Testing the tuning engine with a fake objectives set.')
-        test_objs = {
-            "objs_layer1": ['fpr'],
-            "objs_layer2": []
-        }
+        test_objs = ObjectivesMsg(objs_layer1=['fpr'], objs_layer2=[])
         self.tuner.on_tuning_msg_received(test_objs)
 
     def run_tasks(self):
@@ -158,7 +147,9 @@ class CommandLineParser:
 
     @staticmethod
     def process_command_line_args():
-        # Args: -n_cores, -polling_timer, -verbose
+        # Args: -n_cores, -polling_timer, -n_trials, -tuning_backend, -studies_path, -warm_start_trials, -pruner,
+        # -svm_pruner, -trial_timeout, -svm_screening_candidates, -svm_screening_top_k, -tuning_budget_seconds,
+        # -tuning_role, -shared_dir, -model_cache_dir, -model_cache_memory_mb, -verbose
         parser = argparse.ArgumentParser(description='Process command line arguments for a Python script.')
 
         parser.add_argument('-n_cores',
@@ -169,13 +160,99 @@ class CommandLineParser:
         parser.add_argument('-polling_timer',
                             type=float,
                             default=5,
-                            help='Specify the polling timer (float)'
+                            help='Specify the long polling wait time on each queue, at most 20 seconds (float)'
                             )
         parser.add_argument('-n_trials',
                             type=int,
                             default=40,
                             help='Specify the number of trials for tuning (default 100) (int)'
                             )
+        parser.add_argument('-tuning_backend',
+                            choices=['processes', 'threads'],
+                            default='threads',
+                            help='Run the trials in n_cores threads, or in n_cores worker processes sharing the '
+                                 'datasets (str)'
+                            )
+        parser.add_argument('-studies_path',
+                            type=str,
+                            default='tuning_studies.log',
+                            help='Specify the journal file of the persistent studies, "" for a new in-memory '
+                                 'study at each tuning (str)'
+                            )
+        parser.add_argument('-warm_start_trials',
+                            type=int,
+                            default=5,
+                            help='Specify the number of previous Pareto-optimal configurations tried first on '
+                                 'new data (int)'
+                            )
+        parser.add_argument('-pruner',
+                            choices=['median', 'halving', 'none'],
+                            default='median',
+                            help='Grow the layer1 forests in stages and stop unpromising trials with a median or '
+                                 'successive halving rule, or train every forest in full (str)'
+                            )
+        parser.add_argument('-svm_pruner',
+                            choices=['hyperband', 'halving', 'median', 'none'],
+                            default='hyperband',
+                            help='Fit the layer2 SVMs on growing stratified subsamples and promote only the '
+                                 'promising trials to the whole train set, or fit every SVM on all of it (str)'
+                            )
+        parser.add_argument('-trial_timeout',
+                            type=float,
+                            default=600,
+                            help='Specify the seconds after which a trial is stopped at the end of its current stage, '
+                                 'or cancelled with its worker process shortly after, 0 for no limit (float)'
+                            )
+        parser.add_argument('-svm_screening_candidates',
+                            type=int,
+                            default=0,
+                            help='Specify the number of layer2 configurations screened with a linear SVM on a '
+                                 'kernel approximation before exact training, 0 to sample the trials directly (int)'
+                            )
+        parser.add_argument('-svm_screening_top_k',
+                            type=int,
+                            default=10,
+                            help='Specify the number of screened configurations trained exactly (int)'
+                            )
+        parser.add_argument('-tuning_budget_seconds',
+                            type=float,
+                            default=0,
+                            help='Specify the wall-clock seconds of a tuning run, split between the layers it tunes; '
+                                 'the best model found in time is published, 0 for no limit (float)'
+                            )
+        parser.add_argument('-tuning_role',
+                            choices=['standalone', 'coordinator', 'worker'],
+                            default='standalone',
+                            help='Tune on this host only, coordinate the trials run by the workers sharing '
+                                 'shared_dir and publish the tuned models, or run the trials offered in shared_dir '
+                                 'by a coordinator (str)'
+                            )
+        parser.add_argument('-shared_dir',
+                            type=str,
+                            default='tuning_shared',
+                            help='Specify the folder of the tasks, journals and datasets shared by the coordinator '
+                                 'and its workers, on a filesystem mounted by every host; with a coordinator, '
+                                 'studies_path must be on it as well (str)'
+                            )
+        parser.add_argument('-model_cache_dir',
+                            type=str,
+                            default='model_cache',
+                            help='Specify the folder of the cached models of the trials, reused instead of retrained '
+                                 'for the tuned model and the repeated configurations, "" to disable the cache; with '
+                                 'a coordinator, it must be on the shared filesystem (str)'
+                            )
+        parser.add_argument('-model_cache_memory_mb',
+                            type=int,
+                            default=256,
+                            help='Specify the megabytes of small models kept in memory, the least recently used and '
+                                 'the larger ones are kept on disk (int)'
+                            )
+        parser.add_argument('-outbox_journal',
+                            type=str,
+                            default=None,
+                            help='Specify the journal of the outgoing messages, one for each running hypertuner, '
+                                 'outbox_hypertuner.jsonl by default (str)'
+                            )
         parser.add_argument('-verbose',
                             action='store_true',
                             help='Set the logging default to "DEBUG"'
@@ -202,11 +279,34 @@ class CommandLineParser:
         if trials is not None:
             LOGGER.debug(f'Number of Trials: {trials}')
 
-        return cores, timer, trials
+        backend = args.tuning_backend
+        LOGGER.debug(f'Tuning Backend: {backend}')
+
+        LOGGER.debug(f'Studies Path: {args.studies_path}, Warm Start Trials: {args.warm_start_trials}')
+        LOGGER.debug(f'Pruners: {args.pruner} for layer1, {args.svm_pruner} for layer2, '
+                     f'Trial Timeout: {args.trial_timeout}')
+
+        LOGGER.debug(f'SVM Screening: {args.svm_screening_candidates} candidates, top {args.svm_screening_top_k}')
+        LOGGER.debug(f'Tuning Budget: {args.tuning_budget_seconds}s')
+        LOGGER.debug(f'Tuning Role: {args.tuning_role}, Shared Dir: {args.shared_dir}')
+        LOGGER.debug(f'Model Cache: {args.model_cache_dir}, {args.model_cache_memory_mb} MB in memory')
+
+        pruners = {1: args.pruner, 2: args.svm_pruner}
+        screening = (args.svm_screening_candidates, args.svm_screening_top_k)
+        return cores, timer, trials, backend, args.studies_path, args.warm_start_trials, pruners, args.trial_timeout, \
+            screening, args.tuning_budget_seconds, (args.tuning_role, args.shared_dir), \
+            (args.model_cache_dir, args.model_cache_memory_mb), args.outbox_journal
 
 
 def main():
-    cores, polling_timer, trials = CommandLineParser.process_command_line_args()
+    cores, polling_timer, trials, backend, studies_path, warm_start_trials, pruners, trial_timeout, screening, \
+        budget_seconds, (role, shared_dir), (model_cache_dir, model_cache_memory_mb), outbox_journal = \
+        CommandLineParser.process_command_line_args()
+
+    if role == 'worker':
+        # the datasets and the study come from shared_dir, the worker needs no queue nor bucket
+        TuningWorker(shared_dir).run()
+        return
 
     s3_manager = S3Manager(
         bucket_name='nsl-kdd-datasets'
@@ -228,24 +328,45 @@ def main():
         rf_trainer=rf_trainer,
         svm_trainer=svm_trainer
     )
+    for layer, pruner in pruners.items():
+        if pruner != 'none':
+            optimizer.pruners[layer] = StagePruner(kind=pruner, trial_timeout=trial_timeout or None)
+    if model_cache_dir:
+        optimizer.model_cache = ModelCache(model_cache_dir, memory_bytes=model_cache_memory_mb * 2 ** 20)
+
+    if role == 'coordinator':
+        # n_cores local workers, 0 to only coordinate
+        runner = DistributedStudyRunner(shared_dir, n_workers=cores, trial_timeout=trial_timeout or None)
+    elif backend == 'processes':
+        runner = ProcessPoolStudyRunner(n_workers=cores, trial_timeout=trial_timeout or None)
+    else:
+        runner = None
+    study_store = StudyStore(studies_path, warm_start_trials=warm_start_trials) if studies_path else None
 
     layer1_tuner = TunerLayer1(
         n_cores=cores,
         n_trials=trials,
-        optimizer=optimizer
+        optimizer=optimizer,
+        runner=runner,
+        study_store=study_store
     )
 
+    candidates, top_k = screening
     layer2_tuner = TunerLayer2(
         n_cores=cores,
         n_trials=trials,
-        optimizer=optimizer
+        optimizer=optimizer,
+        runner=runner,
+        study_store=study_store,
+        screener=SurrogateScreener(candidates, top_k) if candidates > 0 else None
     )
 
     tuner = Tuner(
         storage=storage,
         optimization_manager=optimizer,
         layer1_tuner=layer1_tuner,
-        layer2_tuner=layer2_tuner
+        layer2_tuner=layer2_tuner,
+        budget_seconds=budget_seconds or None
     )
 
     tuning_handler = TuningHandler(
@@ -257,7 +378,8 @@ def main():
     message_manager = MsgManager(
         storage=storage,
         polling_timer=polling_timer,
-        tuner=tuning_handler
+        tuner=tuning_handler,
+        outbox_journal=outbox_journal
     )
 
     hypertuner = HypertunerMain(
@@ -275,10 +397,7 @@ def main():
             LOGGER.error('Deleting queues..')
         else:
             if tuning_handler.tuning_state.is_tuning_complete():
-                msg_body = {
-                    "MSG_TYPE": str(msg_type.MODEL_UPDATE_MSG),
-                    "SENDER": 'Hypertuner'
-                }
+                msg_body = ModelUpdateMsg(sender='Hypertuner')
 
                 hypertuner.message_manager.connector.send_message_to_queues(msg_body)
 
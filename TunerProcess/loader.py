@@ -7,6 +7,8 @@ import pandas as pd
 
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 
+from Shared import model_store
+
 class Loader:
     def __init__(self, s3_resource, bucket_name: str):
 
@@ -104,8 +106,8 @@ class Loader:
 
     @staticmethod
     def load_models(model1, model2):
-        model1 = joblib.load(f'AWS Downloads/Models/ModelsToUse/{model1}')
-        model2 = joblib.load(f'AWS Downloads/Models/ModelsToUse/{model2}')
+        model1 = model_store.load_model(f'AWS Downloads/Models/ModelsToUse/{model1}')
+        model2 = model_store.load_model(f'AWS Downloads/Models/ModelsToUse/{model2}')
         return model1, model2
 
     @staticmethod
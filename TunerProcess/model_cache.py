@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
+import uuid
+from collections import OrderedDict
+
+from TunerProcess.studies import dataset_version
+
+
+class ModelCache:
+    """
+    Trained models keyed by a digest of their layer, training parameters and train set version, so that a
+    configuration trained once, by a trial or by a previous run, is not trained again on the same data.
+
+    Models up to max_item_bytes pickled are kept in memory, the least recently used ones beyond memory_bytes
+    spilled to disk; larger models go straight to disk, in directory, where the least recently used files
+    beyond disk_bytes are removed. Pickled for a worker process, the cache keeps only its disk tier, through
+    which the models of the trials reach the tuner.
+    """
+
+    def __init__(self, directory: str, memory_bytes: int = 256 * 2 ** 20, max_item_bytes: int = 16 * 2 ** 20,
+                 disk_bytes: int = 4 * 2 ** 30):
+        """
+        :param directory: folder of the models on disk, created if missing.
+        :param memory_bytes: pickled size of the models kept in memory, 0 to keep every model on disk.
+        :param max_item_bytes: pickled size above which a model goes straight to disk.
+        :param disk_bytes: size of the model files kept on disk.
+        """
+        import hypertuner_main
+        self.LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+
+        self.directory = os.path.abspath(directory)
+        self.memory_bytes = memory_bytes
+        self.max_item_bytes = max_item_bytes
+        self.disk_bytes = disk_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.__lock = threading.Lock()
+        # key -> (model, pickled size), least recently used first
+        self.__memory = OrderedDict()
+        self.__memory_used = 0
+        # layer -> (labels of the train set, version of the train set they belong to)
+        self.__versions = {}
+        self.__stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    def worker_config(self) -> dict:
+        """
+        :return: the arguments of the cache of a worker process, on the same disk tier and without memory tier.
+        """
+        return {
+            'directory': self.directory,
+            'memory_bytes': 0,
+            'max_item_bytes': self.max_item_bytes,
+            'disk_bytes': self.disk_bytes
+        }
+
+    def __getstate__(self) -> dict:
+        return self.worker_config()
+
+    def __setstate__(self, state: dict):
+        self.__init__(**state)
+
+    def key(self, layer: int, parameters: dict, temp_storage) -> str:
+        """
+        :return: the key of the model of a layer trained with parameters on the current train set of temp_storage.
+        """
+        description = json.dumps({
+            'layer': layer,
+            'parameters': parameters,
+            'data': self.__dataset_version(layer, temp_storage)
+        }, sort_keys=True, default=str)
+
+        return hashlib.sha256(description.encode()).hexdigest()[:24]
+
+    def get(self, key: str):
+        """
+        :return: the model of key, None if it is not cached.
+        """
+        with self.__lock:
+            if key in self.__memory:
+                self.__memory.move_to_end(key)
+                self.__stats['memory_hits'] += 1
+                return self.__memory[key][0]
+
+        path = self.__path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # least recently used files are removed first
+            os.utime(path)
+        except FileNotFoundError:
+            with self.__lock:
+                self.__stats['misses'] += 1
+            return None
+
+        model = pickle.loads(data)
+        with self.__lock:
+            self.__stats['disk_hits'] += 1
+        if len(data) <= self.max_item_bytes:
+            self.__keep_in_memory(key, model, len(data))
+
+        return model
+
+    def put(self, key: str, model):
+        data = pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+
+        if self.memory_bytes and len(data) <= self.max_item_bytes:
+            self.__keep_in_memory(key, model, len(data))
+        else:
+            self.__write(key, data)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return dict(self.__stats, memory_models=len(self.__memory), memory_bytes=self.__memory_used)
+
+    def __keep_in_memory(self, key: str, model, size: int):
+        spilled = []
+
+        with self.__lock:
+            if key in self.__memory:
+                self.__memory.move_to_end(key)
+                return
+
+            self.__memory[key] = (model, size)
+            self.__memory_used += size
+
+            while self.__memory_used > self.memory_bytes and self.__memory:
+                evicted_key, (evicted, evicted_size) = self.__memory.popitem(last=False)
+                self.__memory_used -= evicted_size
+                spilled.append((evicted_key, evicted))
+
+        # pickled outside of the lock, the other trials go on meanwhile
+        for evicted_key, evicted in spilled:
+            if not os.path.exists(self.__path(evicted_key)):
+                self.__write(evicted_key, pickle.dumps(evicted, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def __write(self, key: str, data: bytes):
+        # written next to its destination and then moved, readers never see a partial model
+        path = self.__path(key)
+        temp_path = f'{path}.{uuid.uuid4().hex[:8]}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        self.__evict_files()
+
+    def __evict_files(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pkl'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        used = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if used <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            used -= size
+            self.LOGGER.debug(f'Removed the cached model {os.path.basename(path)}.')
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.pkl')
+
+    def __dataset_version(self, layer: int, temp_storage) -> str:
+        # hashed once per train set, the trials of a study share it
+        labels = getattr(temp_storage, f'y_train_l{layer}')
+
+        with self.__lock:
+            cached = self.__versions.get(layer)
+            if cached is not None and cached[0] is labels:
+                return cached[1]
+
+        version = dataset_version(temp_storage, layer)
+        with self.__lock:
+            self.__versions[layer] = (labels, version)
+        return version
@@ -1,15 +1,20 @@
+import math
 import os
 import pickle
 import threading
 import time
 from abc import ABC, abstractmethod
 
+import numpy as np
 import optuna
 import pandas as pd
+from optuna.distributions import BaseDistribution, CategoricalDistribution, FloatDistribution, IntDistribution
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import precision_score, accuracy_score
 from sklearn.svm import SVC
 
+from Shared.confusion import confusion_rates
+from TunerProcess.model_cache import ModelCache
+from TunerProcess.pruning import StagePruner, stage_sizes, subsample_sizes
 from TunerProcess.storage import SQLiteManager
 
 
@@ -32,36 +37,43 @@ class TemporaryStorage:
         self.prepare_temp_storage()
 
     def prepare_temp_storage(self):
-        query = {
-            'select': "*"
-        }
-
-        self.LOGGER.debug('Obtaining the datasets from SQLite3 in memory database.')
-        datasets = []
-        for dataset in ['x_train_l1', 'x_train_l2', 'x_validate_l1', 'x_validate_l2']:
-            query['from'] = str(dataset)
-            result = self.sqlite_manager.perform_query(query)
-            result_df = pd.DataFrame(result)
-            datasets.append(result_df)
-
-        self.x_train_l1 = datasets[0]
-        self.x_train_l2 = datasets[1]
-        self.x_validate_l1 = datasets[2]
-        self.x_validate_l2 = datasets[3]
-        self.y_train_l1 = datasets[0]['targets']
-        self.y_train_l2 = datasets[1]['targets']
-        self.y_validate_l1 = datasets[2]['targets']
-        self.y_validate_l2 = datasets[3]['targets']
-        self.x_train_l1 = self.x_train_l1.drop(self.x_train_l1.columns[-1], axis=1)
-        self.x_train_l2 = self.x_train_l2.drop(self.x_train_l2.columns[-1], axis=1)
-        self.x_validate_l1 = self.x_validate_l1.drop(self.x_validate_l1.columns[-1], axis=1)
-        self.x_validate_l2 = self.x_validate_l2.drop(self.x_validate_l2.columns[-1], axis=1)
+        self.LOGGER.debug('Obtaining the datasets from shared memory or the SQLite3 in memory database.')
+        self.x_train_l1, self.y_train_l1 = self.__read_table('x_train_l1')
+        self.x_train_l2, self.y_train_l2 = self.__read_table('x_train_l2')
+        self.x_validate_l1, self.y_validate_l1 = self.__read_table('x_validate_l1')
+        self.x_validate_l2, self.y_validate_l2 = self.__read_table('x_validate_l2')
+
+    def __read_table(self, table_name: str, chunk_size: int = 10000):
+        # a dataset attached from shared memory is used as it is, its read-only pages are not copied
+        shared = self.sqlite_manager.shared_table(table_name)
+        if shared is not None:
+            return shared[0], pd.Series(shared[1], name='targets')
+
+        # streamed once, in chunks, into arrays sized for the whole table: only one chunk is held as Python rows
+        columns = self.sqlite_manager.table_columns(table_name)
+        features = [position for position, column in enumerate(columns) if column != 'targets']
+        target = columns.index('targets')
+
+        n_rows = self.sqlite_manager.table_rows(table_name)
+        x = np.empty((n_rows, len(features)), dtype=np.float64)
+        y = np.empty(n_rows, dtype=object)
+
+        offset = 0
+        for chunk in self.sqlite_manager.perform_query_chunks({'select': '*', 'from': table_name},
+                                                              chunk_size=chunk_size, dtype=object):
+            x[offset:offset + len(chunk)] = chunk[:, features]
+            y[offset:offset + len(chunk)] = chunk[:, target]
+            offset += len(chunk)
+
+        # the targets keep the type they were stored with
+        return (pd.DataFrame(x[:offset], columns=[columns[position] for position in features]),
+                pd.Series(y[:offset], name='targets').infer_objects())
 
 
 class AbstractTrainer(ABC):
 
     @abstractmethod
-    def train(self, parameters: dict):
+    def train(self, parameters: dict, on_stage: callable = None):
         pass
 
     @abstractmethod
@@ -80,7 +92,12 @@ class RFTrainer(AbstractTrainer):
     def set_temp_storage(self, temp_storage: TemporaryStorage):
         self.temp_storage = temp_storage
 
-    def train(self, parameters: dict):
+    def train(self, parameters: dict, on_stage: callable = None):
+        """
+        :param on_stage: if given, the forest is grown in stages of increasing n_estimators and on_stage is called
+                         with the forest, the index of the stage and the share of the trees grown after each of them.
+                         It may stop the training by raising.
+        """
         classifier = RandomForestClassifier(
             n_estimators=parameters.get('n_estimators', 10),
             criterion=parameters.get('criterion', 'gini'),
@@ -102,9 +119,20 @@ class RFTrainer(AbstractTrainer):
             max_samples=parameters.get('max_samples', None)
         )
 
+        if on_stage is None:
+            classifier.fit(self.temp_storage.x_train_l1, self.temp_storage.y_train_l1)
+        else:
+            # warm_start keeps the trees of the previous stages and only fits the new ones
+            sizes = stage_sizes(classifier.n_estimators)
+            classifier.set_params(warm_start=True)
+
+            for step, n_estimators in enumerate(sizes):
+                classifier.set_params(n_estimators=n_estimators)
+                classifier.fit(self.temp_storage.x_train_l1, self.temp_storage.y_train_l1)
+                on_stage(classifier, step, n_estimators / sizes[-1])
 
+            classifier.set_params(warm_start=parameters.get('warm_start', False))
 
-        classifier.fit(self.temp_storage.x_train_l1, self.temp_storage.y_train_l1)
         self.LOGGER.debug('Trained a new RandomForest classifier.')
 
         return classifier
@@ -112,16 +140,28 @@ class RFTrainer(AbstractTrainer):
 
 class SVMTrainer(AbstractTrainer):
 
+    # smallest subsample an SVM is fitted on when trained in stages
+    MIN_STAGE_ROWS = 200
+
     def __init__(self):
         import hypertuner_main
         self.LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
 
         self.temp_storage = None
+        # stratified order of the rows of y_train_l2, and the labels it was computed for
+        self.__order = None
+        self.__order_labels = None
 
     def set_temp_storage(self, temp_storage: TemporaryStorage):
         self.temp_storage = temp_storage
 
-    def train(self, parameters: dict):
+    def train(self, parameters: dict, on_stage: callable = None):
+        """
+        :param on_stage: if given, the SVM is fitted on stratified subsamples of increasing size, each one
+                         containing the previous one, up to the whole train set. on_stage is called with the SVM,
+                         the index of the stage and the share of the rows fitted after each of them, it may stop
+                         the training by raising.
+        """
         classifier = SVC(
             C=parameters.get('C', 10),
             kernel=parameters.get('kernel', 'rbf'),
@@ -129,7 +169,7 @@ class SVMTrainer(AbstractTrainer):
             gamma=parameters.get('gamma', 0.01),
             coef0=parameters.get('coef0', 0.0),
             shrinking=parameters.get('shrinking', True),
-            probability=True,
+            probability=parameters.get('probability', True),
             tol=parameters.get('tol', 1e-3),
             cache_size=parameters.get('cache_size', 200),
             class_weight=parameters.get('class_weight', None),
@@ -139,456 +179,372 @@ class SVMTrainer(AbstractTrainer):
         )
 
         self.LOGGER.debug('Trained a new SVM classifier.')
-        classifier.fit(self.temp_storage.x_train_l2, self.temp_storage.y_train_l2)
 
-        return classifier
-
-
-class Optimizer(ABC):
-
-    def __init__(self, trainer: AbstractTrainer, temp_storage: TemporaryStorage):
-        self.trainer = trainer
-        self.temp_storage = temp_storage
+        if on_stage is None:
+            classifier.fit(self.temp_storage.x_train_l2, self.temp_storage.y_train_l2)
+            return classifier
 
-    @abstractmethod
-    def optimize(self, trial: optuna.Trial):
-        pass
+        order = self._stratified_order()
+        sizes = subsample_sizes(len(order), self.MIN_STAGE_ROWS)
 
+        for step, n_rows in enumerate(sizes):
+            rows = order[:n_rows]
+            classifier.fit(self.temp_storage.x_train_l2.iloc[rows], self.temp_storage.y_train_l2.iloc[rows])
+            on_stage(classifier, step, n_rows / sizes[-1])
 
-class TPROptimizer_layer1(Optimizer):
+        return classifier
 
-    def optimize(self, trial: optuna.Trial) -> float:
+    def _stratified_order(self) -> np.ndarray:
         """
-        This function defines the objective to maximize the true positive rate
-        :param trial:
-        :return: True positive rate
+        :return: a permutation of the rows of the train set whose every prefix has about the class shares of the
+                 whole set, the same for every trial on the same data.
         """
-        import hypertuner_main
-        LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
-
-        LOGGER.info("TPR optimizer for layer1")
-
-        rf_max_depth = trial.suggest_int(name='max_depth', low=2, high=32, step=1)
-        rf_criterion = trial.suggest_categorical('criterion', ['gini', 'entropy', 'log_loss'])
-        min_samples_split = trial.suggest_int(name='min_samples_split', low=2, high=10, step=1)
-        min_samples_leaf = trial.suggest_int(name='min_samples_leaf', low=1, high=10, step=1)
-        max_features = trial.suggest_categorical('max_features', ['auto', 'sqrt', 'log2'])
+        labels = self.temp_storage.y_train_l2
+        if self.__order_labels is labels:
+            return self.__order
+
+        y = np.asarray(labels)
+        rng = np.random.default_rng(0)
+        keys = np.empty(len(y))
+
+        # the i-th row of a class, in random order, is placed at the fraction i / n_class of the order
+        for label in np.unique(y):
+            rows = np.flatnonzero(y == label)
+            keys[rng.permutation(rows)] = (np.arange(len(rows)) + rng.random()) / len(rows)
+
+        self.__order, self.__order_labels = np.argsort(keys, kind='stable'), labels
+        return self.__order
+
+
+def _inverse(rate: float) -> float:
+    # the rates to minimise are maximised as their inverse, 0 when the rate is already 0
+    try:
+        return 1 / rate
+    except ZeroDivisionError:
+        return 0.0
+
+
+def union_search_space(spaces: list[dict]) -> dict:
+    """
+    :return: the search space covering every given one. The ranges of a parameter shared by several spaces are
+             merged: integer and float ranges span all of them, categorical choices are all kept.
+    """
+    union = {}
+
+    for space in spaces:
+        for name, distribution in space.items():
+            current = union.get(name)
+
+            if current is None:
+                union[name] = distribution
+            elif type(current) is not type(distribution):
+                raise ValueError(f'Parameter {name} is sampled from both {current} and {distribution}.')
+            elif isinstance(distribution, CategoricalDistribution):
+                union[name] = CategoricalDistribution(
+                    list(current.choices) + [choice for choice in distribution.choices if choice not in current.choices]
+                )
+            elif isinstance(distribution, IntDistribution):
+                union[name] = IntDistribution(min(current.low, distribution.low), max(current.high, distribution.high),
+                                              log=current.log and distribution.log,
+                                              step=math.gcd(current.step, distribution.step))
+            else:
+                union[name] = FloatDistribution(min(current.low, distribution.low), max(current.high, distribution.high),
+                                                log=current.log and distribution.log)
+
+    return union
+
+
+def suggest(trial: optuna.Trial, name: str, distribution: BaseDistribution):
+    if isinstance(distribution, CategoricalDistribution):
+        return trial.suggest_categorical(name, distribution.choices)
+    if isinstance(distribution, IntDistribution):
+        return trial.suggest_int(name, distribution.low, distribution.high, step=distribution.step,
+                                 log=distribution.log)
+    return trial.suggest_float(name, distribution.low, distribution.high, step=distribution.step,
+                               log=distribution.log)
 
-        parameters = {
-            'max_depth': rf_max_depth,
-            'criterion': rf_criterion,
-            'min_samples_split': min_samples_split,
-            'min_samples_leaf': min_samples_leaf,
-            'max_features': max_features
-        }
 
-        classifier = self.trainer.train(parameters)
-        predicted = classifier.predict(self.temp_storage.x_validate_l1)
-
-        tp = sum((self.temp_storage.y_validate_l1 == 1) & (predicted == 1))
-        fn = sum((self.temp_storage.y_validate_l1 == 1) & (predicted == 0))
-        tpr = tp / (tp + fn) if (tp + fn) != 0 else 0.0
-
-        return tpr
-
-
-class TPROptimizer_layer2(Optimizer):
-
-    def optimize(self, trial: optuna.Trial) -> float:
-        import hypertuner_main
-        LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
-
-        LOGGER.info("TPR optimizer for layer2")
-
-        svc_c = trial.suggest_float(name='svc_c', low=1e-10, high=1e10)
-        kernel = trial.suggest_categorical('kernel', ['poly', 'rbf', 'sigmoid'])
-
-        # add to parameters all the hyperparameters that need tuning
-        parameters = {
-            'C': svc_c,
-            'kernel': kernel
-        }
-
-        if kernel == 'rbf':
-            gamma = trial.suggest_float(name='gamma', low=1e-10, high=1e10)
-            parameters['gamma'] = gamma
-
-        if kernel in ['sigmoid', 'poly']:
-            degree = trial.suggest_int('degree', 2, 5)
-            coef0 = trial.suggest_float('coef0', -1.0, 1.0)
-            parameters['degree'] = degree
-            parameters['coef0'] = coef0
-
-        classifier = self.trainer.train(parameters)
-        predicted = classifier.predict(self.temp_storage.x_validate_l2)
-
-        tp = sum((self.temp_storage.y_validate_l2 == 1) & (predicted == 1))
-        fn = sum((self.temp_storage.y_validate_l2 == 1) & (predicted == 0))
-        tpr = tp / (tp + fn) if (tp + fn) != 0 else 0.0
-
-        return tpr
+class Optimizer(ABC):
+    """
+    One objective of a layer: the hyperparameters it searches and its value for the predictions of a model.
+    The objectives of a trial are scored together by a TrialEvaluator.
+    """
+
+    # trial parameter -> distribution
+    SEARCH_SPACE: dict = {}
+    # trial parameter -> (parameter, values of that parameter for which it is sampled)
+    CONDITIONS: dict = {}
+    # trial parameter -> parameter of the trainer, when they differ
+    PARAMETER_NAMES: dict = {}
+    # parameters of the trainer for the models of the trials only, not for the tuned model
+    TRIAL_PARAMETERS: dict = {}
+
+    def __init__(self, trainer: AbstractTrainer, temp_storage: TemporaryStorage, objective: str = None):
+        self.trainer = trainer
+        self.temp_storage = temp_storage
+        self.objective = objective
 
+        # prunes the trials between the stages of the training, set for the layers trained incrementally
+        self.pruner: StagePruner = None
+        # models of the trials, reused for the configurations trained before on the same data
+        self.model_cache: ModelCache = None
 
-class FPROptimizer_layer1(Optimizer):
+    @property
+    @abstractmethod
+    def layer(self) -> int:
+        pass
 
-    def optimize(self, trial: optuna.Trial) -> float:
+    @abstractmethod
+    def score(self, rates: dict) -> float:
         """
-        This function defines the objective to maximize the true positive rate
-        :param trial:
-        :return: True positive rate
+        :param rates: rates and scores of the predictions of the validation set, see confusion_rates.
+        :return: the value of the objective.
         """
-        import hypertuner_main
-        LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
-
-        LOGGER.info("FPR optimizer for layer1")
-
-        min_samples_split = trial.suggest_int(name='min_samples_split', low=2, high=10, step=1)
-        min_samples_leaf = trial.suggest_int(name='min_samples_leaf', low=1, high=10, step=1)
-        max_features = trial.suggest_categorical('max_features', [None, 'sqrt', 'log2'])
-
-        parameters = {
-            'min_samples_split': min_samples_split,
-            'min_samples_leaf': min_samples_leaf,
-            'max_features': max_features
-        }
-
-        classifier = self.trainer.train(parameters)
-        predicted = classifier.predict(self.temp_storage.x_validate_l1)
-
-        fp = sum((self.temp_storage.y_validate_l1 == 0) & (predicted == 1))
-        tn = sum((self.temp_storage.y_validate_l1 == 0) & (predicted == 0))
-        fpr = fp / (fp + tn) if (fp + tn) != 0 else 0.0
-
-        try:
-            return 1 / fpr
-        except ZeroDivisionError:
-            return 0.0
-
-
-class FPROptimizer_layer2(Optimizer):
-
-    def optimize(self, trial: optuna.Trial) -> float:
-        import hypertuner_main
-        LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
-
-        LOGGER.info("FPR optimizer for layer2")
-
-        svc_c = trial.suggest_float(name='svc_c', low=1e-10, high=1e10)
-        kernel = trial.suggest_categorical('kernel', ['poly', 'rbf', 'sigmoid'])
-
-        # add to parameters all the hyperparameters that need tuning
-        parameters = {
-            'C': svc_c,
-            'kernel': kernel
-        }
-
-        if kernel == 'rbf':
-            gamma = trial.suggest_float(name='gamma', low=1e-10, high=1e10)
-            parameters['gamma'] = gamma
-
-        if kernel in ['sigmoid', 'poly']:
-            degree = trial.suggest_int('degree', 2, 5)
-            coef0 = trial.suggest_float('coef0', -1.0, 1.0)
-            parameters['degree'] = degree
-            parameters['coef0'] = coef0
-
-        classifier = self.trainer.train(parameters)
-        predicted = classifier.predict(self.temp_storage.x_validate_l2)
-
-        fp = sum((self.temp_storage.y_validate_l2 == 0) & (predicted == 1))
-        tn = sum((self.temp_storage.y_validate_l2 == 0) & (predicted == 0))
-        fpr = fp / (fp + tn) if (fp + tn) != 0 else 0.0
-
-        try:
-            return 1 / fpr
-        except ZeroDivisionError:
-            return 0.0
-
-
-class TNROptimizer_layer1(Optimizer):
+        pass
 
     def optimize(self, trial: optuna.Trial) -> float:
         """
-        This function defines the objective to maximize the true positive rate
-        :param trial:
-        :return: True positive rate
+        Trains and scores a model for this objective alone.
         """
-        import hypertuner_main
-        LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+        return TrialEvaluator([self])(trial)[0]
 
-        LOGGER.info("TNR optimizer for layer1")
 
-        rf_n_estimators = trial.suggest_int(name='n_estimators', low=1, high=19, step=2)
-        rf_max_depth = trial.suggest_int(name='max_depth', low=2, high=32, step=1)
-        rf_criterion = trial.suggest_categorical('criterion', ['gini', 'entropy', 'log_loss'])
-        min_samples_split = trial.suggest_int(name='min_samples_split', low=2, high=10, step=1)
-        max_features = trial.suggest_categorical('max_features', [None, 'sqrt', 'log2'])
+class Layer1Optimizer(Optimizer):
 
-        parameters = {
-            'n_estimators': rf_n_estimators,
-            'max_depth': rf_max_depth,
-            'criterion': rf_criterion,
-            'max_features': max_features,
-            'min_samples_split': min_samples_split
-        }
+    @property
+    def layer(self) -> int:
+        return 1
 
-        classifier = self.trainer.train(parameters)
-        predicted = classifier.predict(self.temp_storage.x_validate_l1)
 
-        tn = sum((self.temp_storage.y_validate_l1 == 0) & (predicted == 0))
-        fp = sum((self.temp_storage.y_validate_l1 == 0) & (predicted == 1))
-        tnr = tn / (tn + fp) if (tn + fp) != 0 else 0.0
+class Layer2Optimizer(Optimizer):
 
-        return tnr
+    SEARCH_SPACE = {
+        'svc_c': FloatDistribution(1e-10, 1e10),
+        'kernel': CategoricalDistribution(['poly', 'rbf', 'sigmoid']),
+        'gamma': FloatDistribution(1e-10, 1e10),
+        'degree': IntDistribution(2, 5),
+        'coef0': FloatDistribution(-1.0, 1.0)
+    }
+    CONDITIONS = {
+        'gamma': ('kernel', ('rbf',)),
+        'degree': ('kernel', ('sigmoid', 'poly')),
+        'coef0': ('kernel', ('sigmoid', 'poly'))
+    }
+    PARAMETER_NAMES = {'svc_c': 'C'}
+    # trials only predict labels, Platt scaling would fit five more SVMs each, and libsvm may never converge with
+    # extreme C and gamma
+    TRIAL_PARAMETERS = {'probability': False, 'max_iter': 1_000_000}
 
+    @property
+    def layer(self) -> int:
+        return 2
 
-class TNROptimizer_layer2(Optimizer):
 
-    def optimize(self, trial: optuna.Trial) -> float:
-        import hypertuner_main
-        LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+class TPROptimizer_layer1(Layer1Optimizer):
 
-        LOGGER.info("TNR optimizer for layer2")
+    SEARCH_SPACE = {
+        'max_depth': IntDistribution(2, 32),
+        'criterion': CategoricalDistribution(['gini', 'entropy', 'log_loss']),
+        'min_samples_split': IntDistribution(2, 10),
+        'min_samples_leaf': IntDistribution(1, 10),
+        'max_features': CategoricalDistribution([None, 'sqrt', 'log2'])
+    }
 
-        svc_c = trial.suggest_float(name='svc_c', low=1e-10, high=1e10)
-        kernel = trial.suggest_categorical('kernel', ['poly', 'rbf', 'sigmoid'])
+    def score(self, rates: dict) -> float:
+        return rates['tpr']
 
-        # add to parameters all the hyperparameters that need tuning
-        parameters = {
-            'C': svc_c,
-            'kernel': kernel
-        }
 
-        if kernel == 'rbf':
-            gamma = trial.suggest_float(name='gamma', low=1e-10, high=1e10)
-            parameters['gamma'] = gamma
+class TPROptimizer_layer2(Layer2Optimizer):
 
-        if kernel in ['sigmoid', 'poly']:
-            degree = trial.suggest_int('degree', 2, 5)
-            coef0 = trial.suggest_float('coef0', -1.0, 1.0)
-            parameters['degree'] = degree
-            parameters['coef0'] = coef0
+    def score(self, rates: dict) -> float:
+        return rates['tpr']
 
-        classifier = self.trainer.train(parameters)
-        predicted = classifier.predict(self.temp_storage.x_validate_l2)
 
-        tn = sum((self.temp_storage.y_validate_l2 == 0) & (predicted == 0))
-        fp = sum((self.temp_storage.y_validate_l2 == 0) & (predicted == 1))
-        tnr = tn / (tn + fp) if (tn + fp) != 0 else 0.0
+class FPROptimizer_layer1(Layer1Optimizer):
 
-        return tnr
+    SEARCH_SPACE = {
+        'min_samples_split': IntDistribution(2, 10),
+        'min_samples_leaf': IntDistribution(1, 10),
+        'max_features': CategoricalDistribution([None, 'sqrt', 'log2'])
+    }
 
+    def score(self, rates: dict) -> float:
+        return _inverse(rates['fpr'])
 
-class FNROptimizer_layer1(Optimizer):
 
-    def optimize(self, trial: optuna.Trial) -> float:
-        """
-        This function defines the objective to maximize the true positive rate
-        :param trial:
-        :return: True positive rate
-        """
-        import hypertuner_main
-        LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+class FPROptimizer_layer2(Layer2Optimizer):
 
-        LOGGER.info("FNR optimizer for layer1")
+    def score(self, rates: dict) -> float:
+        return _inverse(rates['fpr'])
 
-        rf_max_depth = trial.suggest_int(name='max_depth', low=2, high=32, step=1)
-        rf_criterion = trial.suggest_categorical('criterion', ['gini', 'entropy', 'log_loss'])
-        min_samples_split = trial.suggest_int(name='min_samples_split', low=2, high=10, step=1)
 
-        parameters = {
-            'max_depth': rf_max_depth,
-            'criterion': rf_criterion,
-            'max_features': min_samples_split
-        }
+class TNROptimizer_layer1(Layer1Optimizer):
 
-        classifier = self.trainer.train(parameters)
-        predicted = classifier.predict(self.temp_storage.x_validate_l1)
+    SEARCH_SPACE = {
+        'n_estimators': IntDistribution(1, 19, step=2),
+        'max_depth': IntDistribution(2, 32),
+        'criterion': CategoricalDistribution(['gini', 'entropy', 'log_loss']),
+        'min_samples_split': IntDistribution(2, 10),
+        'max_features': CategoricalDistribution([None, 'sqrt', 'log2'])
+    }
 
-        fn = sum((self.temp_storage.y_validate_l1 == 1) & (predicted == 0))
-        tp = sum((self.temp_storage.y_validate_l1 == 1) & (predicted == 1))
-        fnr = fn / (fn + tp) if (fn + tp) != 0 else 0.0
+    def score(self, rates: dict) -> float:
+        return rates['tnr']
 
-        try:
-            return 1 / fnr
-        except ZeroDivisionError:
-            return 0.0
 
+class TNROptimizer_layer2(Layer2Optimizer):
 
-class FNROptimizer_layer2(Optimizer):
+    def score(self, rates: dict) -> float:
+        return rates['tnr']
 
-    def optimize(self, trial: optuna.Trial) -> float:
-        import hypertuner_main
-        LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
 
-        LOGGER.info("FNR optimizer for layer2")
+class FNROptimizer_layer1(Layer1Optimizer):
 
-        svc_c = trial.suggest_float(name='svc_c', low=1e-10, high=1e10)
-        kernel = trial.suggest_categorical('kernel', ['poly', 'rbf', 'sigmoid'])
+    SEARCH_SPACE = {
+        'max_depth': IntDistribution(2, 32),
+        'criterion': CategoricalDistribution(['gini', 'entropy', 'log_loss']),
+        'min_samples_split': IntDistribution(2, 10)
+    }
 
-        # add to parameters all the hyperparameters that need tuning
-        parameters = {
-            'C': svc_c,
-            'kernel': kernel
-        }
+    def score(self, rates: dict) -> float:
+        return _inverse(rates['fnr'])
 
-        if kernel == 'rbf':
-            gamma = trial.suggest_float(name='gamma', low=1e-10, high=1e10)
-            parameters['gamma'] = gamma
 
-        if kernel in ['sigmoid', 'poly']:
-            degree = trial.suggest_int('degree', 2, 5)
-            coef0 = trial.suggest_float('coef0', -1.0, 1.0)
-            parameters['degree'] = degree
-            parameters['coef0'] = coef0
+class FNROptimizer_layer2(Layer2Optimizer):
 
-        classifier = self.trainer.train(parameters)
-        predicted = classifier.predict(self.temp_storage.x_validate_l2)
+    def score(self, rates: dict) -> float:
+        return _inverse(rates['fnr'])
 
-        fn = sum((self.temp_storage.y_validate_l2 == 1) & (predicted == 0))
-        tp = sum((self.temp_storage.y_validate_l2 == 1) & (predicted == 1))
-        fnr = fn / (fn + tp) if (fn + tp) != 0 else 0.0
 
-        try:
-            return 1 / fnr
-        except ZeroDivisionError:
-            return 0.0
+class AccuracyOptimizer_layer1(Layer1Optimizer):
 
+    SEARCH_SPACE = {
+        'n_estimators': IntDistribution(10, 100, step=5),
+        'max_features': CategoricalDistribution([None, 'sqrt', 'log2'])
+    }
 
-class AccuracyOptimizer_layer1(Optimizer):
+    def score(self, rates: dict) -> float:
+        return rates['accuracy']
 
-    def optimize(self, trial: optuna.Trial) -> float:
-        import hypertuner_main
-        LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
 
-        LOGGER.info("Accuracy optimizer for layer1")
+class AccuracyOptimizer_layer2(Layer2Optimizer):
 
-        rf_n_estimators = trial.suggest_int(name='n_estimators', low=10, high=100, step=5)
-        max_features = trial.suggest_categorical('max_features', [None, 'sqrt', 'log2'])
+    def score(self, rates: dict) -> float:
+        return rates['accuracy']
 
-        parameters = {
-            'n_estimators': rf_n_estimators,
-            'max_features': max_features
-        }
-        LOGGER.debug(f"Parameters: n_estimators={rf_n_estimators}, max_features={max_features}")
 
-        classifier = self.trainer.train(parameters)
-        predicted = classifier.predict(self.temp_storage.x_validate_l1)
+class PrecisionOptimizer_layer1(Layer1Optimizer):
 
-        accuracy = accuracy_score(self.temp_storage.y_validate_l1, predicted)
-        return accuracy
+    SEARCH_SPACE = {
+        'max_depth': IntDistribution(2, 32),
+        'criterion': CategoricalDistribution(['gini', 'entropy', 'log_loss']),
+        'min_samples_split': IntDistribution(2, 10),
+        'min_samples_leaf': IntDistribution(1, 10),
+        'n_estimators': IntDistribution(10, 80, step=5)
+    }
 
+    def score(self, rates: dict) -> float:
+        return rates['precision']
 
-class AccuracyOptimizer_layer2(Optimizer):
 
-    def optimize(self, trial: optuna.Trial) -> float:
-        import hypertuner_main
-        LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+class PrecisionOptimizer_layer2(Layer2Optimizer):
 
-        LOGGER.info("Accuracy optimizer for layer2")
+    SEARCH_SPACE = {
+        'svc_c': FloatDistribution(1e-10, 1e10)
+    }
 
-        svc_c = trial.suggest_float(name='svc_c', low=1e-10, high=1e10)
-        kernel = trial.suggest_categorical('kernel', ['poly', 'rbf', 'sigmoid'])
+    def score(self, rates: dict) -> float:
+        return rates['precision']
 
-        # add to parameters all the hyperparameters that need tuning
-        parameters = {
-            'C': svc_c,
-            'kernel': kernel
-        }
 
-        if kernel == 'rbf':
-            gamma = trial.suggest_float(name='gamma', low=1e-10, high=1e10)
-            parameters['gamma'] = gamma
+class TrialEvaluator:
+    """
+    Scores every objective of a trial on one model. The trial samples one configuration from the union of the
+    search spaces of the objectives, the model is trained and predicts the validation set once, and each
+    objective is read from the rates of the same confusion matrix.
+    """
 
-        if kernel in ['sigmoid', 'poly']:
-            degree = trial.suggest_int('degree', 2, 5)
-            coef0 = trial.suggest_float('coef0', -1.0, 1.0)
-            parameters['degree'] = degree
-            parameters['coef0'] = coef0
-
-        classifier = self.trainer.train(parameters)
-        predicted = classifier.predict(self.temp_storage.x_validate_l2)
-
-        accuracy = accuracy_score(self.temp_storage.y_validate_l2, predicted)
-        return accuracy
-
-
-class PrecisionOptimizer_layer1(Optimizer):
-
-    def optimize(self, trial: optuna.Trial) -> float:
+    def __init__(self, optimizers: list[Optimizer]):
         import hypertuner_main
-        LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
-
-        LOGGER.info("Precision optimizer for layer1")
-
-        rf_max_depth = trial.suggest_int(name='max_depth', low=2, high=32, step=1)
-        rf_criterion = trial.suggest_categorical('criterion', ['gini', 'entropy', 'log_loss'])
-        min_samples_split = trial.suggest_int(name='min_samples_split', low=2, high=10, step=1)
-        min_samples_leaf = trial.suggest_int(name='min_samples_leaf', low=1, high=10, step=1)
-        rf_n_estimators = trial.suggest_int(name='n_estimators', low=10, high=80, step=5)
-
-        parameters = {
-            'n_estimators': rf_n_estimators,
-            'max_depth': rf_max_depth,
-            'criterion': rf_criterion,
-            'max_features': min_samples_split,
-            'min_samples_leaf': min_samples_leaf
-        }
-
-        classifier = self.trainer.train(parameters)
-        predicted = classifier.predict(self.temp_storage.x_validate_l1)
+        self.LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
 
-        precision = precision_score(self.temp_storage.y_validate_l1, predicted)
+        self.optimizers = optimizers
+        self.trainer = optimizers[0].trainer
+        self.temp_storage = optimizers[0].temp_storage
+        self.layer = optimizers[0].layer
+        self.pruner = optimizers[0].pruner
+        self.model_cache = optimizers[0].model_cache
+
+        self.search_space = union_search_space([optimizer.SEARCH_SPACE for optimizer in optimizers])
+        self.conditions = {}
+        self.parameter_names = {}
+        self.trial_parameters = {}
+        for optimizer in optimizers:
+            self.conditions.update(optimizer.CONDITIONS)
+            self.parameter_names.update(optimizer.PARAMETER_NAMES)
+            self.trial_parameters.update(optimizer.TRIAL_PARAMETERS)
 
-        return precision
+    def __call__(self, trial: optuna.Trial) -> list[float]:
+        params = {}
+        for name, distribution in self.search_space.items():
+            parent, values = self.conditions.get(name, (None, None))
+            if parent is None or params.get(parent) in values:
+                params[name] = suggest(trial, name, distribution)
 
+        self.LOGGER.debug(f'Trial {trial.number} of layer{self.layer}: {params}')
 
-class PrecisionOptimizer_layer2(Optimizer):
+        x_validate = getattr(self.temp_storage, f'x_validate_l{self.layer}')
+        y_validate = getattr(self.temp_storage, f'y_validate_l{self.layer}')
 
-    def optimize(self, trial: optuna.Trial) -> float:
-        import hypertuner_main
-        LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+        on_stage = None
+        if self.pruner is not None:
+            on_stage = self.pruner.stage_callback(trial, lambda model: self.scores(y_validate, model.predict(x_validate)))
 
-        LOGGER.info("Precision optimizer for layer2")
+        parameters = dict(self.training_parameters(params), **self.trial_parameters)
+        classifier, key = None, None
+        if self.model_cache is not None:
+            key = self.model_cache.key(self.layer, parameters, self.temp_storage)
+            classifier = self.model_cache.get(key)
+            trial.set_user_attr('cached_model', classifier is not None)
 
-        svc_c = trial.suggest_float(name='svc_c', low=1e-10, high=1e10)
+        if classifier is None:
+            classifier = self.trainer.train(parameters, on_stage)
+            if key is not None:
+                self.model_cache.put(key, classifier)
 
-        # add to parameters all the hyperparameters that need tuning
-        parameters = {
-            'C': svc_c
-        }
+        return list(self.scores(y_validate, classifier.predict(x_validate)).values())
 
-        classifier = self.trainer.train(parameters)
-        predicted = classifier.predict(self.temp_storage.x_validate_l2)
-
-        precision = precision_score(self.temp_storage.y_validate_l2, predicted)
+    def scores(self, y_validate, predicted) -> dict:
+        """
+        :return: the value of each objective, by name, for the predictions of the validation set.
+        """
+        rates = confusion_rates(y_validate, predicted)
+        return {optimizer.objective: optimizer.score(rates) for optimizer in self.optimizers}
 
-        return precision
+    def training_parameters(self, params: dict) -> dict:
+        """
+        :return: the parameters of the trainer for the parameters of a trial.
+        """
+        return {self.parameter_names.get(name, name): value for name, value in params.items()}
 
 
 class OptimizersFactory:
 
+    # objective -> optimizer of layer1 and layer2, for each of messages.TUNABLE_METRIC_NAMES
+    OPTIMIZERS = {
+        'tpr': (TPROptimizer_layer1, TPROptimizer_layer2),
+        'tnr': (TNROptimizer_layer1, TNROptimizer_layer2),
+        'fnr': (FNROptimizer_layer1, FNROptimizer_layer2),
+        'fpr': (FPROptimizer_layer1, FPROptimizer_layer2),
+        'precision': (PrecisionOptimizer_layer1, PrecisionOptimizer_layer2),
+        'accuracy': (AccuracyOptimizer_layer1, AccuracyOptimizer_layer2),
+    }
+
     @staticmethod
     def create_optimizer_object(objective: str, trainer: AbstractTrainer, temp_storage: TemporaryStorage,
                                 layer: int) -> Optimizer:
-        if objective == 'tpr':
-            return TPROptimizer_layer1(trainer, temp_storage) if layer == 1 else TPROptimizer_layer2(trainer,
-                                                                                                     temp_storage)
-        if objective == 'tnr':
-            return TNROptimizer_layer1(trainer, temp_storage) if layer == 1 else TNROptimizer_layer2(trainer,
-                                                                                                     temp_storage)
-        if objective == 'fnr':
-            return FNROptimizer_layer1(trainer, temp_storage) if layer == 1 else FNROptimizer_layer2(trainer,
-                                                                                                     temp_storage)
-        if objective == 'fpr':
-            return FPROptimizer_layer1(trainer, temp_storage) if layer == 1 else FPROptimizer_layer2(trainer,
-                                                                                                     temp_storage)
-        if objective == 'precision':
-            return PrecisionOptimizer_layer1(trainer, temp_storage) if layer == 1 else PrecisionOptimizer_layer2(
-                trainer, temp_storage)
-        if objective == 'accuracy':
-            return AccuracyOptimizer_layer1(trainer, temp_storage) if layer == 1 else AccuracyOptimizer_layer2(
-                trainer, temp_storage)
+        if objective in OptimizersFactory.OPTIMIZERS:
+            return OptimizersFactory.OPTIMIZERS[objective][layer - 1](trainer, temp_storage, objective)
 
 
 class OptimizationManager:
@@ -604,6 +560,11 @@ class OptimizationManager:
         self.svm_trainer = svm_trainer
 
         self.temp_storage = None
+        # layer -> pruner of its trials, trained in stages: growing forests for layer1, growing subsamples for
+        # layer2. Without a pruner every model is trained in full.
+        self.pruners: dict[int, StagePruner] = {1: None, 2: None}
+        # models trained by the trials and the tuner, None to train every model
+        self.model_cache: ModelCache = None
 
     def tear_down_storage(self):
         del self.temp_storage
@@ -615,38 +576,35 @@ class OptimizationManager:
         self.rf_trainer.set_temp_storage(self.temp_storage)
 
     def optimizers_mapper(self, objectives: list[str], layer: int):
+        trainer = self.rf_trainer if layer == 1 else self.svm_trainer
 
-        if layer == 1:
-            optimizers = [
-                OptimizersFactory.create_optimizer_object(objective, self.rf_trainer, self.temp_storage, layer)
-                for objective in objectives
-            ]
-        else:
-            optimizers = [
-                OptimizersFactory.create_optimizer_object(objective, self.svm_trainer, self.temp_storage, layer)
-                for objective in objectives
-            ]
+        optimizers = []
+        for objective in objectives:
+            optimizer = OptimizersFactory.create_optimizer_object(objective, trainer, self.temp_storage, layer)
+            if optimizer is None:
+                self.LOGGER.warning(f'No optimizer for the objective {objective} of layer{layer}, skipped.')
+                continue
+
+            optimizer.pruner = self.pruners.get(layer)
+            optimizer.model_cache = self.model_cache
+            optimizers.append(optimizer)
 
         return optimizers
 
     def optimization_wrapper(self, optimizers: list[Optimizer], trial: optuna.Trial):
         """
-        This function wraps the objective functions and optimizes them using Optuna.
-        :return: A list of outputs from the objective functions.
+        This function trains one model per trial and scores it for every objective.
+        :return: A list of outputs from the objective functions, empty if the trial failed.
         """
-        self.LOGGER.debug("Entering optimization_wrapper")
-
-        outputs = []
-        for optimizer in optimizers:
-            self.LOGGER.debug(f"ID: {threading.get_ident()} -> Processing optimizer: {optimizer}")
+        self.LOGGER.debug(f"ID: {threading.get_ident()} -> Evaluating trial {trial.number} for "
+                          f"{[optimizer.objective for optimizer in optimizers]}")
 
-            objective_function = optimizer.optimize
-            try:
-                output_value = objective_function(trial)
-                outputs.append(output_value)
-
-            except Exception as e:
-                self.LOGGER.debug(f"Error in function {objective_function.__name__}: {str(e)}")
-
-        self.LOGGER.debug("Exiting optimization_wrapper")
-        return [output for output in outputs]
+        try:
+            return TrialEvaluator(optimizers)(trial)
+
+        except optuna.TrialPruned:
+            raise
+        except Exception as e:
+            # the trial fails on the wrong number of values, the study goes on
+            self.LOGGER.warning(f"Trial {trial.number} failed: {str(e)}")
+            return []
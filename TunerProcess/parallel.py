@@ -0,0 +1,260 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+import optuna
+from optuna.storages import JournalStorage
+from optuna.trial import TrialState
+
+try:
+    from optuna.storages.journal import JournalFileBackend
+except ImportError:
+    # optuna < 4
+    from optuna.storages import JournalFileStorage as JournalFileBackend
+
+from Shared.shared_datasets import DEFAULT_ROOT, SharedDatasetRegistry
+
+
+def journal_storage(path: str) -> JournalStorage:
+    """
+    Optuna storage in a journal file, which several processes can append trials to at the same time.
+    """
+    return JournalStorage(JournalFileBackend(path))
+
+
+class SharedTemporaryStorage:
+    """
+    Train and validation sets of one layer attached from a SharedDatasetRegistry, with the attributes of
+    TemporaryStorage read by the trainers and the optimizers. The arrays are read-only memory maps, every
+    worker process reads the same physical pages.
+    """
+
+    def __init__(self, registry: SharedDatasetRegistry, dataset_name: str, layer: int):
+        self.x_train_l1 = self.y_train_l1 = self.x_validate_l1 = self.y_validate_l1 = None
+        self.x_train_l2 = self.y_train_l2 = self.x_validate_l2 = self.y_validate_l2 = None
+
+        shared = registry.attach(dataset_name)
+        if shared is None:
+            raise RuntimeError(f'Dataset {dataset_name} has not been published.')
+
+        setattr(self, f'x_train_l{layer}', shared.as_dataframe('x_train'))
+        setattr(self, f'y_train_l{layer}', shared['y_train'])
+        setattr(self, f'x_validate_l{layer}', shared.as_dataframe('x_validate'))
+        setattr(self, f'y_validate_l{layer}', shared['y_validate'])
+
+
+def _worker_optimizers(objectives: list[str], layer: int, registry_root: str, dataset_name: str, pruner=None,
+                       model_cache=None):
+    """
+    Rebuilds, in a worker process, the optimization manager and the optimizers of a layer on its shared datasets.
+    :return: the manager and the optimizers of the objectives.
+    """
+    from TunerProcess import optimizer as optimizer_module
+
+    temp_storage = SharedTemporaryStorage(SharedDatasetRegistry(registry_root), dataset_name, layer)
+
+    trainer = optimizer_module.RFTrainer() if layer == 1 else optimizer_module.SVMTrainer()
+    trainer.set_temp_storage(temp_storage)
+
+    manager = optimizer_module.OptimizationManager(sqlite_manager=None, rf_trainer=trainer, svm_trainer=trainer)
+    manager.temp_storage = temp_storage
+    manager.pruners[layer] = pruner
+    manager.model_cache = model_cache
+    return manager, manager.optimizers_mapper(objectives, layer)
+
+
+def _run_trials(journal_path: str, study_name: str, objectives: list[str], layer: int, n_trials: int,
+                registry_root: str, dataset_name: str, pruner=None, timeout: float = None, model_cache=None):
+    # entry point of a worker process: rebuilds the optimizers on the shared datasets and runs its trials
+    manager, optimizers = _worker_optimizers(objectives, layer, registry_root, dataset_name, pruner, model_cache)
+
+    study = optuna.load_study(study_name=study_name, storage=journal_storage(journal_path),
+                              pruner=pruner.optuna_pruner() if pruner is not None else None)
+
+    def objective(trial: optuna.Trial):
+        # the parent cancels a hung trial by terminating the process running it
+        trial.set_user_attr('worker_pid', os.getpid())
+        return manager.optimization_wrapper(optimizers, trial)
+
+    study.optimize(objective, n_trials=n_trials, timeout=timeout)
+
+
+class ProcessPoolStudyRunner:
+    """
+    Runs the trials of a study in worker processes instead of threads, so that fitting and scoring are not
+    serialised by the GIL. The workers share the study through a journal file and read the train and validation
+    sets of the layer from shared memory, published once per study; the parent only creates the study, watches
+    the workers and reads the trials back.
+
+    A worker whose trial runs longer than trial_timeout is terminated, the trial is marked as failed and a new
+    worker takes over its remaining trials. With a study timeout, the workers start no trial after it and the
+    ones still running CANCEL_GRACE_SECONDS later are terminated, so the study ends on time even if a trial hangs.
+    """
+
+    # seconds a trial is given past its timeout to stop by itself, between the stages of its training
+    CANCEL_GRACE_SECONDS = 30.0
+    # seconds between two checks of the workers
+    POLL_SECONDS = 1.0
+
+    def __init__(self, n_workers: int, registry_root: str = DEFAULT_ROOT, journal_dir: str = None,
+                 trial_timeout: float = None):
+        """
+        :param n_workers: worker processes, -1 for one per core.
+        :param registry_root: folder of the shared datasets, memory backed where available.
+        :param journal_dir: folder of the journal files, a temporary folder removed after each study by default.
+        :param trial_timeout: seconds after which a trial is cancelled, None for no limit.
+        """
+        import hypertuner_main
+        self.LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+
+        self.n_workers = os.cpu_count() if n_workers is None or n_workers < 1 else n_workers
+        self.registry = SharedDatasetRegistry(registry_root)
+        self.journal_dir = journal_dir
+        self.trial_timeout = trial_timeout
+
+        # spawned workers do not inherit the threads and locks of the parent (queue pollers, outbox)
+        self.context = multiprocessing.get_context('spawn')
+
+    def optimize(self, study_name: str, directions: list[str], optimizers: list, layer: int, n_trials: int,
+                 temp_storage, journal_path: str = None, enqueued: list[tuple[dict, dict]] = None,
+                 timeout: float = None, progress=None) -> optuna.Study:
+        """
+        :param optimizers: optimizers of the objectives, rebuilt in each worker from their objective, pruner and
+                           model cache.
+        :param temp_storage: storage holding the train and validation sets of the layer.
+        :param journal_path: journal of an existing study to add the trials to, kept afterwards.
+        :param enqueued: (params, user_attrs) of configurations to try first.
+        :param timeout: seconds after which no trial is started and the running ones are cancelled.
+        :param progress: TuningProgress updated with the trials of the study while the workers run.
+        :return: the study with the trials of every worker.
+        """
+        keep_journal = journal_path is not None or self.journal_dir is not None
+        if journal_path is None:
+            journal_dir = self.journal_dir or tempfile.mkdtemp(prefix='tuning_journal_')
+            os.makedirs(journal_dir, exist_ok=True)
+            journal_path = os.path.join(journal_dir, f'{study_name.replace(" ", "_")}.log')
+
+        dataset_name = f'tuning_l{layer}_{uuid.uuid4().hex[:8]}'
+        self.registry.publish(dataset_name, {
+            'x_train': getattr(temp_storage, f'x_train_l{layer}'),
+            'y_train': getattr(temp_storage, f'y_train_l{layer}'),
+            'x_validate': getattr(temp_storage, f'x_validate_l{layer}'),
+            'y_validate': getattr(temp_storage, f'y_validate_l{layer}')
+        })
+
+        try:
+            storage = journal_storage(journal_path)
+            study = optuna.create_study(study_name=study_name, storage=storage, directions=directions,
+                                        load_if_exists=True)
+            if progress is not None:
+                progress.start(study.get_trials(deepcopy=False))
+            for params, user_attrs in enqueued or []:
+                study.enqueue_trial(params, user_attrs=user_attrs)
+
+            start = time.time()
+            deadline = time.monotonic() + timeout if timeout is not None else None
+
+            def start_worker(name: str, share: int):
+                remaining = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+                worker = self.context.Process(
+                    target=_run_trials,
+                    args=(journal_path, study_name, [optimizer.objective for optimizer in optimizers], layer,
+                          share, self.registry.root, dataset_name, optimizers[0].pruner, remaining,
+                          optimizers[0].model_cache),
+                    name=name,
+                    daemon=True
+                )
+                worker.start()
+                return worker
+
+            # name -> (process, trials it was started for)
+            workers = {
+                f'tuning-worker-{i}': (start_worker(f'tuning-worker-{i}', share), share)
+                for i, share in enumerate(self.__split(n_trials)) if share > 0
+            }
+            n_processes, failed = len(workers), []
+
+            while workers:
+                for name, (worker, _) in list(workers.items()):
+                    worker.join(timeout=self.POLL_SECONDS / len(workers))
+                    if not worker.is_alive():
+                        del workers[name]
+                        if worker.exitcode != 0:
+                            failed.append(name)
+
+                trials = study.get_trials(deepcopy=False)
+                if progress is not None:
+                    progress.update(trials)
+
+                if deadline is not None and time.monotonic() > deadline + self.CANCEL_GRACE_SECONDS:
+                    for name, (worker, _) in list(workers.items()):
+                        self.__cancel(storage, trials, worker, 'study timeout')
+                        del workers[name]
+                    continue
+
+                for name, (worker, share) in list(workers.items()):
+                    if not self.__runs_hung_trial(trials, worker.pid):
+                        continue
+
+                    self.__cancel(storage, trials, worker, f'trial timeout of {self.trial_timeout:.0f}s')
+                    # the trials the worker did not get to are run by a new worker
+                    done = sum(1 for trial in trials if trial.user_attrs.get('worker_pid') == worker.pid)
+                    replacement = f'{name}.{done}'
+                    del workers[name]
+                    if share - done > 0 and not (deadline is not None and time.monotonic() >= deadline):
+                        workers[replacement] = (start_worker(replacement, share - done), share - done)
+                        n_processes += 1
+
+            if failed:
+                self.LOGGER.error(f'Tuning workers {failed} exited with errors.')
+
+            trials = optuna.load_study(study_name=study_name, storage=journal_storage(journal_path)).trials
+            if progress is not None:
+                progress.update(trials)
+            self.LOGGER.info(f'{len(trials)} trial(s) of {study_name} in {time.time() - start:.1f}s '
+                             f'on {n_processes} process(es).')
+
+            # in memory, the journal may be removed right after
+            study = optuna.create_study(study_name=study_name, directions=directions)
+            study.add_trials(trials)
+            return study
+
+        finally:
+            self.registry.remove(dataset_name)
+            if not keep_journal:
+                shutil.rmtree(os.path.dirname(journal_path), ignore_errors=True)
+
+    def __runs_hung_trial(self, trials: list, pid: int) -> bool:
+        """
+        :return: whether the worker of pid has been running a trial for longer than trial_timeout and its grace.
+        """
+        if self.trial_timeout is None:
+            return False
+
+        now = datetime.now()
+        return any(
+            trial.state == TrialState.RUNNING and trial.user_attrs.get('worker_pid') == pid
+            and (now - trial.datetime_start).total_seconds() > self.trial_timeout + self.CANCEL_GRACE_SECONDS
+            for trial in trials
+        )
+
+    def __cancel(self, storage: JournalStorage, trials: list, worker, reason: str):
+        """
+        Terminates a worker and marks the trials it was running as failed.
+        """
+        worker.terminate()
+        worker.join()
+
+        for trial in trials:
+            if trial.state == TrialState.RUNNING and trial.user_attrs.get('worker_pid') == worker.pid:
+                storage.set_trial_user_attr(trial._trial_id, 'cancelled', reason)
+                storage.set_trial_state_values(trial._trial_id, TrialState.FAIL)
+                self.LOGGER.warning(f'Cancelled trial {trial.number} of {worker.name}: {reason}.')
+
+    def __split(self, n_trials: int) -> list[int]:
+        share, extra = divmod(n_trials, self.n_workers)
+        return [share + (i < extra) for i in range(self.n_workers)]
@@ -0,0 +1,158 @@
+import os
+import time
+
+import numpy as np
+import optuna
+from optuna.trial import TrialState
+
+# share of the final number of trees grown before each intermediate evaluation
+STAGES = (0.25, 0.5, 1.0)
+# share of the train set fitted at each stage of a model trained on subsamples, a third of the previous one
+SUBSAMPLE_STAGES = (1 / 9, 1 / 3, 1.0)
+
+
+def stage_sizes(n_estimators: int) -> list[int]:
+    """
+    :return: the increasing numbers of trees of the stages of a forest of n_estimators trees.
+    """
+    return sorted({max(1, int(round(n_estimators * share))) for share in STAGES})
+
+
+def subsample_sizes(n_rows: int, min_rows: int) -> list[int]:
+    """
+    :return: the increasing numbers of rows of the stages of a model trained on n_rows rows, the stages with less
+             than min_rows rows left out.
+    """
+    return sorted({int(round(n_rows * share)) for share in SUBSAMPLE_STAGES if n_rows * share >= min_rows} | {n_rows})
+
+
+class StagePruner:
+    """
+    Stops unpromising trials between the stages of an incremental training.
+
+    Single-objective studies are pruned by the Optuna pruner of the study (median or successive halving) from
+    the values reported at each stage. Optuna cannot prune multi-objective studies, so their intermediate values
+    are kept as user attributes of the trials: a trial is pruned at a stage once it has reported every objective
+    at that stage and each of them is below the given percentile of the values of the other trials at the same
+    stage. A trial that is promising on any objective may still be Pareto-optimal, so it keeps going.
+
+    Each pruned trial records the CPU-seconds it spent and an estimate of the CPU-seconds its remaining stages
+    would have taken, summed per study by summary. A trial still running after trial_timeout seconds is stopped
+    at the end of its current stage.
+    """
+
+    def __init__(self, kind: str = 'median', n_startup_trials: int = 5, n_warmup_steps: int = 1,
+                 percentile: float = 25.0, trial_timeout: float = None):
+        """
+        :param kind: 'median', 'halving' or 'hyperband', the Optuna pruner of single-objective studies.
+        :param n_startup_trials: trials reporting a stage before any trial is pruned at that stage.
+        :param n_warmup_steps: stages never pruned.
+        :param percentile: threshold of the multi-objective pruning.
+        :param trial_timeout: seconds after which a trial is stopped, None for no limit.
+        """
+        self.kind = kind
+        self.n_startup_trials = n_startup_trials
+        self.n_warmup_steps = n_warmup_steps
+        self.percentile = percentile
+        self.trial_timeout = trial_timeout
+
+    def optuna_pruner(self) -> optuna.pruners.BasePruner:
+        if self.kind == 'halving':
+            return optuna.pruners.SuccessiveHalvingPruner(min_resource=1, reduction_factor=2)
+        if self.kind == 'hyperband':
+            return optuna.pruners.HyperbandPruner(min_resource=1, max_resource=len(SUBSAMPLE_STAGES),
+                                                  reduction_factor=3)
+        return optuna.pruners.MedianPruner(n_startup_trials=self.n_startup_trials,
+                                           n_warmup_steps=self.n_warmup_steps)
+
+    def stage_callback(self, trial: optuna.Trial, score: callable) -> callable:
+        """
+        :param score: returns the values of the objectives, by name, of the model at a stage.
+        :return: the callback of the trainer after each stage, called with the model, the index of the stage and
+                 the share of the final model trained so far. It raises optuna.TrialPruned to stop the trial.
+        """
+        # fitting runs in the thread of the trial, the CPU time of the other trials is not counted
+        cpu_start = time.thread_time()
+        start = time.monotonic()
+
+        def on_stage(model, step: int, progress: float):
+            if progress >= 1.0:
+                # nothing left to save, the trial is scored as usual
+                return
+
+            timed_out = self.trial_timeout is not None and time.monotonic() - start > self.trial_timeout
+            if timed_out:
+                trial.set_user_attr('timed_out', True)
+                reason = f'Stopped at stage {step} after {time.monotonic() - start:.0f}s.'
+            else:
+                values = score(model)
+                reason = f'Pruned at stage {step} with {values}.'
+
+            if timed_out or self.__should_prune(trial, step, values):
+                spent = time.thread_time() - cpu_start
+                # linear in the share of the model, trees or rows: a lower bound for the superlinear SVM fits
+                saved = spent * (1.0 / progress - 1.0)
+
+                trial.set_user_attr('pruned_at_stage', step)
+                trial.set_user_attr('cpu_seconds', trial.user_attrs.get('cpu_seconds', 0.0) + spent)
+                trial.set_user_attr('cpu_saved', trial.user_attrs.get('cpu_saved', 0.0) + saved)
+                raise optuna.TrialPruned(reason)
+
+        return on_stage
+
+    def __should_prune(self, trial: optuna.Trial, step: int, values: dict) -> bool:
+        if len(trial.study.directions) == 1:
+            trial.report(next(iter(values.values())), step)
+            return trial.should_prune()
+
+        for objective, value in values.items():
+            trial.set_user_attr(f'stage:{objective}:{step}', value)
+
+        if step < self.n_warmup_steps:
+            return False
+
+        # the objectives scored earlier at this stage in the same trial count too
+        reported = {key: value for key, value in trial.user_attrs.items()
+                    if key.startswith('stage:') and key.endswith(f':{step}')}
+        if len(reported) < len(trial.study.directions):
+            return False
+
+        others = [
+            other.user_attrs for other in trial.study.get_trials(
+                deepcopy=False, states=(TrialState.COMPLETE, TrialState.PRUNED, TrialState.RUNNING)
+            )
+            if other.number != trial.number
+        ]
+
+        for key, value in reported.items():
+            previous = [attrs[key] for attrs in others if key in attrs]
+            if len(previous) < self.n_startup_trials or value >= np.percentile(previous, self.percentile):
+                return False
+
+        return True
+
+    @staticmethod
+    def summary(study: optuna.Study) -> dict:
+        """
+        :return: the number of trials and pruned trials of a study, and the CPU-seconds the pruned ones spent
+                 and saved.
+        """
+        pruned = [trial for trial in study.trials if trial.state == TrialState.PRUNED]
+
+        return {
+            'trials': len(study.trials),
+            'pruned_trials': len(pruned),
+            'timed_out_trials': sum(1 for trial in pruned if trial.user_attrs.get('timed_out')),
+            'pruned_cpu_seconds': sum(trial.user_attrs.get('cpu_seconds', 0.0) for trial in pruned),
+            'cpu_saved': sum(trial.user_attrs.get('cpu_saved', 0.0) for trial in pruned)
+        }
+
+
+def log_summary(study: optuna.Study):
+    import hypertuner_main
+    logger = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+
+    summary = StagePruner.summary(study)
+    logger.info(f'{study.study_name}: pruned {summary["pruned_trials"]}/{summary["trials"]} trial(s), '
+                f'{summary["timed_out_trials"]} timed out, after {summary["pruned_cpu_seconds"]:.1f} CPU-seconds, '
+                f'saving about {summary["cpu_saved"]:.1f}.')
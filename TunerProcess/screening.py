@@ -0,0 +1,175 @@
+import os
+import time
+import warnings
+
+import numpy as np
+import optuna
+from optuna.trial import TrialState
+from scipy.stats import spearmanr
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.kernel_approximation import Nystroem
+from sklearn.pipeline import make_pipeline
+from sklearn.svm import LinearSVC
+
+from TunerProcess.optimizer import OptimizersFactory, SVMTrainer, TrialEvaluator
+
+
+class SurrogateSVMTrainer(SVMTrainer):
+    """
+    Cheap stand-in of SVMTrainer: a linear SVM on a Nystroem approximation of the same kernel, fitted on a
+    stratified subsample of the train set. Its cost grows linearly with the subsample instead of quadratically
+    or worse with the whole train set.
+    """
+
+    def __init__(self, n_components: int = 100, max_iter: int = 300, max_rows: int = 1000):
+        """
+        :param n_components: rows of the subsample the kernel is approximated from.
+        :param max_iter: iterations of the linear SVM, extreme C values are not worth converging.
+        :param max_rows: rows of the stratified subsample the surrogate is fitted on.
+        """
+        super().__init__()
+        self.n_components = n_components
+        self.max_iter = max_iter
+        self.max_rows = max_rows
+
+    def train(self, parameters: dict, on_stage: callable = None):
+        rows = self._stratified_order()[:self.max_rows]
+        x_train, y_train = self.temp_storage.x_train_l2.iloc[rows], self.temp_storage.y_train_l2.iloc[rows]
+
+        # the defaults of SVMTrainer, so that both models are trained for the same configuration
+        surrogate = make_pipeline(
+            Nystroem(kernel=parameters.get('kernel', 'rbf'), gamma=parameters.get('gamma', 0.01),
+                     degree=parameters.get('degree', 3), coef0=parameters.get('coef0', 0.0),
+                     n_components=min(self.n_components, len(rows)), random_state=0),
+            LinearSVC(C=parameters.get('C', 10), max_iter=self.max_iter)
+        )
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', ConvergenceWarning)
+            surrogate.fit(x_train, y_train)
+
+        return surrogate
+
+
+class SurrogateScreener:
+    """
+    First stage of the two-stage tuning of layer2. The candidate configurations are sampled and scored with
+    SurrogateSVMTrainer, the top_k of them by Pareto rank are then enqueued in the study to be trained exactly,
+    each with its surrogate scores as user attribute. After the study, report tells how well the surrogate
+    ranked the candidates that were trained exactly and how much wall-clock time screening saved.
+    """
+
+    def __init__(self, candidates: int, top_k: int, max_rows: int = 1000):
+        """
+        :param candidates: configurations scored with the surrogate.
+        :param top_k: configurations trained exactly.
+        :param max_rows: rows of the train set the surrogate is fitted on.
+        """
+        import hypertuner_main
+        self.LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+
+        self.candidates = candidates
+        self.top_k = top_k
+        self.trainer = SurrogateSVMTrainer(max_rows=max_rows)
+
+        self.__screening_seconds = 0.0
+
+    def screen(self, optimizers: list, n_jobs: int) -> list[tuple[dict, dict]]:
+        """
+        :param optimizers: optimizers of the objectives of the study.
+        :return: the (params, user_attrs) of the top_k candidates, best first.
+        """
+        self.trainer.set_temp_storage(optimizers[0].temp_storage)
+        surrogates = [
+            OptimizersFactory.create_optimizer_object(optimizer.objective, self.trainer, optimizer.temp_storage,
+                                                      optimizer.layer)
+            for optimizer in optimizers
+        ]
+        evaluator = TrialEvaluator(surrogates)
+
+        start = time.monotonic()
+        screening = optuna.create_study(directions=['maximize' for _ in optimizers])
+        screening.optimize(evaluator, n_trials=self.candidates, n_jobs=n_jobs)
+        self.__screening_seconds = time.monotonic() - start
+
+        trials = [trial for trial in screening.trials if trial.state == TrialState.COMPLETE]
+        selected, seen = [], set()
+
+        for i in self.__pareto_order(np.array([trial.values for trial in trials])):
+            key = tuple(sorted(trials[i].params.items(), key=lambda item: item[0]))
+            if key in seen:
+                continue
+            seen.add(key)
+            selected.append((trials[i].params, {'surrogate_values': trials[i].values,
+                                                'surrogate_rank': len(selected)}))
+            if len(selected) == self.top_k:
+                break
+
+        self.LOGGER.info(f'Screened {len(trials)} configuration(s) in {self.__screening_seconds:.1f}s, '
+                         f'{len(selected)} advance to exact training.')
+        return selected
+
+    def report(self, study: optuna.Study) -> dict:
+        """
+        Logs and returns how well the surrogate agrees with the exact training and the wall-clock time saved.
+        Agreement is the Spearman correlation of the surrogate and exact values of each objective over the
+        candidates trained exactly, and whether the best candidate of the surrogate is Pareto-optimal.
+        """
+        screened = [
+            trial for trial in study.trials
+            if trial.state == TrialState.COMPLETE and 'surrogate_values' in trial.user_attrs
+        ]
+        if not screened:
+            return {}
+
+        surrogate = np.array([trial.user_attrs['surrogate_values'] for trial in screened])
+        exact = np.array([trial.values for trial in screened])
+
+        correlations = []
+        for objective in range(exact.shape[1]):
+            if len(screened) < 3 or np.ptp(surrogate[:, objective]) == 0 or np.ptp(exact[:, objective]) == 0:
+                correlations.append(None)
+            else:
+                correlations.append(float(spearmanr(surrogate[:, objective], exact[:, objective])[0]))
+
+        best_numbers = {trial.number for trial in study.best_trials}
+        first = min(screened, key=lambda trial: trial.user_attrs['surrogate_rank'])
+
+        exact_seconds = np.mean([trial.duration.total_seconds() for trial in screened])
+        saved = exact_seconds * (self.candidates - len(screened)) - self.__screening_seconds
+
+        report = {
+            'candidates': self.candidates,
+            'exact_trials': len(screened),
+            'spearman': correlations,
+            'surrogate_best_is_pareto_optimal': first.number in best_numbers,
+            'screening_seconds': self.__screening_seconds,
+            'exact_seconds_per_trial': float(exact_seconds),
+            'seconds_saved': float(saved)
+        }
+
+        self.LOGGER.info(f'Surrogate screening of {study.study_name}: Spearman {correlations} over '
+                         f'{len(screened)} exact trial(s), best candidate Pareto-optimal: '
+                         f'{report["surrogate_best_is_pareto_optimal"]}, about {saved:.0f}s saved against '
+                         f'training the {self.candidates} candidates exactly.')
+        return report
+
+    @staticmethod
+    def __pareto_order(values: np.ndarray) -> list[int]:
+        """
+        :return: the indexes of the rows of values, all maximised, by Pareto front then by mean rank within it.
+        """
+        remaining = np.arange(len(values))
+        ranks = values.argsort(axis=0).argsort(axis=0).mean(axis=1)
+        order = []
+
+        while len(remaining):
+            candidates = values[remaining]
+            dominated = np.array([
+                ((candidates >= row).all(axis=1) & (candidates > row).any(axis=1)).any() for row in candidates
+            ])
+            front = remaining[~dominated]
+            order.extend(front[np.argsort(-ranks[front])].tolist())
+            remaining = remaining[dominated]
+
+        return order
@@ -2,11 +2,13 @@ import os
 import sqlite3
 
 import boto3
+import numpy as np
 import pandas as pd
 
 from botocore.exceptions import ClientError
-from Shared import utils
+from Shared import sql_query, utils
 from Shared.s3_wrapper import Loader
+from Shared.shared_datasets import SharedDatasetRegistry
 
 
 class S3Manager:
@@ -86,6 +88,7 @@ class S3Manager:
 
 
 class Storage:
+    USE_SHARED_DATASETS = True
 
     def __init__(self, s3_manager: S3Manager):
 
@@ -94,25 +97,49 @@ class Storage:
 
         self.s3_manager = s3_manager
         self.loader = self.s3_manager.get_prepared_loader()
+        self.shared_registry = SharedDatasetRegistry() if self.USE_SHARED_DATASETS else None
+        self.dataset_versions = {}
+        # table name -> (x, y) of the datasets attached from shared memory, read in place by the tuner
+        self.shared_tables = {}
         self.__load_data_in_disk()
 
+    def __load_dataset(self, table_name: str, name: str, pca_file: str, targets_file: str):
+        # prefer the copy published by a co-located KnowledgeBase, it is mapped without being parsed again
+        if self.shared_registry is not None:
+            shared = self.shared_registry.attach(name)
+            if shared is not None:
+                self.LOGGER.debug(f'Attached to shared dataset {name}, version {shared.version}.')
+                self.dataset_versions[name] = shared.version
+                self.shared_tables[table_name] = (shared.as_dataframe('x'), shared['y'])
+                return self.shared_tables[table_name]
+
+        return self.loader.load_dataset(pca_file, targets_file)
+
     def __load_data_in_disk(self):
 
         self.LOGGER.debug('Loading train sets.')
-        self.x_train_l1, self.y_train_l1 = self.loader.load_dataset(
+        self.x_train_l1, self.y_train_l1 = self.__load_dataset(
+            'x_train_l1',
+            'KDDTrain+_l1_pca',
             'KDDTrain+_l1_pca.txt',
             'KDDTrain+_l1_targets.npy'
         )
-        self.x_train_l2, self.y_train_l2 = self.loader.load_dataset(
+        self.x_train_l2, self.y_train_l2 = self.__load_dataset(
+            'x_train_l2',
+            'KDDTrain+_l2_pca',
             'KDDTrain+_l2_pca.txt',
             'KDDTrain+_l2_targets.npy'
         )
         self.LOGGER.debug('Loading validation sets.')
-        self.x_validate_l1, self.y_validate_l1 = self.loader.load_dataset(
+        self.x_validate_l1, self.y_validate_l1 = self.__load_dataset(
+            'x_validate_l1',
+            'KDDValidate+_l1_pca',
             'KDDValidate+_l1_pca.txt',
             'KDDValidate+_l1_targets.npy'
         )
-        self.x_validate_l2, self.y_validate_l2 = self.loader.load_dataset(
+        self.x_validate_l2, self.y_validate_l2 = self.__load_dataset(
+            'x_validate_l2',
+            'KDDValidate+_l2_pca',
             'KDDValidate+_l2_pca.txt',
             'KDDValidate+_l2_targets.npy'
         )
@@ -145,19 +172,16 @@ class SQLiteManager:
         self.LOGGER.debug('Completed sqlite3 in memory databases setup.')
 
     def __move_data_in_memory(self):
-        # create a table for each train set
-        self.storage.x_train_l1.to_sql('x_train_l1', self.sql_connection, index=False, if_exists='replace')
-        self.storage.x_train_l2.to_sql('x_train_l2', self.sql_connection, index=False, if_exists='replace')
-
-        # create a table for each validation set
-        self.storage.x_validate_l1.to_sql('x_validate_l1', self.sql_connection, index=False, if_exists='replace')
-        self.storage.x_validate_l2.to_sql('x_validate_l2', self.sql_connection, index=False, if_exists='replace')
+        # the datasets attached from shared memory are read in place, only the others are copied in tables
+        for table_name in ['x_train_l1', 'x_train_l2', 'x_validate_l1', 'x_validate_l2']:
+            if table_name in self.storage.shared_tables:
+                self.LOGGER.debug(f'{table_name} is read from shared memory, no table created.')
+                continue
 
-        # now append target variables as the last column of each table
-        self.__append_to_table('x_train_l1', 'targets', self.storage.y_train_l1)
-        self.__append_to_table('x_train_l2', 'targets', self.storage.y_train_l2)
-        self.__append_to_table('x_validate_l1', 'targets', self.storage.y_validate_l1)
-        self.__append_to_table('x_validate_l2', 'targets', self.storage.y_validate_l2)
+            getattr(self.storage, table_name).to_sql(table_name, self.sql_connection, index=False,
+                                                     if_exists='replace')
+            # now append target variables as the last column of the table
+            self.__append_to_table(table_name, 'targets', getattr(self.storage, 'y' + table_name[1:]))
 
     def __append_to_table(self, table_name, column_name, target_values):
         existing_data = pd.read_sql_query(f'SELECT * FROM {table_name}', self.sql_connection)
@@ -169,25 +193,34 @@ class SQLiteManager:
         del self.storage.x_train_l1, self.storage.x_train_l2, self.storage.y_train_l1, self.storage.y_train_l2
         del self.storage.x_validate_l1, self.storage.x_validate_l2, self.storage.y_validate_l1, self.storage.y_validate_l2
 
-    def perform_query(self, received):
+    def table_columns(self, table_name: str) -> list[str]:
+        return sql_query.query_columns(self.sql_connection, table_name)
 
-        try:
-            select_clause = received.get("select")
-            from_clause = received.get("from")
-            where_clause = received.get("where")
+    def table_rows(self, table_name: str) -> int:
+        return sql_query.query_row_count(self.sql_connection, table_name)
 
-            if where_clause is None:
-                sql_query = f'SELECT {select_clause} FROM {from_clause}'
-            else:
-                sql_query = f'SELECT {select_clause} FROM {from_clause} WHERE {where_clause}'
+    def shared_table(self, table_name: str):
+        """
+        :return: the features and the targets of a table attached from shared memory, None if it is in SQLite.
+        """
+        return self.storage.shared_tables.get(table_name)
 
-            self.LOGGER.debug(f'Executing the query: {sql_query}')
+    def perform_query(self, received):
 
-            result_df = pd.read_sql_query(sql_query, self.sql_connection)
+        try:
+            result_df = sql_query.read_query(self.sql_connection, received)
 
-        except pd.errors.DatabaseError:
+        except (pd.errors.DatabaseError, ValueError):
             self.LOGGER.exception('Could not fulfill the requests.')
             return None
 
         self.LOGGER.debug('Query was executed correctly.')
         return result_df
+
+    def perform_query_chunks(self, received, chunk_size: int = 10000, dtype=np.float64):
+        """
+        Streams the result of a query as NumPy arrays of at most chunk_size rows.
+        See Shared.sql_query.build_query for the supported query keys.
+        """
+        self.LOGGER.debug('Received a chunked query.')
+        return sql_query.iter_query_chunks(self.sql_connection, received, chunk_size=chunk_size, dtype=dtype)
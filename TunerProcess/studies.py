@@ -0,0 +1,93 @@
+import hashlib
+import os
+import time
+
+import numpy as np
+import optuna
+
+from TunerProcess.parallel import journal_storage
+
+
+def dataset_version(temp_storage, layer: int) -> str:
+    """
+    :return: a digest of the train and validation sets of a layer, the first 12 hex characters of their sha256.
+    """
+    digest = hashlib.sha256()
+
+    for name in ('x_train', 'y_train', 'x_validate', 'y_validate'):
+        array = np.ascontiguousarray(getattr(temp_storage, f'{name}_l{layer}'))
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+
+    return digest.hexdigest()[:12]
+
+
+class StudyStore:
+    """
+    Optuna studies persisted in a journal file, one per (layer, objectives, dataset version).
+
+    Tuning again a layer for the same objectives on the same data resumes its study. On new data, the study
+    starts with the Pareto-optimal configurations of the last study of the same layer and objectives enqueued
+    as its first trials, so that good models come out of the first trials instead of after the whole search.
+    """
+
+    def __init__(self, path: str, warm_start_trials: int = 5):
+        """
+        :param path: journal file of the studies, created if missing.
+        :param warm_start_trials: maximum number of previous configurations enqueued in a new study.
+        """
+        import hypertuner_main
+        self.LOGGER = hypertuner_main.LOGGER.getChild(os.path.splitext(os.path.basename(__file__))[0])
+
+        self.path = path
+        self.warm_start_trials = warm_start_trials
+        self.storage = journal_storage(path)
+
+    @staticmethod
+    def study_name(layer: int, objectives: list[str], version: str) -> str:
+        return f'layer{layer}:{"+".join(sorted(objectives))}:{version}'
+
+    def open_study(self, layer: int, objectives: list[str], temp_storage,
+                   pruner: optuna.pruners.BasePruner = None) -> optuna.Study:
+        """
+        :param pruner: pruner of the trials of single-objective studies.
+        :return: the study of the objectives on the current data of the layer, warm started if new.
+        """
+        version = dataset_version(temp_storage, layer)
+        study_name = self.study_name(layer, objectives, version)
+
+        study = optuna.create_study(study_name=study_name, storage=self.storage,
+                                    directions=['maximize' for _ in objectives], load_if_exists=True, pruner=pruner)
+
+        if study.trials:
+            self.LOGGER.info(f'Resuming study {study_name} with {len(study.trials)} trial(s).')
+            return study
+
+        study.set_user_attr('layer', layer)
+        study.set_user_attr('objectives', sorted(objectives))
+        study.set_user_attr('dataset_version', version)
+        study.set_user_attr('created_at', time.time())
+
+        self.__warm_start(study, layer, objectives, version)
+        return study
+
+    def __warm_start(self, study: optuna.Study, layer: int, objectives: list[str], version: str):
+        previous = [
+            summary for summary in optuna.get_all_study_summaries(self.storage)
+            if summary.user_attrs.get('layer') == layer
+            and summary.user_attrs.get('objectives') == sorted(objectives)
+            and summary.user_attrs.get('dataset_version') != version
+            and summary.n_trials > 0
+        ]
+        if not previous:
+            self.LOGGER.debug(f'No previous study for layer{layer} and {objectives}, starting from scratch.')
+            return
+
+        latest = max(previous, key=lambda summary: summary.user_attrs.get('created_at', 0))
+        best_trials = optuna.load_study(study_name=latest.study_name, storage=self.storage).best_trials
+
+        for trial in best_trials[:self.warm_start_trials]:
+            study.enqueue_trial(trial.params, skip_if_exists=True)
+
+        self.LOGGER.info(f'Warm started {study.study_name} with {min(len(best_trials), self.warm_start_trials)} '
+                         f'Pareto-optimal configuration(s) of {latest.study_name}.')
@@ -1,130 +1,284 @@
+import json
 import os
-import pickle
+import threading
 import time
 from abc import ABC, abstractmethod
+from collections import deque
 from datetime import datetime
+from typing import Optional
 
 import optuna
 optuna.logging.set_verbosity(optuna.logging.INFO)
 
-from Shared import utils
-from Shared.msg_enum import msg_type
+from Shared import model_store
+from Shared.messages import ModelUpdateMsg, ObjectivesMsg
 from Shared.utils import LOGGER
-from TunerProcess.optimizer import OptimizationManager, Optimizer
+from TunerProcess.budget import TuningBudget, TuningProgress, cpu_seconds
+from TunerProcess.optimizer import OptimizationManager, Optimizer, TrialEvaluator
+from TunerProcess.parallel import ProcessPoolStudyRunner
+from TunerProcess.pruning import StagePruner, log_summary
+from TunerProcess.screening import SurrogateScreener
+from TunerProcess.studies import StudyStore
 from TunerProcess.storage import Storage
 
 
 class LayerTuner(ABC):
 
+    n_trials: int
+    n_cores: int
+    optimizer: OptimizationManager
+    runner: ProcessPoolStudyRunner = None
+    study_store: StudyStore = None
+    screener: SurrogateScreener = None
+    progress: TuningProgress = None
+
     @abstractmethod
-    def tune_layer(self, fun_calls: list[callable]):
+    def tune_layer(self, fun_calls: list[callable], timeout: float = None):
         pass
 
+    def _run_study(self, layer: int, optimizers: list[Optimizer], timeout: float = None) -> Optional[optuna.Study]:
+        """
+        Runs n_trials trials for the objectives of the optimizers, in the persistent study of the layer if there is
+        a study store, in worker processes if there is a runner. With a screener, the trials are the top
+        configurations of the screening instead. With a timeout, the study stops starting trials after it and
+        keeps the trials finished so far; the runner also cancels the trials still running shortly after it.
+        :return: the study, None if no objective of the layer has an optimizer.
+        """
+        if not optimizers:
+            LOGGER.warning(f'No objective of layer{layer} can be optimized, no study is run.')
+            return None
+
+        # the values of a trial follow the order of the optimizers: sorted as in the name of the persisted study,
+        # the same objectives requested in another order resume it with the values in the same columns
+        optimizers = sorted(optimizers, key=lambda optimizer: optimizer.objective)
+
+        directions = ['maximize' for _ in optimizers]
+        study, study_name, journal_path = None, f'Layer{layer} optimization', None
+        pruner = optimizers[0].pruner.optuna_pruner() if optimizers[0].pruner is not None else None
+
+        n_trials, enqueued = self.n_trials, []
+        if self.screener is not None:
+            enqueued = self.screener.screen(optimizers, self.n_cores)
+            n_trials = len(enqueued)
+
+        if self.study_store is not None:
+            study = self.study_store.open_study(layer, [optimizer.objective for optimizer in optimizers],
+                                                self.optimizer.temp_storage, pruner)
+            study_name, journal_path = study.study_name, self.study_store.path
+            if enqueued:
+                # the warm start configurations still waiting run before the screened ones
+                n_trials += len(study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.WAITING,)))
+
+        n_workers = self.runner.n_workers if self.runner is not None else self.n_cores
+        self.progress = TuningProgress(layer, n_trials, n_workers if n_workers > 0 else os.cpu_count(), timeout)
+
+        if self.runner is not None:
+            study = self.runner.optimize(study_name, directions, optimizers, layer, n_trials,
+                                         self.optimizer.temp_storage, journal_path, enqueued, timeout,
+                                         self.progress)
+        else:
+            if study is None:
+                study = optuna.create_study(study_name=study_name, directions=directions, pruner=pruner)
+            self.progress.start(study.get_trials(deepcopy=False))
+            for params, user_attrs in enqueued:
+                study.enqueue_trial(params, user_attrs=user_attrs)
+
+            # a hung trial keeps its thread past the timeout, only worker processes can be cancelled
+            study.optimize(
+                lambda trial: self.optimizer.optimization_wrapper(optimizers, trial),
+                n_trials=n_trials,
+                n_jobs=self.n_cores,
+                timeout=timeout,
+                callbacks=[self.progress]
+            )
+
+        if optimizers[0].pruner is not None:
+            log_summary(study)
+        if self.screener is not None:
+            study.set_user_attr('screening', self.screener.report(study))
+
+        return study
+
 
 class TunerLayer1(LayerTuner):
 
-    def __init__(self, n_trials: int, n_cores: int, optimizer: OptimizationManager):
+    def __init__(self, n_trials: int, n_cores: int, optimizer: OptimizationManager,
+                 runner: ProcessPoolStudyRunner = None, study_store: StudyStore = None):
+        """
+        :param runner: runs the trials in worker processes, in n_cores threads of this process if None.
+        :param study_store: persistent studies to resume and warm start, a new in-memory study per run if None.
+        """
         self.n_trials = n_trials
         self.n_cores = n_cores
         self.optimizer = optimizer
+        self.runner = runner
+        self.study_store = study_store
 
-    def tune_layer(self, optimizers: list[Optimizer]) -> dict:
-
-        study_l1 = optuna.create_study(
-            study_name='Layer1 optimization',
-            directions=['maximize' for _ in optimizers],
-            #pruner=optuna.pruners.NopPruner()
-        )
-
-        study_l1.optimize(
-            lambda trial: self.optimizer.optimization_wrapper(optimizers, trial),
-            n_trials=self.n_trials,
-            n_jobs=self.n_cores
-        )
-
-        return study_l1
+    def tune_layer(self, optimizers: list[Optimizer], timeout: float = None) -> Optional[optuna.Study]:
+        return self._run_study(1, optimizers, timeout)
 
 
 class TunerLayer2(LayerTuner):
 
-    def __init__(self, n_trials: int, n_cores: int, optimizer: OptimizationManager):
+    def __init__(self, n_trials: int, n_cores: int, optimizer: OptimizationManager,
+                 runner: ProcessPoolStudyRunner = None, study_store: StudyStore = None,
+                 screener: SurrogateScreener = None):
+        """
+        :param runner: runs the trials in worker processes, in n_cores threads of this process if None.
+        :param study_store: persistent studies to resume and warm start, a new in-memory study per run if None.
+        :param screener: screens configurations with a cheap surrogate, only its top ones are trained as trials.
+        """
         self.n_trials = n_trials
         self.n_cores = n_cores
         self.optimizer = optimizer
+        self.runner = runner
+        self.study_store = study_store
+        self.screener = screener
 
-    def tune_layer(self, fun_calls2: list):
-
-        study_l2 = optuna.create_study(
-            study_name='Layer2 optimization',
-            directions=['maximize' for _ in fun_calls2]
-        )
-
-        study_l2.optimize(
-            lambda trial: self.optimizer.optimization_wrapper(fun_calls2, trial),
-            n_trials=self.n_trials,
-            n_jobs=self.n_cores
-        )
-
-        return study_l2
+    def tune_layer(self, fun_calls2: list, timeout: float = None) -> Optional[optuna.Study]:
+        return self._run_study(2, fun_calls2, timeout)
 
 
 class Tuner:
 
-    def __init__(self, storage: Storage, optimization_manager: OptimizationManager, layer1_tuner: LayerTuner, layer2_tuner: LayerTuner):
+    def __init__(self, storage: Storage, optimization_manager: OptimizationManager, layer1_tuner: LayerTuner,
+                 layer2_tuner: LayerTuner, budget_seconds: float = None):
+        """
+        :param budget_seconds: wall-clock seconds of a tuning run, split between its layers, None for no limit.
+                               The best model found when a layer runs out of time is published.
+        """
         self.optimization_manager = optimization_manager
         self.storage = storage
         self.layer1_tuner = layer1_tuner
         self.layer2_tuner = layer2_tuner
+        self.budget_seconds = budget_seconds
+
+    def progress(self) -> dict:
+        """
+        :return: layer -> progress of its study in the current run.
+        """
+        return {
+            layer: tuner.progress.as_dict()
+            for layer, tuner in ((1, self.layer1_tuner), (2, self.layer2_tuner)) if tuner.progress is not None
+        }
 
     def tune(self, objectives: dict):
 
         objs_l1 = objectives['layer1']
         objs_l2 = objectives['layer2']
 
+        budget = TuningBudget(self.budget_seconds)
+        budget.start()
+        layers_left = sum(1 for objs in (objs_l1, objs_l2) if len(objs) > 0)
+        # the progress of the previous run is not reported as the one of this run
+        self.layer1_tuner.progress = self.layer2_tuner.progress = None
+
         self.optimization_manager.prepare_trainers_and_storage()
 
         if len(objs_l1) > 0:
             optimizers1 = self.optimization_manager.optimizers_mapper(objs_l1, 1)
 
             start = time.time()
+            cpu_start = cpu_seconds()
 
-            study_l1 = self.layer1_tuner.tune_layer(optimizers1)
-            best_hps = self.__get_hps_from_trials(study_l1)
-            new_layer1 = self.optimization_manager.rf_trainer.train(best_hps)
+            timeout = budget.layer_timeout(layers_left)
+            layers_left -= 1
+            study_l1 = self.layer1_tuner.tune_layer(optimizers1, timeout)
 
-            LOGGER.debug(f"Found new optimal hyperparameters for layer 1: {best_hps}")
-            tune_time = time.time() - start
-            LOGGER.info(f"Optimization of layer1 took: {tune_time}")
+            if self.__has_results(1, study_l1):
+                # trial parameters renamed for the trainer, as each trial trained them
+                best_hps = TrialEvaluator(optimizers1).training_parameters(self.__get_hps_from_trials(study_l1))
+                new_layer1 = self.__train_model(1, self.optimization_manager.rf_trainer, best_hps)
 
-            self.report_tuning_info(1, tune_time, best_hps)
+                LOGGER.debug(f"Found new optimal hyperparameters for layer 1: {best_hps}")
+                tune_time = time.time() - start
+                LOGGER.info(f"Optimization of layer1 took: {tune_time}")
 
-            with open(f'TunedModels/l1_classifier.pkl', 'wb') as f:
-                pickle.dump(new_layer1, f)
+                self.report_tuning_info(1, tune_time, best_hps)
+                self.report_tuning_cost(1, objs_l1, tune_time, self.__cpu_seconds(study_l1, cpu_start),
+                                        self.layer1_tuner.n_trials, StagePruner.summary(study_l1),
+                                        progress=self.__budget_progress(self.layer1_tuner, timeout))
+
+                model_store.save_model(new_layer1, 'TunedModels/l1_classifier.pkl')
         else:
             LOGGER.warning('No new objectives received for layer1.')
 
-        if len(objs_l2) > 0:
+        if len(objs_l2) > 0 and budget.exhausted():
+            LOGGER.warning(f'The tuning budget of {self.budget_seconds}s is exhausted, layer2 keeps its model.')
+        elif len(objs_l2) > 0:
             optimizers2 = self.optimization_manager.optimizers_mapper(objs_l2, 2)
 
             start = time.time()
+            cpu_start = cpu_seconds()
+
+            timeout = budget.layer_timeout(layers_left)
+            study_l2 = self.layer2_tuner.tune_layer(optimizers2, timeout)
 
-            study_l2 = self.layer2_tuner.tune_layer(optimizers2)
-            best_hps = self.__get_hps_from_trials(study_l2)
-            new_layer2 = self.optimization_manager.svm_trainer.train(best_hps)
+            if self.__has_results(2, study_l2):
+                # trial parameters renamed for the trainer, as each trial trained them
+                best_hps = TrialEvaluator(optimizers2).training_parameters(self.__get_hps_from_trials(study_l2))
+                new_layer2 = self.__train_model(2, self.optimization_manager.svm_trainer, best_hps)
 
-            LOGGER.debug(f"Found new optimal hyperparameters for layer 2: {best_hps}")
-            tune_time = time.time() - start
-            LOGGER.info(f"Optimization of layer2 took: {tune_time}")
+                LOGGER.debug(f"Found new optimal hyperparameters for layer 2: {best_hps}")
+                tune_time = time.time() - start
+                LOGGER.info(f"Optimization of layer2 took: {tune_time}")
 
-            self.report_tuning_info(2, tune_time, best_hps)
+                self.report_tuning_info(2, tune_time, best_hps)
+                self.report_tuning_cost(2, objs_l2, tune_time, self.__cpu_seconds(study_l2, cpu_start),
+                                        self.layer2_tuner.n_trials, StagePruner.summary(study_l2),
+                                        study_l2.user_attrs.get('screening'),
+                                        self.__budget_progress(self.layer2_tuner, timeout))
 
-            with open('TunedModels/l2_classifier.pkl', 'wb') as f:
-                pickle.dump(new_layer2, f)
+                model_store.save_model(new_layer2, 'TunedModels/l2_classifier.pkl')
         else:
             LOGGER.warning('No new objectives received for layer2.')
 
         self.optimization_manager.tear_down_storage()
 
+    def __train_model(self, layer: int, trainer, parameters: dict):
+        """
+        :return: the model of the best configuration, from the model cache if a trial or a previous run trained it
+                 on the same data, trained and cached otherwise.
+        """
+        cache = self.optimization_manager.model_cache
+        if cache is None:
+            return trainer.train(parameters)
+
+        key = cache.key(layer, parameters, self.optimization_manager.temp_storage)
+        model = cache.get(key)
+        if model is not None:
+            LOGGER.info(f'Layer{layer} model taken from the model cache instead of retrained: {cache.stats()}')
+            return model
+
+        model = trainer.train(parameters)
+        cache.put(key, model)
+        return model
+
+    @staticmethod
+    def __has_results(layer: int, study: Optional[optuna.study.Study]) -> bool:
+        if study is None:
+            return False
+
+        # a study stopped by the budget before any trial completed leaves the current model in place
+        if study.best_trials:
+            return True
+
+        LOGGER.warning(f'No trial of {study.study_name} completed, layer{layer} keeps its model.')
+        return False
+
+    @staticmethod
+    def __cpu_seconds(study: optuna.study.Study, cpu_start: float) -> float:
+        # the tuner, its threads and its worker processes, plus the trials run by the workers of other hosts
+        return cpu_seconds() - cpu_start + study.user_attrs.get('remote_cpu_seconds', 0.0)
+
+    @staticmethod
+    def __budget_progress(layer_tuner: LayerTuner, timeout: float) -> dict:
+        if timeout is None or layer_tuner.progress is None:
+            return None
+
+        progress = layer_tuner.progress.as_dict()
+        return {key: progress.get(key) for key in ('timeout', 'finished', 'cancelled')}
+
     @staticmethod
     def __get_hps_from_trials(study: optuna.study.Study):
         trials = sorted(study.best_trials, key=lambda t: t.values)
@@ -142,8 +296,88 @@ class Tuner:
             f.write(f"New optimal hyperparamters: [{hps}]\n")
             f.write(f"Training time: {timing}")
 
+    @staticmethod
+    def report_tuning_cost(layer: int, objectives: list[str], wall_seconds: float, cpu_seconds: float,
+                           n_trials: int, pruning: dict = None, screening: dict = None, progress: dict = None):
+        # one JSON record per tuning run, from which the analyzer learns what tuning each objective costs
+        record = {
+            'time': time.time(),
+            'layer': layer,
+            'objectives': list(objectives),
+            'wall_seconds': wall_seconds,
+            'cpu_seconds': cpu_seconds,
+            'n_trials': n_trials
+        }
+        if pruning is not None:
+            record['pruned_trials'] = pruning['pruned_trials']
+            record['cpu_saved'] = pruning['cpu_saved']
+        if screening:
+            record['screening'] = screening
+        if progress is not None:
+            # a budgeted run may stop before n_trials
+            record['budget_seconds'] = progress['timeout']
+            record['finished_trials'] = progress['finished']
+            record['cancelled_trials'] = progress['cancelled']
+
+        with open("tuning_history.jsonl", "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+class TuningJob:
+    """
+    Tuning of one layer for a set of objectives. Objectives received while the job is queued are merged into it.
+    """
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+
+    def __init__(self, job_id: int, layer: int, objectives: list[str], model_version: str = None,
+                 correlation_id: str = None):
+        self.job_id = job_id
+        self.layer = layer
+        self.objectives = list(objectives)
+        self.model_version = model_version
+        self.correlation_id = correlation_id
+        self.merged_messages = 1
+
+        self.state = self.QUEUED
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def merge(self, objectives: list[str], model_version: str = None, correlation_id: str = None):
+        # union of the objectives, in the order they were first requested, the latest snapshot tags win
+        self.objectives += [objective for objective in objectives if objective not in self.objectives]
+        self.model_version = model_version
+        self.correlation_id = correlation_id
+        self.merged_messages += 1
+
+    def as_dict(self) -> dict:
+        now = time.time()
+        return {
+            'job_id': self.job_id,
+            'layer': self.layer,
+            'state': self.state,
+            'objectives': list(self.objectives),
+            'model_version': self.model_version,
+            'merged_messages': self.merged_messages,
+            'queued_for': (self.started_at or now) - self.submitted_at,
+            'running_for': ((self.finished_at or now) - self.started_at) if self.started_at else None,
+            'error': self.error
+        }
+
 
 class TuningHandler:
+    """
+    Schedules the tuning requested by the objectives messages. Objectives are merged into one queued job per
+    layer and tuned by a background worker, so the message loop never waits for a tuning to complete and no
+    objectives are dropped while a tuning is running: they are tuned by the next run.
+    """
+
+    FINISHED_HISTORY = 50
 
     def __init__(self, storage: Storage, optimizer: OptimizationManager, tuner: Tuner):
 
@@ -155,30 +389,115 @@ class TuningHandler:
         self.tuner = tuner
         self.tuning_state = TuningStatusManager()
 
-    def on_tuning_msg_received(self, json_dict: dict):
+        self.__condition = threading.Condition()
+        self.__next_job_id = 1
+        # layer -> queued job
+        self.__queued = {}
+        self.__running = []
+        self.__finished = deque(maxlen=self.FINISHED_HISTORY)
+
+        self.__on_models_tuned = None
+        self.__worker = None
+
+    def start(self, on_models_tuned: callable = None):
+        """
+        Starts the worker.
+        :param on_models_tuned: called with the models update message after each tuning run.
+        """
+        self.__on_models_tuned = on_models_tuned
+        self.__worker = threading.Thread(target=self.__run, name='tuning-worker', daemon=True)
+        self.__worker.start()
+
+    def on_tuning_msg_received(self, message: ObjectivesMsg):
+        """
+        Queues the objectives of a message, merging them with the ones already queued for the same layer.
+        Returns immediately.
+        """
+        self.LOGGER.debug(f'Parsing message: {message}')
+
+        with self.__condition:
+            for layer, objectives in ((1, message.objs_layer1), (2, message.objs_layer2)):
+                if not objectives:
+                    continue
+
+                job = self.__queued.get(layer)
+                if job is None:
+                    self.__queued[layer] = TuningJob(self.__next_job_id, layer, objectives, message.model_version,
+                                                     message.correlation_id)
+                    self.__next_job_id += 1
+                    self.LOGGER.info(f'Queued tuning job {self.__queued[layer].job_id} for layer{layer}: '
+                                     f'{objectives}')
+                else:
+                    job.merge(objectives, message.model_version, message.correlation_id)
+                    self.LOGGER.info(f'Merged objectives {objectives} into the queued job {job.job_id} '
+                                     f'for layer{layer}: {job.objectives}')
+
+            self.__condition.notify()
+
+    def status(self) -> dict:
+        """
+        :return: the queued, running and last finished jobs, with how long they waited and ran in seconds, and the
+                 progress of the running ones.
+        """
+        progress = self.tuner.progress()
+        with self.__condition:
+            return {
+                'queued': [job.as_dict() for job in self.__queued.values()],
+                'running': [dict(job.as_dict(), progress=progress.get(job.layer)) for job in self.__running],
+                'finished': [job.as_dict() for job in self.__finished]
+            }
 
-        self.tuning_state.set_start_tuning_state()
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__queued:
+                    self.__condition.wait()
 
-        if not self.tuning_state.is_optimization_locked():
-            LOGGER.debug(f'Parsing message: {json_dict}')
-            objectives = utils.parse_objs(json_dict)
+                # the queued jobs of both layers are tuned in the same run, on the same prepared storage
+                jobs = [self.__queued.pop(layer) for layer in sorted(self.__queued)]
+                for job in jobs:
+                    job.state = TuningJob.RUNNING
+                    job.started_at = time.time()
+                self.__running = jobs
 
-            self.tuning_state.lock_optimization()
+            self.__tune(jobs)
+
+            with self.__condition:
+                self.__running = []
+                self.__finished.extend(jobs)
+
+            self.LOGGER.info(f'Tuning status: {self.status()}')
+
+    def __tune(self, jobs: list[TuningJob]):
+        objectives = {'layer1': [], 'layer2': []}
+        for job in jobs:
+            objectives[f'layer{job.layer}'] = job.objectives
+
+        self.tuning_state.set_start_tuning_state()
+        self.tuning_state.lock_optimization()
+
+        try:
             self.tuner.tune(objectives)
             self.storage.s3_manager.publish_s3_models()
+        except Exception as e:
+            self.LOGGER.exception(f'Tuning jobs {[job.job_id for job in jobs]} failed.')
+            for job in jobs:
+                job.state = TuningJob.FAILED
+                job.error = str(e)
+                job.finished_at = time.time()
+            self.tuning_state.unlock_optimization()
+            return
 
-            LOGGER.debug('Models have been tuned and updated. Forwarding models update notification.')
+        for job in jobs:
+            job.state = TuningJob.FINISHED
+            job.finished_at = time.time()
 
-            new_models_msg = {
-                "MSG_TYPE": str(msg_type.MODEL_UPDATE_MSG),
-                "SENDER": 'Hypertuner'
-            }
+        self.LOGGER.debug('Models have been tuned and updated. Forwarding models update notification.')
+        self.tuning_state.set_complete_tuning_state()
 
-            self.tuning_state.set_complete_tuning_state()
+        if self.__on_models_tuned is not None:
+            self.__on_models_tuned(ModelUpdateMsg(sender='Hypertuner'))
 
-            return new_models_msg
-        else:
-            LOGGER.debug('Process locked. Optimization in progress.')
 
 class TuningStatusManager:
 
@@ -201,3 +520,6 @@ class TuningStatusManager:
 
     def lock_optimization(self):
         self.OPTIMIZATION_LOCK = True
+
+    def unlock_optimization(self):
+        self.OPTIMIZATION_LOCK = False
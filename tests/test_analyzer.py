@@ -0,0 +1,49 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'AnalyzerProcess'))
+
+from AnalyzerProcess.analyzer import Analyzer
+from Shared.messages import (CLASSIFICATION_METRIC_NAMES, METRIC_NAMES, ClassificationMetrics, ConfusionCounts,
+                             LayerMetrics, MetricsSnapshotMsg)
+
+THRESHOLDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'AnalyzerProcess', 'thresholds.json')
+
+
+def snapshot(ticks: int) -> MetricsSnapshotMsg:
+    # cumulative counts of an instance with far too many false positives on both layers
+    metrics = LayerMetrics(*[0.0] * len(METRIC_NAMES))
+    classification = ClassificationMetrics(*[0.0] * len(CLASSIFICATION_METRIC_NAMES))
+    counts = ConfusionCounts(50 * ticks, 40 * ticks, 50 * ticks, 10 * ticks)
+
+    return MetricsSnapshotMsg(metrics, metrics, classification, 'v1', None, 'ds-0', counts, counts)
+
+
+class EvaluateFleetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.analyzer = Analyzer(THRESHOLDS, stale_after=3600)
+
+    def test_alarms_are_not_raised_again_without_fresh_samples(self):
+        for tick in range(1, 13):
+            self.analyzer.record_snapshot(snapshot(tick))
+            objectives = self.analyzer.evaluate_fleet()
+
+        self.assertIn('fpr', objectives.objs_layer1)
+        self.assertIn('fpr', objectives.objs_layer2)
+
+        # nothing new since the previous tick: the counts of the fleet do not tell anything about the metrics
+        stale = self.analyzer.evaluate_fleet()
+
+        self.assertTrue(stale.is_empty())
+        self.assertEqual(stale.rationale, [])
+
+        # the alarms held: they are raised again as soon as degraded samples come in
+        self.analyzer.record_snapshot(snapshot(13))
+        self.assertIn('fpr', self.analyzer.evaluate_fleet().objs_layer1)
+
+
+if __name__ == '__main__':
+    unittest.main()
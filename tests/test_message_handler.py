@@ -0,0 +1,79 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Shared import messages
+from Shared.message_handler import MessageDispatcher
+from Shared.msg_enum import msg_type
+
+
+def snapshot_dict() -> dict:
+    return messages.MetricsSnapshotMsg(
+        messages.LayerMetrics(*[0.5] * len(messages.METRIC_NAMES)),
+        messages.LayerMetrics(*[0.5] * len(messages.METRIC_NAMES)),
+        messages.ClassificationMetrics(0.7, 0.1, 0.1, 0.1),
+        model_version='v1'
+    ).to_dict()
+
+
+class MessageDispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handled = []
+        self.dispatcher = MessageDispatcher({
+            msg_type.METRICS_SNAPSHOT_MSG: self.handled.append,
+            msg_type.OBJECTIVES_MSG: self.handled.append
+        })
+
+    def test_well_formed_messages_are_handled(self):
+        objectives = messages.ObjectivesMsg(objs_layer1=['accuracy'], model_version='v1')
+
+        self.assertTrue(self.dispatcher.dispatch(json.dumps(snapshot_dict())))
+        self.assertTrue(self.dispatcher.dispatch(messages.encode(objectives)))
+
+        self.assertEqual(len(self.handled), 2)
+        self.assertEqual(self.handled[1].objs_layer1, ['accuracy'])
+
+    def test_malformed_messages_are_rejected(self):
+        snapshot = snapshot_dict()
+        snapshot['metrics_1'] = 5
+
+        bodies = [
+            json.dumps({'MSG_TYPE': [1]}),
+            json.dumps({'MSG_TYPE': str(msg_type.OBJECTIVES_MSG), 'objs_layer1': 5}),
+            json.dumps(snapshot),
+            '{"MSG_TYPE": ',
+            'not a message'
+        ]
+
+        for body in bodies:
+            with self.subTest(body=body[:60]):
+                self.assertFalse(self.dispatcher.dispatch(body))
+
+        self.assertEqual(self.handled, [])
+        self.assertEqual(self.dispatcher.get_stats()['MALFORMED']['rejected'], len(bodies))
+
+    def test_messages_without_handler_are_rejected(self):
+        update = messages.ModelUpdateMsg(sender='Hypertuner')
+
+        self.assertFalse(self.dispatcher.dispatch(messages.encode(update)))
+        self.assertEqual(self.handled, [])
+
+
+class DecodeTest(unittest.TestCase):
+
+    def test_wrong_field_types_raise_value_error(self):
+        snapshot = snapshot_dict()
+        snapshot['metrics_1'] = 5
+
+        for data in [{'MSG_TYPE': [1]}, {'MSG_TYPE': str(msg_type.OBJECTIVES_MSG), 'objs_layer1': 5}, snapshot]:
+            with self.subTest(data=data):
+                with self.assertRaises(ValueError):
+                    messages.decode(json.dumps(data))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import numpy as np
+from sklearn.datasets import make_classification
+from sklearn.ensemble import BaggingClassifier, VotingClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.svm import SVC
+
+from Shared import model_store
+
+
+class LoadModelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.x, self.y = make_classification(n_samples=200, n_features=5, random_state=0)
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_nested_svms_predict_probabilities_when_memory_mapped(self):
+        models = {
+            'svc': SVC(probability=True, random_state=0),
+            'pipeline': make_pipeline(StandardScaler(), SVC(probability=True, random_state=0)),
+            'voting': VotingClassifier([('svc', SVC(probability=True, random_state=0)),
+                                        ('lr', LogisticRegression())], voting='soft'),
+            'bagging': BaggingClassifier(SVC(probability=True, random_state=0), n_estimators=2, random_state=0)
+        }
+
+        for name, model in models.items():
+            with self.subTest(model=name):
+                path = os.path.join(self.directory.name, f'{name}.pkl')
+                expected = model.fit(self.x, self.y).predict_proba(self.x)
+                model_store.save_model(model, path)
+
+                loaded = model_store.load_model(path)
+
+                np.testing.assert_allclose(loaded.predict_proba(self.x), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+import json
+import os
+import sys
+import threading
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Shared import messages
+from Shared.fake_sqs import FakeSQSClient, FakeSQSResource, FAKE_QUEUE_URL
+from Shared.local_broker import LocalBroker
+from Shared.message_handler import MessageDispatcher
+from Shared.msg_enum import msg_type
+from Shared.sqs_wrapper import Connector, ConnectorStats
+from Shared.transports import SQSTransport
+
+
+class RecordingSQSClient(FakeSQSClient):
+    """
+    FakeSQSClient keeping the receipt handles of each delete_message_batch call.
+    """
+
+    def __init__(self, broker: LocalBroker):
+        super().__init__(broker)
+        self.deleted_batches = []
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.deleted_batches.append([entry['ReceiptHandle'] for entry in Entries])
+        return super().delete_message_batch(QueueUrl, Entries)
+
+
+class RecordingSQSResource(FakeSQSResource):
+    """
+    FakeSQSResource whose queues keep the number of entries of each send_messages call.
+    """
+
+    def __init__(self, broker: LocalBroker):
+        super().__init__(broker)
+        self.sent_batches = []
+
+    def create_queue(self, QueueName, Attributes=None):
+        queue = super().create_queue(QueueName, Attributes)
+        send_messages = queue.send_messages
+
+        def recording_send_messages(Entries):
+            self.sent_batches.append(len(Entries))
+            return send_messages(Entries)
+
+        queue.send_messages = recording_send_messages
+        return queue
+
+
+class ConnectorOnFakeSQSTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = LocalBroker()
+        self.sqs_client = RecordingSQSClient(self.broker)
+        self.sqs_resource = RecordingSQSResource(self.broker)
+        self.connector = Connector(
+            queue_names=['tuner-update.fifo'],
+            queue_urls=[FAKE_QUEUE_URL.format('tuner-update.fifo')],
+            transport=SQSTransport(self.sqs_client, self.sqs_resource)
+        )
+
+    def test_batch_send_is_split_in_batches_of_ten(self):
+        message_ids = self.connector.send_message_batch('tuner-update.fifo', [{'n': i} for i in range(25)])
+
+        self.assertEqual(len(message_ids), 25)
+        self.assertNotIn(None, message_ids)
+        self.assertEqual(self.sqs_resource.sent_batches, [10, 10, 5])
+
+    def test_batch_send_is_split_on_the_batch_size_limit(self):
+        # 100 KiB each: at most two of them fit in the 256 KiB of a batch
+        bodies = [{'n': i, 'padding': 'x' * 100 * 1024} for i in range(5)]
+        self.connector.send_message_batch('tuner-update.fifo', bodies)
+
+        self.assertEqual(self.sqs_resource.sent_batches, [2, 2, 1])
+
+    def test_messages_are_received_in_order_and_deleted(self):
+        self.connector.send_message_batch('tuner-update.fifo', [{'n': i} for i in range(25)])
+
+        received = []
+        while True:
+            batch = self.connector.receive_message_batch(wait_time=0)
+            if not batch:
+                break
+            received += [json.loads(body)['n'] for body in batch]
+
+        self.assertEqual(received, list(range(25)))
+        # one delete call per received batch, of at most ten messages
+        self.assertEqual([len(handles) for handles in self.sqs_client.deleted_batches], [10, 10, 5])
+        self.assertEqual(self.broker.receive_messages('tuner-update.fifo', 10, 0, 0), [])
+
+    def test_receive_messages_returns_one_message_per_call(self):
+        self.connector.send_message_batch('tuner-update.fifo', [{'n': i} for i in range(3)])
+
+        received = [json.loads(self.connector.receive_messages())['n'] for _ in range(3)]
+
+        self.assertEqual(received, [0, 1, 2])
+        self.assertEqual(len(self.sqs_client.deleted_batches), 1)
+
+    def test_stats_count_calls_and_messages(self):
+        self.connector.send_message_batch('tuner-update.fifo', [{'n': i} for i in range(12)])
+        self.connector.receive_message_batch(wait_time=0)
+        self.connector.receive_message_batch(wait_time=0)
+        self.connector.receive_message_batch(wait_time=0)
+
+        stats = self.connector.get_stats()
+
+        self.assertEqual((stats['send_batch']['calls'], stats['send_batch']['messages']), (2, 12))
+        self.assertEqual((stats['receive']['calls'], stats['receive']['messages']), (3, 12))
+        self.assertEqual(stats['receive']['empty_calls'], 1)
+        self.assertEqual(stats['receive:tuner-update.fifo']['calls'], 3)
+        self.assertEqual((stats['delete_batch']['calls'], stats['delete_batch']['messages']), (2, 12))
+        self.assertEqual(stats['latency:tuner-update.fifo']['messages'], 12)
+
+    def test_listen_deletes_messages_once_handled(self):
+        self.connector.send_message_batch('tuner-update.fifo', [{'n': i} for i in range(15)])
+        stop_event = threading.Event()
+        received = []
+
+        def handler(body):
+            received.append(json.loads(body)['n'])
+            if len(received) == 15:
+                stop_event.set()
+
+        self.connector.listen(handler, wait_time=1, stop_event=stop_event)
+
+        self.assertEqual(received, list(range(15)))
+        self.assertEqual([len(handles) for handles in self.sqs_client.deleted_batches], [10, 5])
+        self.assertEqual(self.broker.receive_messages('tuner-update.fifo', 10, 0, 0), [])
+
+    def test_listen_leaves_unhandled_messages_in_the_queue_when_stopped(self):
+        self.connector.send_message_batch('tuner-update.fifo', [{'n': i} for i in range(5)])
+        stop_event = threading.Event()
+        received = []
+
+        def handler(body):
+            received.append(json.loads(body)['n'])
+            if len(received) == 2:
+                stop_event.set()
+
+        self.connector.listen(handler, wait_time=1, stop_event=stop_event, visibility_timeout=1)
+
+        self.assertEqual(received, [0, 1])
+        self.assertEqual([len(handles) for handles in self.sqs_client.deleted_batches], [2])
+        # the others are delivered again once their visibility timeout expires
+        redelivered = self.broker.receive_messages('tuner-update.fifo', 10, 3, 0)
+        self.assertEqual([json.loads(message['Body'])['n'] for message in redelivered], [2, 3, 4])
+
+    def test_listen_keeps_the_message_whose_handler_failed(self):
+        self.connector.send_message_batch('tuner-update.fifo', [{'n': i} for i in range(3)])
+
+        def handler(body):
+            if json.loads(body)['n'] == 1:
+                raise RuntimeError('handler failed')
+
+        with self.assertRaises(RuntimeError):
+            self.connector.listen(handler, wait_time=1, visibility_timeout=1)
+
+        redelivered = self.broker.receive_messages('tuner-update.fifo', 10, 3, 0)
+        self.assertEqual([json.loads(message['Body'])['n'] for message in redelivered], [1, 2])
+
+    def test_listen_keeps_the_message_whose_dispatched_handler_failed(self):
+        objectives = [messages.ObjectivesMsg(objs_layer1=[objective]) for objective in ('accuracy', 'fpr', 'tpr')]
+        self.connector.send_message_batch('tuner-update.fifo', objectives)
+        stop_event = threading.Event()
+        handled = []
+
+        def handle_objectives(message):
+            if message.objs_layer1 == ['fpr']:
+                stop_event.set()
+                raise RuntimeError('handler failed')
+            handled.append(message.objs_layer1)
+
+        dispatcher = MessageDispatcher({msg_type.OBJECTIVES_MSG: handle_objectives})
+        self.connector.listen(dispatcher.dispatch, wait_time=1, stop_event=stop_event, visibility_timeout=1)
+
+        self.assertEqual(handled, [['accuracy']])
+        self.assertEqual([len(handles) for handles in self.sqs_client.deleted_batches], [1])
+        redelivered = self.broker.receive_messages('tuner-update.fifo', 10, 3, 0)
+        self.assertEqual([messages.decode(message['Body']).objs_layer1 for message in redelivered],
+                         [['fpr'], ['tpr']])
+
+
+class ConnectorStatsTest(unittest.TestCase):
+
+    def test_snapshot(self):
+        stats = ConnectorStats()
+        stats.record('receive', 0.5, 3)
+        stats.record('receive', 1.5, 0)
+
+        snapshot = stats.snapshot()['receive']
+
+        self.assertEqual(snapshot['calls'], 2)
+        self.assertEqual(snapshot['messages'], 3)
+        self.assertEqual(snapshot['empty_calls'], 1)
+        self.assertAlmostEqual(snapshot['time'], 2.0)
+        self.assertAlmostEqual(snapshot['mean_time'], 1.0)
+        self.assertAlmostEqual(snapshot['max_time'], 1.5)
+
+    def test_snapshot_is_a_copy(self):
+        stats = ConnectorStats()
+        stats.record('send', 0.1, 1)
+
+        stats.snapshot()['send']['calls'] = 100
+
+        self.assertEqual(stats.snapshot()['send']['calls'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
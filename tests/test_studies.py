@@ -0,0 +1,64 @@
+import os
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'TunerProcess'))
+
+import optuna
+import pandas as pd
+from sklearn.datasets import make_classification
+
+from TunerProcess.optimizer import OptimizationManager, RFTrainer, SVMTrainer
+from TunerProcess.studies import StudyStore
+from TunerProcess.tuner import TunerLayer1
+
+
+class StudyStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        optuna.logging.set_verbosity(optuna.logging.WARNING)
+
+        x, y = make_classification(n_samples=600, n_features=6, class_sep=2.0, random_state=0)
+        columns = [f'pc{i}' for i in range(x.shape[1])]
+        temp_storage = SimpleNamespace(
+            x_train_l1=pd.DataFrame(x[:400], columns=columns), y_train_l1=pd.Series(y[:400]),
+            x_validate_l1=pd.DataFrame(x[400:], columns=columns), y_validate_l1=pd.Series(y[400:])
+        )
+
+        trainer = RFTrainer()
+        trainer.set_temp_storage(temp_storage)
+        self.manager = OptimizationManager(None, trainer, SVMTrainer())
+        self.manager.temp_storage = temp_storage
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = StudyStore(os.path.join(self.directory.name, 'studies.log'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_permuted_objectives_resume_the_study_with_the_same_value_order(self):
+        tuner = TunerLayer1(n_trials=2, n_cores=1, optimizer=self.manager, study_store=self.store)
+
+        first = tuner.tune_layer(self.manager.optimizers_mapper(['tpr', 'fnr'], 1))
+        second = tuner.tune_layer(self.manager.optimizers_mapper(['fnr', 'tpr'], 1))
+
+        self.assertEqual(first.study_name, second.study_name)
+        self.assertEqual(len(second.trials), 4)
+        # values in the order of the sorted objectives: fnr, scored as its inverse, then tpr
+        for trial in second.trials:
+            fnr_score, tpr = trial.values
+            self.assertGreater(fnr_score, 1.0)
+            self.assertLessEqual(tpr, 1.0)
+
+    def test_objectives_without_optimizer_run_no_study(self):
+        tuner = TunerLayer1(n_trials=2, n_cores=1, optimizer=self.manager, study_store=self.store)
+
+        self.assertIsNone(tuner.tune_layer(self.manager.optimizers_mapper(['fscore'], 1)))
+        self.assertEqual(optuna.get_all_study_summaries(self.store.storage), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'AnalyzerProcess'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'TunerProcess'))
+
+from AnalyzerProcess.tuning_scheduler import TuningCostModel, TuningScheduler
+from Shared.messages import ObjectiveRationale, ObjectivesMsg, TUNABLE_METRIC_NAMES
+from TunerProcess.optimizer import OptimizersFactory
+
+
+def rationale(layer: int, metric: str) -> ObjectiveRationale:
+    return ObjectiveRationale(layer, metric, value=0.5, ewma=0.5, threshold=0.9, cusum=1.0, samples=10)
+
+
+class TuningSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        cost_model = TuningCostModel([os.path.join(self.directory.name, 'tuning_history.jsonl')])
+        self.scheduler = TuningScheduler(cost_model, budget_per_hour=5000, cooldown=600,
+                                         audit_path=os.path.join(self.directory.name, 'tuning_decisions.jsonl'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_objectives_without_optimizer_are_not_planned_nor_charged(self):
+        objectives = ObjectivesMsg(['fscore'], ['fscore', 'tpr'], rationale=[
+            rationale(1, 'fscore'), rationale(2, 'fscore'), rationale(2, 'tpr')
+        ])
+
+        planned = self.scheduler.plan(objectives, now=0)
+        self.scheduler.on_requested(planned, now=0)
+
+        self.assertEqual((planned.objs_layer1, planned.objs_layer2), ([], ['tpr']))
+        self.assertEqual(self.scheduler.budget_left(now=0), 5000 - 1800)
+        # layer1 is not cooling down, its next tunable objective is requested
+        self.assertEqual(self.scheduler.plan(ObjectivesMsg(rationale=[rationale(1, 'fpr')]), now=1).objs_layer1,
+                         ['fpr'])
+
+    def test_tunable_metrics_are_the_optimized_objectives(self):
+        self.assertEqual(set(TUNABLE_METRIC_NAMES), set(OptimizersFactory.OPTIMIZERS))
+
+
+if __name__ == '__main__':
+    unittest.main()